@@ -0,0 +1,259 @@
+import re
+import jwt
+import hmac
+import time
+import bcrypt
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from log_lib import get_logger
+
+logger = get_logger(__name__)
+
+# Prefixes of the bcrypt hash formats. Stored passwords without one
+# are legacy plaintext records
+BCRYPT_PREFIXES = ("$2a$", "$2b$", "$2y$")
+
+# A whole bcrypt hash: prefix, two-digit cost, then 53 characters of
+# salt and digest
+_BCRYPT_HASH = re.compile(r"\$2[aby]\$\d\d\$[./A-Za-z0-9]{53}")
+
+def is_password_hash(stored):
+    return stored.startswith(BCRYPT_PREFIXES) and _BCRYPT_HASH.fullmatch(stored) is not None
+
+def _create_executor(workers):
+    """
+    Thread pool for the bcrypt work. Under a gevent worker, threads are
+    greenlets and would block the event loop while hashing, so use
+    gevent's pool of real OS threads instead.
+    """
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched("threading"):
+            from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+            return GeventThreadPoolExecutor(max_workers=workers)
+    except ImportError:
+        pass
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+
+class PasswordVerifier:
+    """
+    Checks passwords against their bcrypt hashes on a bounded pool of
+    worker threads, so that a login storm can't stall the threads
+    serving the sockets, and remembers successful checks for a short
+    while so that repeated logins skip bcrypt altogether.
+    """
+
+    def __init__(self, workers=2, log_rounds=12, cache_ttl=60, cache_size=10000, clock=time.monotonic):
+        """
+        Args:
+            workers (int): Maximum number of concurrent bcrypt calls.
+            log_rounds (int): bcrypt cost for new hashes.
+            cache_ttl (float): Seconds a successful check is remembered
+                (0 disables the cache).
+            cache_size (int): Maximum number of remembered checks.
+            clock (callable): Returns the current time in seconds.
+        """
+        self.workers = workers
+        self.log_rounds = log_rounds
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.clock = clock
+
+        self.cache = OrderedDict()      # digest -> expiry time
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def _run(self, function, *args):
+        # The pool is created on first use, after any monkey patching
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = _create_executor(self.workers)
+        return self.executor.submit(function, *args)
+
+    def _cache_key(self, username, password, stored):
+        # Bound to the stored hash: changing the password invalidates it
+        return hashlib.sha256(
+            b"\0".join((username.encode(), password.encode(), stored.encode()))
+        ).digest()
+
+    def _cached(self, key):
+        with self.lock:
+            expiry = self.cache.get(key)
+            if expiry is None:
+                return False
+            if expiry < self.clock():
+                del self.cache[key]
+                return False
+            self.cache.move_to_end(key)
+            return True
+
+    def _remember(self, key):
+        if self.cache_ttl <= 0:
+            return
+        with self.lock:
+            self.cache[key] = self.clock() + self.cache_ttl
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def hash_password(self, password):
+        """
+        Hash a password on the worker pool.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the hash (str).
+        """
+        def generate():
+            return bcrypt.hashpw(password.encode(), bcrypt.gensalt(self.log_rounds)).decode()
+        return self._run(generate)
+
+    def verify(self, username, password, stored, upgrade=None):
+        """
+        Check a password against the stored one.
+
+        Args:
+            username (str): The user's username.
+            password (str): The password given by the user.
+            stored (str): The stored bcrypt hash, or a legacy
+                plaintext password.
+            upgrade (callable, optional): Called (from the pool) with a
+                bcrypt hash of the password after a successful check
+                against a plaintext password, to replace it. If it
+                fails, the error is logged and the plaintext password
+                is upgraded on a later login.
+
+        Returns:
+            bool: True if the password matches.
+        """
+        if not stored:
+            return False
+
+        key = self._cache_key(username, password, stored)
+        if self._cached(key):
+            return True
+
+        if is_password_hash(stored):
+            matches = self._run(bcrypt.checkpw, password.encode(), stored.encode()).result()
+        else:
+            matches = hmac.compare_digest(password.encode(), stored.encode())
+            if matches and upgrade is not None:
+                def replace(future):
+                    try:
+                        upgrade(future.result())
+                    except Exception:
+                        logger.exception("Could not replace the plaintext password of %s with its hash", username)
+                self.hash_password(password).add_done_callback(replace)
+
+        if matches:
+            self._remember(key)
+        return matches
+
+class InvalidToken(Exception):
+    """
+    Raised for a token that is malformed, forged or expired.
+    """
+
+class TokenVerifier:
+    """
+    Issues and checks the HS256 access and refresh tokens.
+
+    Decoded claims are cached by token until the token expires (or for
+    'cache_ttl' seconds at most), so a player pinging every few seconds
+    pays for the HMAC check and JSON decoding once, not on every ping.
+    """
+
+    def __init__(self, secret_key, cache_ttl=300, cache_size=100000, clock=time.time):
+        """
+        Args:
+            secret_key (str): The HMAC key.
+            cache_ttl (float): Seconds decoded claims are cached at most.
+            cache_size (int): Maximum number of cached tokens.
+            clock (callable): Returns the current UNIX time in seconds.
+        """
+        self.secret_key = secret_key
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.clock = clock
+
+        self.cache = OrderedDict()      # token -> (claims, cache expiry)
+        self.lock = threading.Lock()
+
+    def encode(self, subject, token_type, lifetime):
+        """
+        Create a token.
+
+        Args:
+            subject (str): The user_id the token is issued to.
+            token_type (str): 'access' or 'refresh'.
+            lifetime (float): Seconds the token is valid for, 0 for a
+                token that does not expire.
+
+        Returns:
+            str: The encoded token.
+        """
+        issued_at = self.clock()
+        payload = {
+            "expiration_time": issued_at + lifetime if lifetime else 0,
+            "issued_at": issued_at,
+            "subject": subject,
+            "token_type": token_type,
+        }
+        return jwt.encode(payload, self.secret_key, algorithm = "HS256")
+
+    def verify(self, token, token_type="access"):
+        """
+        Check a token and return its claims.
+
+        Args:
+            token (str): The encoded token.
+            token_type (str): The expected token type.
+
+        Returns:
+            dict: The claims ('expiration_time', 'issued_at', 'subject',
+            'token_type').
+
+        Raises:
+            InvalidToken: If the token can't be trusted, or is not of
+                the expected type.
+        """
+        claims = self._claims(token)
+        if claims.get("token_type") != token_type:
+            raise InvalidToken(f"Not an {token_type} token")
+        return claims
+
+    def _claims(self, token):
+        now = self.clock()
+
+        with self.lock:
+            cached = self.cache.get(token)
+            if cached is not None:
+                claims, expiry = cached
+                if expiry >= now:
+                    self.cache.move_to_end(token)
+                    return claims
+                del self.cache[token]
+
+        try:
+            # (YES, it is 'algorithms' not 'algorithm')
+            claims = jwt.decode(token, self.secret_key, algorithms = ["HS256"])
+        except jwt.InvalidTokenError as e:
+            raise InvalidToken(str(e))
+
+        expiration_time = claims.get("expiration_time") or 0
+        if expiration_time and expiration_time < now:
+            raise InvalidToken("Token has expired")
+
+        expiry = now + self.cache_ttl
+        if expiration_time:
+            expiry = min(expiry, expiration_time)
+
+        with self.lock:
+            self.cache[token] = (claims, expiry)
+            self.cache.move_to_end(token)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return claims
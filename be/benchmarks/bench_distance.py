@@ -0,0 +1,87 @@
+# Compare the per-pair geopy.geodesic check that /location used to run
+# for every cop/mafia pair with the batch modes of distance_lib.
+#
+# Run from the be/ directory:
+#   python3 benchmarks/bench_distance.py [--sizes 10 1000 100000]
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import distance_lib
+from geopy.distance import geodesic
+
+# How close the cop must be to arrest a mafia player (in meters)
+ELIMINATION_DISTANCE = 100
+
+def random_players(count, center, spread=0.01, seed=42):
+    """
+    Scatter players around a center point (spread is in degrees,
+    0.01 is roughly 1 km).
+    """
+    rng = random.Random(seed)
+    return [
+        (center[0] + rng.uniform(-spread, spread), center[1] + rng.uniform(-spread, spread))
+        for _ in range(count)
+    ]
+
+def per_pair_geodesic(cop, mafia):
+    """
+    The original elimination check: one geodesic() per mafia player.
+    """
+    return [
+        i for i, position in enumerate(mafia) 
+        if geodesic(cop, position).meters <= ELIMINATION_DISTANCE
+    ]
+
+def measure(function, repeat):
+    """
+    Best wall-clock time of a few runs, in seconds.
+    """
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the elimination distance check")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    cop = (42.33528, -71.09702)
+
+    print(f"numpy: {'yes' if distance_lib.np is not None else 'no (pure Python fallback)'}")
+    print(f"{'players':>8} {'method':>20} {'time (ms)':>12} {'speedup':>9} {'matches':>8}")
+
+    for size in args.sizes:
+        mafia = random_players(size, cop)
+        mafia_array = distance_lib.np.asarray(mafia) if distance_lib.np is not None else mafia
+
+        # geopy is slow enough that a single run is plenty for big lobbies
+        baseline, expected = measure(
+            lambda: per_pair_geodesic(cop, mafia), 
+            1 if size >= 10000 else args.repeat
+        )
+        print(f"{size:>8} {'geopy per pair':>20} {baseline * 1000:>12.3f} {1:>8.1f}x {len(expected):>8}")
+
+        for mode in ("fast", "haversine", "hybrid"):
+            elapsed, matches = measure(
+                lambda: distance_lib.within_distance(cop, mafia_array, ELIMINATION_DISTANCE, mode), 
+                args.repeat
+            )
+            flag = "" if matches == expected else "  (differs from geodesic)"
+            print(
+                f"{size:>8} {mode:>20} {elapsed * 1000:>12.3f} "
+                f"{baseline / elapsed:>8.1f}x {len(matches):>8}{flag}"
+            )
+
+if __name__ == "__main__":
+    main()
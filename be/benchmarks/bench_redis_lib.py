@@ -0,0 +1,259 @@
+# Micro-benchmarks of the redis_lib calls on the request paths, and of
+# the cop's elimination check in process_location(), at growing numbers
+# of stored users / mafia players.
+#
+# The results can be saved as a JSON baseline and later runs compared
+# against it, so a change that brings back an O(N) scan of the users
+# fails the comparison.
+#
+# Run from the be/ directory (fakeredis unless --redis-url is given):
+#   python3 benchmarks/bench_redis_lib.py --save benchmarks/baseline.json
+#   python3 benchmarks/bench_redis_lib.py --compare benchmarks/baseline.json
+#
+# Absolute times depend on the machine, so the comparison is on how
+# each benchmark scales: its time at the largest size divided by its
+# time at the smallest (e.g. 100000 vs 100 users), which stays near 1
+# for the calls that don't grow with N, whatever the machine.
+# --compare exits with status 1 if a benchmark scales more than
+# --threshold times worse than in the baseline (the committed
+# benchmarks/baseline.json was made with the default sizes).
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Keep the server quiet while it's being measured
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+# The cop pings the same position over and over, which the ping
+# filter would drop before the elimination check
+os.environ.setdefault("PING_FILTER", "0")
+
+# Where the games take place (degrees)
+CENTER = (42.33528, -71.09702)
+
+# Active players, whatever the number of stored users
+ACTIVE_PLAYERS = 50
+
+def use_redis(redis_url):
+    """
+    Point redis_lib at the Redis to measure, before the server is
+    configured.
+    """
+    import redis_lib
+
+    if redis_url:
+        redis_lib.configure(url=redis_url)
+    else:
+        import fakeredis
+        redis_lib.client = fakeredis.FakeStrictRedis(decode_responses=True)
+    redis_lib.client.flushdb()
+    return redis_lib
+
+def measure(function, number, repeat):
+    """
+    Best mean time of a call over a few runs of 'number' calls, in
+    seconds.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+def seed_users(redis_lib, first, last):
+    """
+    Store users first..last-1, the first ACTIVE_PLAYERS of them active.
+    """
+    rng = random.Random(first)
+    for user_id in range(first, last):
+        redis_lib.store_user_location(
+            str(user_id),
+            f"bench-{user_id}",
+            "password",
+            "active" if user_id < ACTIVE_PLAYERS else "inactive",
+            CENTER[0] + rng.uniform(-0.01, 0.01),
+            CENTER[1] + rng.uniform(-0.01, 0.01),
+            "mafia"
+        )
+
+def bench_redis_lib(redis_lib, sizes, number, repeat):
+    """
+    Time the redis_lib calls with sizes[i] users stored.
+    """
+    results = {}
+    stored = 0
+    rng = random.Random(42)
+
+    for size in sizes:
+        seed_users(redis_lib, stored, size)
+        stored = size
+
+        def update_user(user_id):
+            redis_lib.update_user(
+                str(user_id),
+                [f"bench-{user_id}", "password", "inactive", CENTER[0], CENTER[1], "mafia"]
+            )
+
+        benchmarks = {
+            "get_active_users": lambda: redis_lib.get_active_users(),
+            "get_user_credentials": lambda: redis_lib.get_user_credentials(
+                f"bench-{rng.randrange(size)}"
+            ),
+            "update_location": lambda: redis_lib.update_location(
+                str(rng.randrange(size)), CENTER[0], CENTER[1], "mafia"
+            ),
+            "update_user": lambda: update_user(rng.randrange(ACTIVE_PLAYERS, size)),
+        }
+        for name, function in benchmarks.items():
+            results[f"{name}[{size}]"] = measure(function, number, repeat)
+            print(f"{name:>24} {size:>8} users {results[f'{name}[{size}]'] * 1e6:>12.1f} us")
+
+    return results
+
+def bench_elimination(redis_lib, mafia_counts, number, repeat):
+    """
+    Time the cop's location update (elimination check included) in
+    rooms with mafia_counts[i] mafia players, none close enough to be
+    caught so that every call does the same work.
+
+    The players join the room as they would at '/login', and every
+    mafia pings once before the cop does, as in a real game (a
+    cop alone in a game wins it straight away, and the calls after
+    that would only measure a finished game).
+    """
+    import gameserver
+    gameserver.create_app()
+
+    results = {}
+    rng = random.Random(7)
+
+    for count in mafia_counts:
+        game_id = f"bench-{count}"
+        room = gameserver.rooms.get_or_create(game_id)
+
+        for i in range(count):
+            player_id = f"{game_id}-mafia-{i}"
+
+            # Between ~300m and ~1km from the cop
+            latitude = CENTER[0] + rng.choice((-1, 1)) * rng.uniform(0.003, 0.009)
+            longitude = CENTER[1] + rng.uniform(-0.009, 0.009)
+            redis_lib.store_user_location(player_id, player_id, "password", "active", latitude, longitude, "mafia")
+            room.join(player_id, "mafia")
+            response, status = gameserver.process_location(
+                {"id": player_id, "lat": latitude, "lon": longitude, "role": "mafia", "game_id": game_id}
+            )
+            if status != 200:
+                raise RuntimeError(f"Location update failed: {response}")
+
+        cop_id = f"{game_id}-cop"
+        redis_lib.store_user_location(cop_id, cop_id, "password", "active", CENTER[0], CENTER[1], "cop")
+        room.join(cop_id, "cop")
+        ping = {"id": cop_id, "lat": CENTER[0], "lon": CENTER[1], "role": "cop", "game_id": game_id}
+
+        def cop_ping():
+            response, status = gameserver.process_location(ping)
+            if status != 200:
+                raise RuntimeError(f"Location update failed: {response}")
+
+        results[f"cop_location[{count}]"] = measure(cop_ping, number, repeat)
+        if room.finished:
+            raise RuntimeError(f"Game {game_id} ended while it was measured")
+        print(f"{'cop_location':>24} {count:>8} mafia {results[f'cop_location[{count}]'] * 1e6:>12.1f} us")
+
+    return results
+
+def scaling(results):
+    """
+    How each benchmark scales with N.
+
+    Args:
+        results (dict): Times keyed by 'name[size]'.
+
+    Returns:
+        dict: name -> (smallest size, largest size, time at the largest
+        size / time at the smallest), for the benchmarks run at more
+        than one size.
+    """
+    times = {}
+    for key, elapsed in results.items():
+        name, _, size = key.rpartition("[")
+        times.setdefault(name, {})[int(size.rstrip("]"))] = elapsed
+
+    return {
+        name: (min(by_size), max(by_size), by_size[max(by_size)] / by_size[min(by_size)])
+        for name, by_size in times.items() if len(by_size) > 1
+    }
+
+def compare(results, baseline, threshold):
+    """
+    Print how each benchmark scales, next to its baseline.
+
+    Returns:
+        list: Names of the benchmarks that scale more than 'threshold'
+        times worse than in the baseline.
+    """
+    regressions = []
+    before = scaling(baseline)
+    print(f"{'benchmark':>24} {'sizes':>16} {'baseline':>10} {'now':>10}")
+    for name, (smallest, largest, ratio) in scaling(results).items():
+        sizes = f"{smallest}..{largest}"
+        if name not in before or before[name][:2] != (smallest, largest):
+            print(f"{name:>24} {sizes:>16} {'-':>10} {ratio:>9.2f}x  (no baseline at these sizes)")
+            continue
+        base_ratio = before[name][2]
+        flag = "  REGRESSION" if ratio > base_ratio * threshold else ""
+        print(f"{name:>24} {sizes:>16} {base_ratio:>9.2f}x {ratio:>9.2f}x{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark redis_lib and the elimination check")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 10000, 100000])
+    parser.add_argument("--mafia", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--number", type=int, default=200, help="Calls per run")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs (the best one counts)")
+    parser.add_argument("--redis-url", help="Redis to use (it is flushed!), fakeredis if omitted")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare the results with this JSON baseline")
+    parser.add_argument(
+        "--threshold", type=float, default=2.0, 
+        help="How many times worse than the baseline's scaling counts as a regression"
+    )
+    args = parser.parse_args()
+
+    redis_lib = use_redis(args.redis_url)
+
+    results = {}
+    results.update(bench_redis_lib(redis_lib, sorted(args.sizes), args.number, args.repeat))
+    results.update(bench_elimination(redis_lib, sorted(args.mafia), args.number, args.repeat))
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({
+                "python": platform.python_version(),
+                "redis": args.redis_url or "fakeredis",
+                "results": results,
+                "scaling": {name: ratio for name, (_, _, ratio) in scaling(results).items()},
+            }, file, indent=2, sort_keys=True)
+        print(f"Saved {len(results)} results to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
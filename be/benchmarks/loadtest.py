@@ -0,0 +1,476 @@
+# Load test for the location path: logs in N synthetic cops and mafia
+# through /login, then streams random-walk GPS pings to /location
+# (HTTP) and/or the Socket.IO 'location' event at a fixed rate, and
+# reports throughput, latency percentiles and broadcast delay (time
+# from a ping to the 'positions_delta' carrying it reaching the cop).
+#
+# Run from the be/ directory.
+#
+# In-process, against fakeredis (nothing else to start):
+#   python3 benchmarks/loadtest.py --players 1000 --games 10 --rate 1 --duration 30
+#
+# In-process, against a local Redis:
+#   python3 benchmarks/loadtest.py --redis-url redis://localhost:6379/0
+#
+# Against a running server (the players are seeded into its Redis):
+#   python3 benchmarks/loadtest.py --url http://localhost:5000 --redis-url redis://localhost:6379/0
+#
+# The Socket.IO path of the remote mode needs the python-socketio client
+# extras (pip install "python-socketio[client]").
+
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import argparse
+import threading
+import http.client
+from collections import defaultdict, deque
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Cheap password hashes and quiet logs for the in-process server (the
+# remote server uses its own settings)
+os.environ.setdefault("BCRYPT_LOG_ROUNDS", "4")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import bcrypt
+
+# Synthetic players get ids from here up, away from the real accounts
+FIRST_USER_ID = 900000
+PASSWORD = "loadtest"
+
+# Where the games take place (degrees)
+CENTER = (42.33528, -71.09702)
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a list of numbers (0 if empty).
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+# ==========================================================
+# +++ Synthetic players +++
+# ==========================================================
+class Player:
+    """
+    One synthetic player walking randomly around its game.
+    """
+
+    def __init__(self, user_id, role, game_id, latitude, longitude, rng):
+        self.user_id = str(user_id)
+        self.username = f"loadtest-{user_id}"
+        self.role = role
+        self.game_id = game_id
+        self.latitude = latitude
+        self.longitude = longitude
+        self.rng = rng
+        self.token = None
+        self.socket = None
+        self.eliminated = False
+
+    def step(self, meters):
+        # ~111 km per degree, close enough for a random walk
+        self.latitude += self.rng.uniform(-meters, meters) / 111000
+        self.longitude += self.rng.uniform(-meters, meters) / 111000
+
+    def ping(self):
+        return {
+            "id": self.user_id,
+            "lat": round(self.latitude, 7),
+            "lon": round(self.longitude, 7),
+            "role": self.role,
+            "game_id": self.game_id,
+        }
+
+def create_players(count, games, cops_per_game, spread, seed):
+    """
+    Split the players between the games: the first cops_per_game of
+    each game are cops, the others mafia.
+    """
+    rng = random.Random(seed)
+    players = []
+    for i in range(count):
+        game_index = i % games
+        role = "cop" if i // games < cops_per_game else "mafia"
+        players.append(Player(
+            FIRST_USER_ID + i,
+            role,
+            f"loadtest-{game_index}",
+            CENTER[0] + rng.uniform(-spread, spread),
+            CENTER[1] + rng.uniform(-spread, spread),
+            random.Random(seed + i)
+        ))
+    return players
+
+def seed_players(players):
+    """
+    Store the synthetic accounts, all with the same (cheap) bcrypt hash.
+    """
+    import redis_lib
+
+    password_hash = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(4)).decode()
+    for player in players:
+        redis_lib.store_user_location(
+            player.user_id,
+            player.username,
+            password_hash,
+            "inactive",
+            player.latitude,
+            player.longitude,
+            player.role
+        )
+
+# ==========================================================
+# +++ Transports +++
+# The in-process ones drive the app through the Flask and
+# Flask-SocketIO test clients, the remote ones over the
+# network
+# ==========================================================
+class InProcessServer:
+
+    def __init__(self, redis_url):
+        import redis_lib
+        import gameserver
+
+        if redis_url:
+            self.app = gameserver.create_app({"REDIS_URL": redis_url})
+        else:
+            import fakeredis
+            redis_lib.client = fakeredis.FakeStrictRedis(decode_responses=True)
+            self.app = gameserver.create_app()
+        self.socketio = gameserver.socketio
+
+    def http_client(self):
+        client = self.app.test_client()
+
+        def post(path, body, headers=None):
+            response = client.post(path, json=body, headers=headers or {})
+            return response.get_json()
+        return post
+
+    def connect(self, token, on_delta):
+        client = self.socketio.test_client(self.app, auth={"token": token})
+        if not client.is_connected():
+            raise RuntimeError("Socket.IO connection refused")
+        return InProcessSocket(client, on_delta)
+
+class InProcessSocket:
+    """
+    Test clients queue what they receive, so a poller thread (see
+    poll()) timestamps the broadcasts as they show up.
+    """
+
+    def __init__(self, client, on_delta):
+        self.client = client
+        self.on_delta = on_delta
+        self.lock = threading.Lock()
+
+    def emit(self, event, data):
+        with self.lock:
+            return self.client.emit(event, data, callback=True)
+
+    def poll(self):
+        with self.lock:
+            received = self.client.get_received()
+        now = time.perf_counter()
+        for packet in received:
+            if packet["name"] == "positions_delta":
+                self.on_delta(packet["args"][0], now)
+
+    def close(self):
+        with self.lock:
+            self.client.disconnect()
+
+class RemoteServer:
+
+    def __init__(self, url, redis_url):
+        import redis_lib
+
+        if redis_url:
+            redis_lib.configure(url=redis_url)
+        self.url = url.rstrip("/")
+
+    def http_client(self):
+        parts = urlsplit(self.url)
+        connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        state = {"connection": None}
+
+        # One keep-alive connection per worker thread
+        def post(path, body, headers=None):
+            for attempt in (1, 2):
+                if state["connection"] is None:
+                    state["connection"] = connection_class(parts.netloc, timeout=30)
+                try:
+                    state["connection"].request(
+                        "POST", path, json.dumps(body),
+                        {"Content-Type": "application/json", **(headers or {})}
+                    )
+                    return json.loads(state["connection"].getresponse().read())
+                except (http.client.HTTPException, OSError):
+                    state["connection"].close()
+                    state["connection"] = None
+                    if attempt == 2:
+                        raise
+        return post
+
+    def connect(self, token, on_delta):
+        import socketio
+
+        client = socketio.Client(reconnection=False)
+        client.on("positions_delta", lambda data, *_: on_delta(data, time.perf_counter()))
+        client.connect(self.url, auth={"token": token}, transports=["websocket"])
+        return RemoteSocket(client)
+
+class RemoteSocket:
+
+    def __init__(self, client):
+        self.client = client
+
+    def emit(self, event, data):
+        return self.client.call(event, data, timeout=30)
+
+    def poll(self):
+        pass
+
+    def close(self):
+        self.client.disconnect()
+
+# ==========================================================
+# +++ Load test +++
+# ==========================================================
+class LoadTest:
+
+    def __init__(self, server, players, args):
+        self.server = server
+        self.players = players
+        self.args = args
+
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)      # transport -> seconds
+        self.statuses = defaultdict(int)        # (transport, status) -> count
+        self.errors = 0
+        self.broadcast_delays = []
+
+        # player_id -> recent (latitude, send time), to match the
+        # positions in the broadcasts with the pings they came from
+        self.sent = defaultdict(lambda: deque(maxlen=64))
+
+    def login(self, player, post):
+        body = {
+            "name": player.username,
+            "password": PASSWORD,
+            "role": player.role,
+            "game_id": player.game_id
+        }
+        response, status = post("/login", body)
+        if status != 200:
+            raise RuntimeError(f"Login of {player.username} failed: {response}")
+        player.token = response["access_token"]
+
+    def on_delta(self, delta, received_at):
+        with self.lock:
+            for player_id, state in delta.items():
+                latitude = round(float(state["latitude"]), 7)
+                for sent_latitude, sent_at in self.sent.get(player_id, ()):
+                    if sent_latitude == latitude:
+                        self.broadcast_delays.append(received_at - sent_at)
+                        break
+
+    def send(self, player, transport, post):
+        data = player.ping()
+        sent_at = time.perf_counter()
+        with self.lock:
+            self.sent[player.user_id].append((data["lat"], sent_at))
+
+        try:
+            if transport == "socketio":
+                response, status = player.socket.emit("location", data)
+            else:
+                response, status = post(
+                    "/location", data, {"Authorization": f"Bearer {player.token}"}
+                )
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            return
+
+        elapsed = time.perf_counter() - sent_at
+        with self.lock:
+            self.latencies[transport].append(elapsed)
+            self.statuses[(transport, status)] += 1
+
+            # The server may store (and broadcast) a smoothed position,
+            # it is the one in the response. Broadcasts are matched with
+            # the earliest ping carrying their position, so a dropped
+            # ping echoing an older position is never matched first
+            if status == 200 and isinstance(response, dict):
+                stored = round(float(response["latitude"]), 7)
+                if stored != data["lat"]:
+                    self.sent[player.user_id].append((stored, sent_at))
+        if status == 403:
+            player.eliminated = True
+
+    def transport_of(self, index):
+        if self.args.transport == "both":
+            return "socketio" if index % 2 else "http"
+        return self.args.transport
+
+    def setup(self):
+        """
+        Log everybody in, open the sockets, and send a first ping from
+        every mafia before the cops start chasing them (a cop alone
+        in a game wins it straight away).
+        """
+        post = self.server.http_client()
+        for player in self.players:
+            self.login(player, post)
+
+        for index, player in enumerate(self.players):
+            # The cops' sockets watch the broadcasts of their game
+            if player.role == "cop" or self.transport_of(index) == "socketio":
+                player.socket = self.server.connect(
+                    player.token,
+                    self.on_delta if player.role == "cop" else (lambda delta, at: None)
+                )
+                player.socket.emit("join_game", {"game_id": player.game_id, "role": player.role})
+
+        for player in self.players:
+            if player.role == "mafia":
+                post("/location", player.ping(), {"Authorization": f"Bearer {player.token}"})
+
+    def worker(self, players, deadline):
+        post = self.server.http_client()
+        interval = 1.0 / self.args.rate
+        start = time.perf_counter()
+
+        # (next ping time, tie breaker, index into self.players)
+        queue = [
+            (start + random.uniform(0, interval), i, i)
+            for i in players
+        ]
+        heapq.heapify(queue)
+
+        while queue:
+            due, tie, index = heapq.heappop(queue)
+            # Pings still due when time is up (when the server can't
+            # keep up) are dropped, not sent late
+            if due >= deadline or time.perf_counter() >= deadline:
+                break
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+
+            player = self.players[index]
+            if player.eliminated:
+                continue
+            player.step(self.args.step)
+            self.send(player, self.transport_of(index), post)
+            heapq.heappush(queue, (due + interval, tie, index))
+
+    def poller(self, stopped):
+        sockets = [player.socket for player in self.players if player.role == "cop" and player.socket]
+        while not stopped.is_set():
+            for socket in sockets:
+                socket.poll()
+            stopped.wait(0.005)
+
+    def run(self):
+        setup_start = time.perf_counter()
+        self.setup()
+        print(f"Logged in {len(self.players)} players in {time.perf_counter() - setup_start:.1f}s")
+
+        stopped = threading.Event()
+        poller = threading.Thread(target=self.poller, args=(stopped,), daemon=True)
+        poller.start()
+
+        start = time.perf_counter()
+        deadline = start + self.args.duration
+        workers = [
+            threading.Thread(
+                target=self.worker,
+                args=(range(i, len(self.players), self.args.workers), deadline),
+                daemon=True
+            )
+            for i in range(self.args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        # Let the last broadcast tick go out
+        time.sleep(1)
+        stopped.set()
+        poller.join()
+
+        for player in self.players:
+            if player.socket is not None:
+                player.socket.close()
+
+        self.report(elapsed)
+
+    def report(self, elapsed):
+        target = len(self.players) * self.args.rate
+        total = sum(len(latencies) for latencies in self.latencies.values())
+
+        print(f"Duration: {elapsed:.1f}s, target {target:.0f} pings/s, achieved {total / elapsed:.0f} pings/s")
+        print(f"{'transport':>10} {'pings':>8} {'p50 (ms)':>10} {'p90 (ms)':>10} {'p99 (ms)':>10} {'max (ms)':>10}")
+        for transport, latencies in sorted(self.latencies.items()):
+            print(
+                f"{transport:>10} {len(latencies):>8} "
+                f"{percentile(latencies, 0.5) * 1000:>10.2f} "
+                f"{percentile(latencies, 0.9) * 1000:>10.2f} "
+                f"{percentile(latencies, 0.99) * 1000:>10.2f} "
+                f"{max(latencies) * 1000:>10.2f}"
+            )
+
+        statuses = ", ".join(
+            f"{transport} {status}: {count}"
+            for (transport, status), count in sorted(self.statuses.items())
+        )
+        print(f"Statuses: {statuses or 'none'}, errors: {self.errors}")
+
+        delays = self.broadcast_delays
+        print(
+            f"Broadcast delay ({len(delays)} positions): "
+            f"p50 {percentile(delays, 0.5) * 1000:.1f} ms, "
+            f"p99 {percentile(delays, 0.99) * 1000:.1f} ms"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the location path")
+    parser.add_argument("--players", type=int, default=200)
+    parser.add_argument("--games", type=int, default=4)
+    parser.add_argument("--cops-per-game", type=int, default=1)
+    parser.add_argument("--rate", type=float, default=1.0, help="Pings per second per player")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds")
+    parser.add_argument("--transport", choices=("http", "socketio", "both"), default="both")
+    parser.add_argument("--workers", type=int, default=8, help="Sending threads")
+    parser.add_argument("--step", type=float, default=5.0, help="Random walk step, in meters")
+    parser.add_argument("--spread", type=float, default=0.02, help="Start area, in degrees")
+    parser.add_argument("--url", help="Server to test, in-process if omitted")
+    parser.add_argument("--redis-url", help="Redis to use (to seed, with --url), fakeredis if omitted")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if args.url and not args.redis_url:
+        parser.error("--url needs --redis-url to seed the players")
+
+    server = RemoteServer(args.url, args.redis_url) if args.url else InProcessServer(args.redis_url)
+
+    players = create_players(args.players, args.games, args.cops_per_game, args.spread, args.seed)
+    seed_players(players)
+
+    LoadTest(server, players, args).run()
+
+if __name__ == "__main__":
+    main()
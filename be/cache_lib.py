@@ -0,0 +1,347 @@
+import json
+import time
+import uuid
+import threading
+from log_lib import get_logger
+from timer_lib import Ticker
+
+logger = get_logger(__name__)
+
+# Pub/sub channel the servers tell each other about changes on
+UPDATES_CHANNEL = "rooms:updates"
+
+class CachedRoomStore:
+    """
+    Read cache in front of a room store (see room_lib).
+
+    The members (and their roles) and eliminations are read from this
+    process. Writes
+    still go straight to the wrapped store, which settles races with the
+    other servers (only one of them eliminates a player), and
+    are announced to the other servers with 'on_change', whose caches
+    apply them with apply().
+    """
+
+    def __init__(self, store, on_change=None):
+        """
+        Args:
+            store (RedisRoomStore or MemoryRoomStore): The shared store.
+            on_change (callable, optional): Called with (event,
+                player_id, role) after a write: 'joined' (role is the
+                member's role, or None), 'left' or 'eliminated'.
+        """
+        self.store = store
+        self.on_change = on_change
+        self.mutex = threading.Lock()
+        self.member_ids = None
+        self.member_roles = None
+        self.eliminated_ids = None
+
+    def _load(self):
+        # Caller holds self.mutex
+        if self.member_ids is None:
+            self.member_ids = set(self.store.members())
+            self.member_roles = dict(self.store.roles())
+            self.eliminated_ids = set(self.store.eliminated())
+
+    def reload(self):
+        """
+        Read the members and eliminations from the store again, in
+        case an update from another server was lost.
+        """
+        members = set(self.store.members())
+        roles = dict(self.store.roles())
+        eliminated = set(self.store.eliminated())
+        with self.mutex:
+            self.member_ids = members
+            self.member_roles = roles
+            self.eliminated_ids = eliminated
+
+    def _changed(self, event, player_id, role=None):
+        if self.on_change is not None:
+            self.on_change(event, player_id, role)
+
+    def apply(self, event, player_id, role=None):
+        """
+        Apply a change made by another server.
+        """
+        with self.mutex:
+            self._load()
+            if event == "joined":
+                self.member_ids.add(player_id)
+                if role is not None:
+                    self.member_roles[player_id] = role
+            elif event == "left":
+                self.member_ids.discard(player_id)
+                self.member_roles.pop(player_id, None)
+            elif event == "eliminated":
+                self.eliminated_ids.add(player_id)
+
+    def claim(self, field, value):
+        return self.store.claim(field, value)
+
+    def get(self, field):
+        return self.store.get(field)
+
+    def release(self, field, value):
+        self.store.release(field, value)
+
+    def add_member(self, player_id, role=None):
+        with self.mutex:
+            self._load()
+            if player_id in self.member_ids and (role is None or self.member_roles.get(player_id) == role):
+                return
+        self.store.add_member(player_id, role)
+        with self.mutex:
+            self.member_ids.add(player_id)
+            if role is not None:
+                self.member_roles[player_id] = role
+        self._changed("joined", player_id, role)
+
+    def remove_member(self, player_id):
+        self.store.remove_member(player_id)
+        with self.mutex:
+            self._load()
+            self.member_ids.discard(player_id)
+            self.member_roles.pop(player_id, None)
+        self._changed("left", player_id)
+
+    def members(self):
+        with self.mutex:
+            self._load()
+            return set(self.member_ids)
+
+    def roles(self):
+        with self.mutex:
+            self._load()
+            return dict(self.member_roles)
+
+    def role(self, player_id):
+        with self.mutex:
+            self._load()
+            return self.member_roles.get(player_id)
+
+    def eliminate(self, player_id):
+        eliminated = self.store.eliminate(player_id)
+        with self.mutex:
+            self._load()
+            self.eliminated_ids.add(player_id)
+        if eliminated:
+            self._changed("eliminated", player_id)
+        return eliminated
+
+    def is_eliminated(self, player_id):
+        with self.mutex:
+            self._load()
+            return player_id in self.eliminated_ids
+
+    def eliminated(self):
+        with self.mutex:
+            self._load()
+            return set(self.eliminated_ids)
+
+    def lock(self):
+        return self.store.lock()
+
+    def close(self, start_time):
+        self.store.close(start_time)
+        with self.mutex:
+            self.member_ids = None
+            self.member_roles = None
+            self.eliminated_ids = None
+
+class PlayerStateCache:
+    """
+    Makes the rooms of this process the authoritative copy of their
+    players' positions.
+
+    A location ping only updates the room in memory. The positions are
+    written behind to Redis every 'interval' seconds, in one pipeline,
+    and published to the other servers, which apply them to their own
+    copy of the room. Pub/sub does not retry, so every
+    'resync_interval' seconds each room is also reloaded from Redis.
+    """
+
+    def __init__(self, client, rooms, save_locations, load_players, interval=1.0, resync_interval=30.0, channel=UPDATES_CHANNEL):
+        """
+        Args:
+            client (redis.Redis): The Redis client to publish and
+                subscribe with.
+            rooms (RoomRegistry): The rooms hosted by this process.
+            save_locations (callable): Writes a list of (player_id,
+                latitude, longitude, role) tuples to Redis.
+            load_players (callable): Reads a room's players from Redis,
+                as (player_id, role, latitude, longitude) tuples.
+            interval (float): Seconds between two writes to Redis.
+            resync_interval (float): Seconds between two reloads of the
+                rooms from Redis (0 never reloads).
+            channel (str): The pub/sub channel.
+        """
+        self.client = client
+        self.rooms = rooms
+        self.save_locations = save_locations
+        self.load_players = load_players
+        self.interval = interval
+        self.resync_interval = resync_interval
+        self.channel = channel
+        self.node_id = uuid.uuid4().hex
+
+        self.lock = threading.Lock()
+        self.pending = {}          # (game_id, player_id) -> (role, latitude, longitude)
+        self.last_resync = time.monotonic()
+
+        self.ticker = None
+        self.pubsub = None
+        self.subscriber = None
+        self.start_lock = threading.Lock()
+
+    def wrap_store(self, game_id, store):
+        """
+        Put a CachedRoomStore in front of a new room's store.
+        """
+        return CachedRoomStore(
+            store,
+            on_change = lambda event, player_id, role: self.publish(
+                game_id, event, player_id=player_id, role=role
+            )
+        )
+
+    def record(self, room, player_id, role, latitude, longitude):
+        """
+        Take a location ping: update the room in memory, and queue the
+        write to Redis.
+        """
+        room.join(player_id, role)
+        room.update_player(player_id, role, latitude, longitude)
+        room.geo_index.add(player_id, role, latitude, longitude)
+        with self.lock:
+            self.pending[(room.game_id, player_id)] = (role, latitude, longitude)
+
+    def publish(self, game_id, event, **fields):
+        message = {"node": self.node_id, "game_id": game_id, "event": event, **fields}
+        self.client.publish(self.channel, json.dumps(message))
+
+    # ==========================================================
+    # +++ Write-behind +++
+    # ==========================================================
+    def flush(self):
+        """
+        Write the queued positions to Redis and publish them.
+        """
+        with self.lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return
+
+        try:
+            self.save_locations([
+                (player_id, latitude, longitude, role)
+                for (_, player_id), (role, latitude, longitude) in batch.items()
+            ])
+        except Exception:
+            # Keep them for the next flush, unless they moved since
+            with self.lock:
+                for key, value in batch.items():
+                    self.pending.setdefault(key, value)
+            raise
+
+        by_room = {}
+        for (game_id, player_id), state in batch.items():
+            by_room.setdefault(game_id, {})[player_id] = state
+        for game_id, players in by_room.items():
+            self.publish(game_id, "positions", players=players)
+
+    def resync(self, room):
+        """
+        Reload a room from Redis, keeping the positions not written yet.
+        """
+        self.flush()
+        room.store.reload()
+        players = self.load_players(room)
+        with self.lock:
+            pending = {player_id for game_id, player_id in self.pending if game_id == room.game_id}
+        room.refresh([player for player in players if player[0] not in pending])
+
+    def tick(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Could not write the player positions to Redis")
+            return
+
+        now = time.monotonic()
+        if self.resync_interval and now - self.last_resync >= self.resync_interval:
+            self.last_resync = now
+            for room in self.rooms:
+                try:
+                    self.resync(room)
+                except Exception:
+                    logger.exception("Could not reload game %s from Redis", room.game_id)
+
+    # ==========================================================
+    # +++ Updates from the other servers +++
+    # ==========================================================
+    def apply(self, message):
+        """
+        Apply an update published by another server.
+        """
+        if message.get("node") == self.node_id:
+            return
+
+        room = self.rooms.get(message.get("game_id"))
+        if room is None:
+            return
+
+        event = message.get("event")
+        if event == "positions":
+            # A late update must not bring back a player who left or
+            # was eliminated since. The other server broadcasts the
+            # positions it took, this one only learns them
+            members = room.store.members()
+            eliminated = room.store.eliminated()
+            for player_id, (role, latitude, longitude) in message["players"].items():
+                if player_id in members and player_id not in eliminated:
+                    room.update_player(player_id, role, latitude, longitude, broadcast=False)
+                    room.geo_index.add(player_id, role, latitude, longitude)
+        elif event in ("joined", "left", "eliminated"):
+            player_id = message["player_id"]
+            room.store.apply(event, player_id, message.get("role"))
+            if event != "joined":
+                room.drop(player_id)
+
+    def _listen(self):
+        for item in self.pubsub.listen():
+            if item.get("type") != "message":
+                continue
+            try:
+                self.apply(json.loads(item["data"]))
+            except Exception:
+                logger.exception("Could not apply an update from another server")
+
+    def start(self):
+        """
+        Start the write-behind ticks and the subscriber, if not already
+        started.
+        """
+        with self.start_lock:
+            if self.ticker is not None:
+                return
+            self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            self.pubsub.subscribe(self.channel)
+            self.subscriber = threading.Thread(target=self._listen, name="room-updates", daemon=True)
+            self.subscriber.start()
+            self.ticker = Ticker(1.0 / self.interval, self.tick)
+            self.ticker.start()
+
+    def stop(self):
+        """
+        Stop the ticks, write what is left, and unsubscribe.
+        """
+        with self.start_lock:
+            ticker, self.ticker = self.ticker, None
+        if ticker is None:
+            return
+        ticker.stop()
+        self.flush()
+        self.pubsub.unsubscribe()
+        self.pubsub.close()
@@ -0,0 +1,167 @@
+import os
+import math
+
+# NumPy is optional: without it, the batch functions fall back to
+# plain Python loops (same results, just slower)
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Mean earth radius (IUGG), in meters
+EARTH_RADIUS = 6371008.8
+
+# A spherical model is off from the WGS-84 ellipsoid by at most ~0.56%.
+# In 'hybrid' mode, only the points whose spherical distance is within
+# this fraction of the threshold are re-checked with geodesic()
+BOUNDARY_TOLERANCE = 0.006
+
+# Accuracy modes understood by within_distance()
+#   fast      - equirectangular approximation, fine for short ranges
+#   haversine - great-circle distance on a sphere
+#   geodesic  - geopy's ellipsoidal geodesic for every point (slowest)
+#   hybrid    - haversine, falling back to geodesic near the threshold
+MODES = ("fast", "haversine", "geodesic", "hybrid")
+DEFAULT_MODE = os.environ.get("DISTANCE_MODE", "hybrid")
+
+def haversine(lat1, lon1, lat2, lon2, radius=EARTH_RADIUS):
+    """
+    Great-circle distance between two points, in meters.
+
+    Args:
+        lat1 (float): Latitude of the first point.
+        lon1 (float): Longitude of the first point.
+        lat2 (float): Latitude of the second point.
+        lon2 (float): Longitude of the second point.
+        radius (float): Sphere radius in meters.
+
+    Returns:
+        float: The distance in meters.
+    """
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+
+    a = math.sin(d_phi / 2) ** 2 \
+        + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * radius * math.asin(math.sqrt(min(1.0, a)))
+
+def equirectangular(lat1, lon1, lat2, lon2, radius=EARTH_RADIUS):
+    """
+    Equirectangular approximation of the distance between two points,
+    in meters. Accurate to well under a meter over a few kilometers.
+    """
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return radius * math.hypot(x, y)
+
+def geodesic(lat1, lon1, lat2, lon2):
+    """
+    Ellipsoidal (WGS-84) distance between two points, in meters.
+    """
+    from geopy.distance import geodesic as _geodesic
+    return _geodesic((lat1, lon1), (lat2, lon2)).meters
+
+_SCALAR_FUNCTIONS = {
+    "fast": equirectangular,
+    "haversine": haversine,
+    "geodesic": geodesic,
+}
+
+def distance(coord1, coord2, mode="geodesic"):
+    """
+    Distance between two (latitude, longitude) pairs, in meters.
+
+    Args:
+        coord1 (tuple): The first (latitude, longitude).
+        coord2 (tuple): The second (latitude, longitude).
+        mode (str): 'fast', 'haversine' or 'geodesic'.
+
+    Returns:
+        float: The distance in meters.
+    """
+    function = _SCALAR_FUNCTIONS["geodesic" if mode == "hybrid" else mode]
+    return function(float(coord1[0]), float(coord1[1]), float(coord2[0]), float(coord2[1]))
+
+def batch_distances(origin, points, mode="haversine"):
+    """
+    Distances from one origin to many points, in meters.
+
+    Args:
+        origin (tuple): The (latitude, longitude) of the origin.
+        points (sequence): (latitude, longitude) pairs, or an Nx2 array.
+        mode (str): 'fast', 'haversine' or 'geodesic'.
+
+    Returns:
+        numpy.ndarray or list: One distance per point.
+    """
+    lat0 = float(origin[0])
+    lon0 = float(origin[1])
+
+    if mode == "geodesic" or np is None:
+        function = _SCALAR_FUNCTIONS[mode]
+        return [function(lat0, lon0, float(lat), float(lon)) for lat, lon in points]
+
+    coords = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    lat = np.radians(coords[:, 0])
+    lon = np.radians(coords[:, 1])
+    phi0 = math.radians(lat0)
+    lambda0 = math.radians(lon0)
+
+    if mode == "fast":
+        x = (lon - lambda0) * np.cos((lat + phi0) / 2)
+        y = lat - phi0
+        return EARTH_RADIUS * np.hypot(x, y)
+
+    a = np.sin((lat - phi0) / 2) ** 2 \
+        + math.cos(phi0) * np.cos(lat) * np.sin((lon - lambda0) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(1.0, a)))
+
+def within_distance(origin, points, threshold, mode=None):
+    """
+    Find which points are within a threshold distance of the origin.
+
+    Args:
+        origin (tuple): The (latitude, longitude) of the origin.
+        points (sequence): (latitude, longitude) pairs, or an Nx2 array.
+        threshold (float): The distance in meters.
+        mode (str, optional): One of MODES, DEFAULT_MODE if None.
+
+    Returns:
+        list: Indexes (into points) of the points within threshold.
+    """
+    mode = mode or DEFAULT_MODE
+    if mode not in MODES:
+        raise ValueError(f"Unknown distance mode '{mode}'")
+
+    if len(points) == 0:
+        return []
+
+    if mode != "hybrid":
+        distances = batch_distances(origin, points, mode)
+        return _indexes(distances, lambda d: d <= threshold)
+
+    distances = batch_distances(origin, points, "haversine")
+    margin = threshold * BOUNDARY_TOLERANCE
+
+    matches = _indexes(distances, lambda d: d <= threshold - margin)
+    boundary = _indexes(distances, lambda d: (d > threshold - margin) & (d <= threshold + margin))
+
+    # Too close to call on a sphere, ask the ellipsoid
+    for i in boundary:
+        lat, lon = points[i]
+        if geodesic(float(origin[0]), float(origin[1]), float(lat), float(lon)) <= threshold:
+            matches.append(i)
+
+    matches.sort()
+    return matches
+
+def _indexes(distances, condition):
+    """
+    Indexes of the distances matching a condition, vectorized when the
+    distances are a NumPy array.
+    """
+    if np is not None and isinstance(distances, np.ndarray):
+        return np.flatnonzero(condition(distances)).tolist()
+    return [i for i, d in enumerate(distances) if condition(d)]
@@ -1,15 +1,36 @@
 import os
-import jwt
+import sys
+import math
 from http import HTTPStatus
-from flask_bcrypt import Bcrypt
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, session, stream_with_context
 from flask_cors import CORS, cross_origin
-from flask_socketio import SocketIO, emit
-from datetime import datetime, timedelta, timezone
-import time
+from flask_socketio import SocketIO, emit, join_room
+from socketio import PubSubManager
+from datetime import datetime, timezone
+from functools import wraps
+import hmac
+import json
 import threading
-from geopy.distance import geodesic
+import click
+from itertools import islice
 from redis_lib import *
+import redis_lib
+from log_lib import get_logger, get_sampled_logger, configure_logging, PRODUCTION
+from auth_lib import PasswordVerifier, TokenVerifier, InvalidToken, is_password_hash
+from geo_lib import create_geo_index, GridGeoIndex
+from cache_lib import PlayerStateCache
+from journal_lib import EventJournal
+from ingest_lib import PingFilter, ACCEPTED
+from wire_lib import encode_players, decode_location, JSON, PACKED, ENCODINGS, PACKED_CONTENT_TYPE
+from room_lib import GameRoom, RoomRegistry, MemoryRoomStore, RedisRoomStore
+from room_lib import DEFAULT_GAME_ID, DEFAULT_GAME_DURATION, DEFAULT_DELTA_HISTORY, channel_name
+from timer_lib import GameClockScheduler, Ticker
+import distance_lib
+from metrics_lib import Counter, Gauge, Histogram, timed, REGISTRY, CONTENT_TYPE
+import metrics_lib
+
+logger = get_logger(__name__)
+ping_logger = get_sampled_logger(__name__)
 
 # Initialize the Flask application
 app = Flask(__name__)
@@ -17,35 +38,151 @@ app = Flask(__name__)
 # Allow Cross Origin Resource Sharing with default settings
 CORS(app)
 
-# Initialize SocketIO for broadcasting service
-socketio = SocketIO(app, cors_allowed_origins="*")
-
-# To use Bcrypt APIs, wrap the Flask app in Bcrypt()
-bcrypt = Bcrypt(app)
+# SocketIO for broadcasting service, attached to the
+# application by create_app()
+socketio = SocketIO()
 
 # This variable will store the application settings and
 # made available globally (used by app_settings() method)
 g = dict()
 
-# List to track the broadcast receipents
-broadcast_recipients = dict()
-
-# Define player roles
-# There will be only 1 cop
-# Everybody else is considered as mafia
-roles = {"cop": None, "mafia": []}
-
-mafia_players = []
+# Set game duration for 5 minutes
+game_duration = DEFAULT_GAME_DURATION
+
+# Seconds a game stays open once it is over (for the late pings and
+# the clients reading the outcome), before its room is closed and the
+# game id can host a new game
+room_close_delay = float(os.environ.get("ROOM_CLOSE_DELAY", 60))
+
+# Broadcast ticks each room remembers, so that a client reconnecting
+# within DELTA_HISTORY / TICK_RATE seconds only gets what it missed
+delta_history = int(os.environ.get("DELTA_HISTORY", DEFAULT_DELTA_HISTORY))
+
+# Where the shared state of the games (members, eliminations, cop,
+# outcome) lives: 'redis' (the default) lets several servers host
+# the same games, 'memory' keeps it in this process
+room_state_backend = os.environ.get("ROOM_STATE_BACKEND", "redis")
+
+# The player cache (see cache_lib) and the game journal (see
+# journal_lib), built by create_app() unless turned off
+player_cache = None
+journal = None
+
+def journal_event(game_id, event, **fields):
+    if journal is not None:
+        journal.record(game_id, event, **fields)
+
+# Build the room of a new game, with its own geospatial index
+# holding the player positions used for the elimination checks
+def create_room(game_id):
+    if room_state_backend == "memory":
+        store = MemoryRoomStore()
+    else:
+        # Keep the game's keys for an hour after the game ends
+        store = RedisRoomStore(redis_lib.client, game_id, ttl = game_duration + 3600)
+
+    # The cached positions are searched in memory (in a spatial
+    # hash, see geo_lib), the Redis geospatial index would lag
+    # behind the writes
+    if player_cache is not None:
+        return GameRoom(
+            game_id, 
+            GridGeoIndex(), 
+            player_cache.wrap_store(game_id, store), 
+            duration = game_duration, 
+            history = delta_history
+        )
 
-# Did cop win?
-game_outcome = False
+    return GameRoom(
+        game_id, 
+        create_geo_index(redis_lib.client, f"geo:{game_id}:players"), 
+        store, 
+        duration = game_duration, 
+        history = delta_history
+    )
 
-# Set game timer and duration for 10 minutes
-game_start_time = time.time()
-game_duration = 5 * 60
+# One scheduler holds the game clocks of every room
+game_clocks = GameClockScheduler()
+
+# Batches the position broadcasts of every room, 
+# created with the first room (see start_broadcasts)
+position_ticker = None
+position_ticker_lock = threading.Lock()
+
+def start_broadcasts():
+    global position_ticker
+    with position_ticker_lock:
+        if position_ticker is None:
+            position_ticker = Ticker(read_app_settings('tick_rate'), broadcast_tick)
+    position_ticker.start()
+
+# Start the game clock of every new room, and the
+# broadcast ticks with the first one
+# (The game may have been started by another server)
+def open_room(room):
+    game_clocks.start_clock(room.game_id, room.time_left(), lambda: game_over(room))
+    start_broadcasts()
+    if journal is not None:
+        journal.start()
+        journal.open(room.game_id, room.start_time)
+
+    # Load the players the other servers already know about
+    if player_cache is not None:
+        player_cache.start()
+        room.refresh(room_players(room))
+        for player_id, player in room.recipients().items():
+            room.geo_index.add(player_id, player['role'], player['latitude'], player['longitude'])
+
+# Every game hosted by this server, keyed by game id
+rooms = RoomRegistry(create_room, on_create=open_room)
+
+# Close the room of a game that is over, room_close_delay seconds
+# from now. The game's clock is replaced by this one
+def close_room_later(room):
+    game_clocks.start_clock(room.game_id, room_close_delay, lambda: close_room(room))
+
+def close_room(room):
+    # A newer room may host the game id already
+    if rooms.remove(room.game_id, room) is None:
+        return
+    game_clocks.cancel(room.game_id)
+    room.close()
+    if journal is not None:
+        journal.close(room.game_id)
+    logger.info("Game %s closed", room.game_id)
 
-# Lock for thread safety
-lock = threading.Lock()
+# ==========================================================
+# +++ Metrics +++
+# Exposed by the '/metrics' endpoint. Each process (e.g.
+# each Gunicorn worker) counts for itself
+# ==========================================================
+LOCATION_LATENCY = Histogram(
+    "location_update_seconds", 
+    "End-to-end time of a location update, in seconds", 
+    ("transport",)
+)
+DISTANCE_LATENCY = Histogram(
+    "distance_check_seconds", 
+    "Time spent finding the opponents within elimination distance of a moving player, in seconds"
+)
+EMIT_LATENCY = Histogram(
+    "socketio_emit_seconds", 
+    "Time spent fanning a Socket.IO event out to a room, in seconds", 
+    ("event",)
+)
+ELIMINATIONS = Counter("eliminations_total", "Mafia players eliminated")
+PINGS_DROPPED = Counter(
+    "pings_dropped_total", 
+    "Location pings dropped by the ingestion filter", 
+    ("reason",)
+)
+CONNECTED_SOCKETS = Gauge("connected_sockets", "Open Socket.IO connections")
+
+ACTIVE_PLAYERS = Gauge("active_players", "Players in the active-players index")
+ACTIVE_PLAYERS.set_function(count_active_users)
+
+ROOMS = Gauge("rooms", "Game rooms hosted by this process")
+ROOMS.set_function(lambda: len(rooms))
 
 # ==========================================================
 # +++ Application settings +++
@@ -54,45 +191,17 @@ lock = threading.Lock()
 # Be mindful of what you change here ...
 # ==========================================================
 
+# Users created by 'flask seed'
+# (user_id, username, password, status, latitude, longitude, role)
+SEED_USERS = [
+    (1001, "Elon Musk", "Tesla", "inactive", "37.7749", "-79.5555", "cop"),
+    (1002, "Jeff Bezos", "BlueHorizon", "inactive", "37.7749", "-79.5555", "mafia"),
+    (1003, "Bill Gates", "Clippy", "inactive", "35.89", "-54.4194", "mafia"),
+]
+
 def app_settings():
     global g
 
-    # User data
-    user_id = 1001
-    username = "Elon Musk"
-    password = "Tesla"
-    status = "inactive"
-    latitude = "37.7749"
-    longitude = "-79.5555"
-    role = "cop"
-
-    # Store user location
-    store_user_location(user_id, username, password, status, latitude ,longitude, role)
-    
-    # User data
-    user_id = 1002
-    username = "Jeff Bezos"
-    password = "BlueHorizon"
-    status = "inactive"
-    latitude = "37.7749"
-    longitude = "-79.5555"
-    role = "mafia"
-
-    # Store user location
-    store_user_location(user_id, username, password, status, latitude ,longitude, role)
-
-    # User data
-    user_id = 1003
-    username = "Bill Gates"
-    password = "Clippy"
-    status = "inactive"
-    latitude = "35.89"
-    longitude = "-54.4194"
-    role = "mafia"
-
-    # Store user location
-    store_user_location(user_id, username, password, status, latitude ,longitude, role)
-
     # This key will be used when encoding and decoding the 
     # access tokens
     if 'secret_key' not in g:
@@ -102,18 +211,47 @@ def app_settings():
     # Higher values for bcrypt_log_rounds mean more secure hashes
     # but slower performance
     if 'bcrypt_log_rounds' not in g:
-        g['bcrypt_log_rounds'] = os.environ.get("BCRYPT_LOG_ROUNDS", 12)
+        g['bcrypt_log_rounds'] = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))
+
+    # Passwords are checked with bcrypt on a pool of BCRYPT_WORKERS
+    # threads, and a successful check is remembered for
+    # CREDENTIAL_CACHE_TTL seconds so repeated logins skip bcrypt
+    if 'password_verifier' not in g:
+        g['password_verifier'] = PasswordVerifier(
+            workers = int(os.environ.get("BCRYPT_WORKERS", os.cpu_count() or 1)), 
+            log_rounds = g['bcrypt_log_rounds'], 
+            cache_ttl = float(os.environ.get("CREDENTIAL_CACHE_TTL", 60))
+        )
 
     # Define how long an access token remains valid
-    # By default, set to 900 seconds (which is 15 minutes)
+    # By default, set to 0, which makes it a session token
+    # that does not expire
     if 'access_token_expiration' not in g:
-        g['access_token_expiration'] = os.environ.get("ACCESS_TOKEN_EXPIRATION", 0)
+        g['access_token_expiration'] = int(os.environ.get("ACCESS_TOKEN_EXPIRATION", 0))
     
     # Similar to access_token_expiration, but for refresh tokens
     # Refresh tokens typically have a longer lifespan than access tokens
     # By default, set to 2,592,000 seconds (which is 30 days)
     if 'refresh_token_expiration' not in g:
-        g['refresh_token_expiration'] = os.environ.get("REFRESH_TOKEN_EXPIRATION", 2592000)
+        g['refresh_token_expiration'] = int(os.environ.get("REFRESH_TOKEN_EXPIRATION", 2592000))
+
+    # Issues and checks the tokens. Checked tokens are cached for
+    # TOKEN_CACHE_TTL seconds (at most until they expire)
+    if 'token_verifier' not in g:
+        g['token_verifier'] = TokenVerifier(
+            g['secret_key'], 
+            cache_ttl = float(os.environ.get("TOKEN_CACHE_TTL", 300))
+        )
+
+    # Location updates must come with the player's access token.
+    # Set REQUIRE_AUTH=0 to accept them without (for testing only)
+    if 'require_auth' not in g:
+        g['require_auth'] = os.environ.get("REQUIRE_AUTH", "1") == "1"
+
+    # Bearer token of the admin endpoints (game replays and player
+    # administration). Without ADMIN_TOKEN they are turned off
+    if 'admin_token' not in g:
+        g['admin_token'] = os.environ.get("ADMIN_TOKEN") or None
 
     # +++ DEBUG BLOCK: For debugging purposes only (REMOVE BEFORE DEPLOYING)
     
@@ -121,20 +259,14 @@ def app_settings():
     if 'users' not in g:
         users = os.environ.get("USERS", 'Elon Musk,Bill Gates,Jeff Bezos')
         g['users'] = list(users.split(','))
-        print("g['users'] = ", g['users'])
+        logger.debug("Seeded users: %s", g['users'])
     
-    # Create their passwords and hash them using Bcrypt API
+    # Create their passwords
+    # (They are stored in plaintext and replaced by their bcrypt 
+    # hash on the first login, never hashed on startup)
     if 'passwords' not in g:
         passwords = os.environ.get("PASSWORDS", 'Tesla,Clippy,BlueHorizon')
         g['passwords'] = list(passwords.split(','))
-        print("g['passwords'] = ", g['passwords'])
-
-        g['password_hashes'] = []
-        for p in g['passwords']:
-            g['password_hashes'].append(
-                bcrypt.generate_password_hash(p, g['bcrypt_log_rounds']).decode('utf-8')
-            )
-        print("g['password_hashes]=", g['password_hashes'])
 
         # Assign these users their user_id
         g['user_ids'] = list(range(0, len(g['users'])))
@@ -148,6 +280,31 @@ def app_settings():
     # How closeby the cop must be to the mafia to arrest them
     # In meters
     g['elimination_distance'] = 100
+
+    # How often (in seconds) a mafia player's position is sent to
+    # the other mafia players. The cop always gets every update
+    g['mafia_peer_update_interval'] = float(os.environ.get("MAFIA_PEER_UPDATE_INTERVAL", 10))
+
+    # Position broadcasts per second. Every tick sends one message
+    # per room and role with the players that moved since the last one
+    g['tick_rate'] = float(os.environ.get("TICK_RATE", 5))
+
+    # Moves shorter than this (in meters) are not broadcast
+    g['position_epsilon'] = float(os.environ.get("POSITION_EPSILON", 1))
+
+    # Ingestion of the location pings (see ingest_lib): each player
+    # is rate-limited, the GPS jitter smoothed, and the moves too
+    # small to matter dropped. PING_FILTER=0 takes every ping as is
+    if 'ping_filter' not in g:
+        g['ping_filter'] = None
+        if os.environ.get("PING_FILTER", "1") == "1":
+            g['ping_filter'] = PingFilter(
+                min_interval = float(os.environ.get("PING_MIN_INTERVAL", 0.5)), 
+                min_move = float(os.environ.get("PING_MIN_MOVE", 2)), 
+                alpha = float(os.environ.get("PING_SMOOTHING", 0.5)), 
+                beta = float(os.environ.get("PING_VELOCITY_GAIN", 0.1)), 
+                snap_distance = float(os.environ.get("PING_SNAP_DISTANCE", 30))
+            )
         
     # +++ DEBUG BLOCK: For debugging purposes only (REMOVE BEFORE DEPLOYING)
 
@@ -188,39 +345,22 @@ def encode_token(user_id, token_type):
     else:
         expiration_time = read_app_settings("refresh_token_expiration")
 
-    # Define the contents of the token
-    expiration_time = datetime.utcnow() + timedelta(seconds = expiration_time)
-    issued_at =  datetime.utcnow()
-
-    payload = {
-        "expiration_time": expiration_time.timestamp(),
-        "issued_at": issued_at.timestamp(),
-        "subject": user_id,
-    }
-
     # Encode the payload, create the token, and return it
     # For encoding, use the HMAC-SHA256 hashing algorithm
-    return jwt.encode(
-        payload, 
-        read_app_settings("secret_key"), 
-        algorithm = "HS256"
-    )
+    return read_app_settings("token_verifier").encode(user_id, token_type, expiration_time)
 
-def decode_token(token):
-    
-    # Decode the token (YES, it is 'algorithms' not 'algorithm')
-    encoded_payload = jwt.decode(
-        token, 
-        read_app_settings("secret_key"), 
-        algorithms = ["HS256"]
-    )
+def decode_token(token, token_type="access"):
+
+    # Decode (and check) the token, the claims of tokens seen 
+    # before come from the verifier's cache
+    encoded_payload = read_app_settings("token_verifier").verify(token, token_type)
 
     # If access_token_expiration is 0, convert the cookie to a session cookie
     expiration_time = 0
 
     # Convert expiration_time to UTC string to help setting cookies in
     # Javascript without any further convertion
-    if read_app_settings('access_token_expiration'):
+    if encoded_payload['expiration_time']:
         expiration_time = datetime\
                             .fromtimestamp(encoded_payload['expiration_time'], timezone.utc)\
                             .strftime('%a, %d %b %Y %H:%M:%S UTC')
@@ -238,6 +378,88 @@ def decode_token(token):
 
     return decoded_payload
 
+# ==========================================================
+# +++ Authentication middleware +++
+# Every location update (and logout) must carry a valid
+# access token issued to the player it is for:
+# - over HTTP, in the 'Authorization: Bearer <token>' header
+# - over Socket.IO, once, when the socket connects
+# ==========================================================
+def token_subject(token):
+    """
+    Return the player id an access token was issued to, or None if
+    the token is missing or invalid.
+    """
+    if not token:
+        return None
+    try:
+        return str(read_app_settings("token_verifier").verify(token)['subject'])
+    except InvalidToken as e:
+        logger.info("Rejected access token: %s", e)
+        return None
+
+def bearer_token():
+    header = request.headers.get("Authorization", "")
+    if header.startswith("Bearer "):
+        return header[len("Bearer "):]
+    return None
+
+def token_required(view):
+    """
+    Decorator for the HTTP endpoints acting for the player in the
+    request's 'id' field.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not read_app_settings('require_auth'):
+            return view(*args, **kwargs)
+
+        subject = token_subject(bearer_token())
+        if subject is None:
+            return jsonify((
+                "ERROR: Missing or invalid access token", 
+                HTTPStatus.UNAUTHORIZED
+            ))
+        try:
+            data, _ = read_location_request()
+        except ValueError as e:
+            return jsonify((f"ERROR: Malformed location: {e}", HTTPStatus.BAD_REQUEST))
+        if data is None or str(data.get('id')) != subject:
+            return jsonify((
+                "ERROR: The access token was issued to another player", 
+                HTTPStatus.FORBIDDEN
+            ))
+        return view(*args, **kwargs)
+    return wrapper
+
+def admin_required(view):
+    """
+    Decorator for the admin endpoints, which take the ADMIN_TOKEN
+    in the 'Authorization: Bearer <token>' header.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        admin_token = read_app_settings('admin_token')
+        if admin_token is None:
+            return jsonify(("ERROR: The admin endpoints are disabled", HTTPStatus.FORBIDDEN))
+
+        token = bearer_token() or ""
+        if not hmac.compare_digest(token.encode(), admin_token.encode()):
+            return jsonify(("ERROR: Missing or invalid admin token", HTTPStatus.UNAUTHORIZED))
+        return view(*args, **kwargs)
+    return wrapper
+
+# ==========================================================
+# +++ Metrics Endpoint +++
+# Prometheus scrape target (METRICS_ENABLED=0 turns
+# the metrics off)
+# ==========================================================
+@app.route("/metrics")
+def metrics():
+    if not metrics_lib.ENABLED:
+        return jsonify(("Metrics are disabled", HTTPStatus.NOT_FOUND))
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
 # ==========================================================
 # +++ Player Login Endpoint +++
 # Sets the access tokens for the authenticated 
@@ -250,6 +472,7 @@ def login():
         user_name = request.json['name']
         password = request.json['password']
         role = request.json['role']
+        game_id = str(request.json.get('game_id', DEFAULT_GAME_ID))
 
         # +++ DEBUG BLOCK: For debugging purposes only (REMOVE BEFORE DEPLOYING)
         
@@ -258,14 +481,12 @@ def login():
         # available_users = read_app_settings('users')
 
         #getting user credentials using redis
-        print("getting user details... ")
         user = get_user_credentials(user_name)
-        print("outside if: ", user)
 
         if user[1] == "":
 
             # +++ DEBUG BLOCK: For debugging purposes only (REMOVE BEFORE DEPLOYING)
-            print('Unknown user trying to login ...')
+            logger.info("Unknown user '%s' trying to login", user_name)
 
             server_response = (
                 "Error! This user does not have an account", 
@@ -273,16 +494,19 @@ def login():
             )
         else:
 
-            # Get the user's hashed password from app_settings()
+            # Get the user's hashed password from redis
             password_hash = user[2]
-            print("within else condition",user[2])
-            # password_hash = read_app_settings('password_hashes')[available_users.index(user)]
 
             # Hash the user provided password and compare it with
-            # password_hash
-            # if not bcrypt.check_password_hash(password_hash, password):
-            if password != password_hash:
-                print("within else-if condition ",user[2])
+            # password_hash (on the bcrypt worker pool). Plaintext
+            # passwords left from the seed data get hashed on the way
+            verifier = read_app_settings('password_verifier')
+            if not verifier.verify(
+                user_name, 
+                password, 
+                password_hash, 
+                upgrade = lambda new_hash: set_user_password(user[0], new_hash)
+            ):
 
                 # Wrong password
                 server_response = (
@@ -295,33 +519,32 @@ def login():
                 user_id = user[0]
                 
                 access_token = encode_token(user_id, "access")
-                print("else: access token ", access_token)
                 refresh_token = encode_token(user_id, "refresh")
                 expiration_time = decode_token(access_token)['expiration_time']
                 g['logged_userId'] = user_id
+                logger.info("Player %s logged in as %s (game %s)", user_id, role, game_id)
                 
-                user_data = fetch_user_data(user_id)
-                print(user_data)
-                user_data[2] = "active"
-                user_data[-1] = role
-
-                update_user(user_id, user_data)
+                # Mark the player active (and add them to the
+                # active-players index) without rewriting the record
+                set_user_status(user_id, "active", role)
+                rooms.get_or_create(game_id).join(user_id, role)
+                journal_event(game_id, "joined", player_id=str(user_id), role=role)
                 
                 # Prepare the tokens for serialization
                 server_response = ({
                     "userId": user_id,
                     "role": role,
+                    "game_id": game_id,
                     "access_token": access_token,
                     "refresh_token": refresh_token,
                     "expiration_time": expiration_time
                 }, HTTPStatus.OK)
 
         return jsonify(server_response)
-    except Exception as e:
+    except Exception:
 
         # +++ DEBUG BLOCK: For debugging purposes only (REMOVE BEFORE DEPLOYING)
-        print("Something went wrong in '/login' method")
-        print(e)
+        logger.exception("Something went wrong in '/login' method")
         return jsonify((
             "Something went wrong in '/login' method", 
             HTTPStatus.INTERNAL_SERVER_ERROR
@@ -329,17 +552,45 @@ def login():
 
 
 # ==========================================================
-# +++ Assign roles to players (if not already assigned) +++
+# +++ Player Logout Endpoint +++
+# Removes the player from the active players
 # ==========================================================
-def assign_role(player_id):
-    with lock:
-        if roles["cop"] is None:
-            roles["cop"] = player_id
-            role = "cop"
+@app.route("/logout", methods=["POST"])
+@cross_origin()
+@token_required
+def logout():
+    try:
+        user_id = request.json['id']
+
+        if set_user_status(user_id, "inactive"):
+            for room in rooms:
+                if str(user_id) in room.members:
+                    journal_event(room.game_id, "left", player_id=str(user_id))
+                    room.leave(str(user_id))
+            forget_pings(str(user_id))
+            server_response = ("Logged out", HTTPStatus.OK)
         else:
-            roles["mafia"].append(player_id)
-            role = "mafia"
-    return role
+            server_response = (
+                "Error! This user does not have an account", 
+                HTTPStatus.UNAUTHORIZED
+            )
+
+        return jsonify(server_response)
+    except Exception:
+
+        # +++ DEBUG BLOCK: For debugging purposes only (REMOVE BEFORE DEPLOYING)
+        logger.exception("Something went wrong in '/logout' method")
+        return jsonify((
+            "Something went wrong in '/logout' method", 
+            HTTPStatus.INTERNAL_SERVER_ERROR
+        ))
+
+
+# ==========================================================
+# +++ Assign roles to players (if not already assigned) +++
+# ==========================================================
+def assign_role(player_id, game_id=DEFAULT_GAME_ID):
+    return rooms.get_or_create(game_id).assign_role(player_id)
 
 
 # ==========================================================
@@ -347,126 +598,338 @@ def assign_role(player_id):
 # Distances are calculated in meters
 # ==========================================================
 def distance(coord1, coord2):
-    return geodesic(coord1, coord2).meters
+    return distance_lib.distance(coord1, coord2)
+
+# ==========================================================
+# +++ Players of a room +++
+# Read this game's active players from redis, as
+# (player_id, role, latitude, longitude) tuples
+# ==========================================================
+def room_players(room):
+    players = []
+    for item in get_users(room.members):
+        for user_id, details in item.items():
+            players.append((
+                user_id, 
+                details[-1],    # The last element in the list is the role
+                details[-3],    # The third last element is the latitude
+                details[-2]     # The second last element is the longitude
+            ))
+    return players
+
+# Bring a room up to date with what the other servers wrote
+def catch_up(room):
+    if player_cache is not None:
+        player_cache.resync(room)
+    else:
+        room.refresh(room_players(room))
 
 # ==========================================================
 # +++ Overall game timer +++
 # When the timer runs out, and there's no mafia left,
 # then the cop wins. Else the cop loses.
+# Called by game_clocks when the room's clock runs out,
+# the room is closed a little later either way
 # ==========================================================
-def game_timer():
-    while True:
-        time_elapsed = time.time() - game_start_time
-        if time_elapsed >= game_duration:
-            with lock:
-                if mafia_players:
-                    socketio.emit('game_over', {'result': 'cop_loses'})
-            break
-        time.sleep(1)
+def game_over(room):
+
+    # The players may have pinged other servers, catch up first
+    catch_up(room)
+
+    with room.game_lock():
+        if room.mafia_players() and room.finish("cop_loses"):
+            logger.info("Game %s over: time is up, cop loses", room.game_id)
+            journal_event(room.game_id, "game_over", result="cop_loses")
+            with EMIT_LATENCY.labels("game_over").time():
+                socketio.emit(
+                    'game_over', 
+                    {'result': 'cop_loses', 'game_id': room.game_id}, 
+                    to = channel_name(room.game_id)
+                )
+
+    close_room_later(room)
 
 # ==========================================================
-# +++ Location Endpoint +++
-# To get location co-ordinates (along with
-# other data) from players
+# +++ Broadcast tick +++
+# Runs tick_rate times per second and sends each room
+# one 'positions_delta' message per role, with only
+# the players that moved since the previous tick, and
+# the room's version (see join_game)
+# Each server only sends the moves it took the pings
+# of, the message queue takes them to every client
 # ==========================================================
+def broadcast_tick():
+    epsilon = read_app_settings('position_epsilon')
+    peer_interval = read_app_settings('mafia_peer_update_interval')
+
+    # One room failing must not hold back the others
+    for room in rooms:
+        try:
+            broadcast_room(room, epsilon, peer_interval)
+        except Exception:
+            logger.exception("Could not broadcast the positions of game %s", room.game_id)
+
+def broadcast_room(room, epsilon, peer_interval):
+
+    # Only check the outcome this server already knows about,
+    # ticks must not wait on Redis
+    if room.cached_outcome is not None:
+        return
+
+    deltas = room.role_deltas(epsilon, peer_interval)
+    version = room.version
+
+    for role, delta in deltas.items():
+        if delta:
+            with EMIT_LATENCY.labels("positions_delta").time():
+                socketio.emit(
+                    'positions_delta', 
+                    (delta, version), 
+                    to = channel_name(room.game_id, role)
+                )
 
-@app.route("/location", methods = ["POST"])
-@cross_origin()
-def get_player_location():
-    global game_outcome
+                # Same delta for the clients using the packed encoding,
+                # only packed if one of them is listening
+                packed_channel = channel_name(room.game_id, role, PACKED)
+                if has_listeners(packed_channel):
+                    socketio.emit(
+                        'positions_delta', 
+                        (encode_players(delta), version), 
+                        to = packed_channel
+                    )
 
-    try:
-        
-        # Try getting the player details from the query parameters
-        player_id = request.json['id']
-        player_latitude = request.json['lat']
-        player_longitude = request.json['lon']
-        player_role = request.json['role']
+# True if a Socket.IO room may have sockets in it. Through a
+# message queue, the sockets of the other servers are unknown
+def has_listeners(channel):
+    manager = socketio.server.manager
+    if isinstance(manager, PubSubManager):
+        return True
+    return bool(manager.rooms.get("/", {}).get(channel))
 
-        # +++ DEBUG BLOCK: For debugging purposes only (REMOVE BEFORE DEPLOYING)
-        
-        print("Player ID is ", player_id)
-        print("Player Role is ", player_role)
-        print("Player Latitude is ", player_latitude)
-        print("Player Longitude is ", player_longitude)
-        
-        # +++ DEBUG BLOCK: For debugging purposes only (REMOVE BEFORE DEPLOYING)
+# ==========================================================
+# +++ Ping ingestion helpers +++
+# ==========================================================
+
+# True if a raw ping is close enough to an opponent that 
+# filtering it could change an elimination
+def near_elimination(room, role, latitude, longitude):
+    opponent = "mafia" if role == "cop" else "cop"
+    radius = read_app_settings('elimination_distance') + read_app_settings('ping_filter').max_error
+    return bool(room.geo_index.search(opponent, latitude, longitude, radius))
+
+def forget_pings(player_id):
+    ping_filter = read_app_settings('ping_filter')
+    if ping_filter is not None:
+        ping_filter.forget(player_id)
 
-        #debug
-        print("before update location: ", player_id, player_latitude, player_longitude, player_role)
-        #update the user's current location
-        update_location(player_id, player_latitude, player_longitude, player_role)
-         
-        print("[DONE]update location")
+# ==========================================================
+# +++ Proximity checks +++
+# Every move (a cop's or a mafia's) is checked against
+# the opponents around the player only, with one radius
+# query on the room's geospatial index
+# ==========================================================
 
-        #Code to get data of all active users from redis
-        active_users = get_active_users()
+# The (cop, mafia) pairs within elimination distance, after
+# a player moved: a cop catches every mafia around, a mafia
+# is caught by the nearest cop
+def find_catches(room, player_id, role, latitude, longitude, players):
+    if role not in ("cop", "mafia"):
+        return []
+    opponent = "mafia" if role == "cop" else "cop"
+
+    # The index works on a sphere, so search slightly wider
+    # and let distance_lib settle the ones near the edge
+    elimination_distance = read_app_settings('elimination_distance')
+    candidates = [
+        _player for _player, _ in room.geo_index.search(
+            opponent, 
+            latitude, 
+            longitude, 
+            elimination_distance * (1 + distance_lib.BOUNDARY_TOLERANCE)
+        )
+        if _player in players and players[_player]['role'] == opponent
+    ]
+    candidate_locations = [
+        (players[_player]['latitude'], players[_player]['longitude']) 
+        for _player in candidates
+    ]
+    nearby = [
+        candidates[i] for i in distance_lib.within_distance(
+            (latitude, longitude), 
+            candidate_locations, 
+            elimination_distance
+        )
+    ]
 
-        # Create a dictionary with player details to send back as a response
-        for item in active_users:
-            for user_id, details in item.items():
-                broadcast_recipients[user_id] = {
-                    'role': details[-1],       # The last element in the list is the role
-                    'latitude': details[-3],   # The third last element is the latitude
-                    'longitude': details[-2]   # The second last element is the longitude
-                }
+    if role == "cop":
+        return [(player_id, _player) for _player in nearby]
 
-        with lock:
-            if player_role == "cop":
+    # Candidates come nearest first
+    return [(nearby[0], player_id)] if nearby else []
 
-                # +++ DEBUG BLOCK: For debugging purposes only (REMOVE BEFORE DEPLOYING)
+# ==========================================================
+# +++ Location handling +++
+# Shared by the HTTP endpoint and the Socket.IO 
+# 'location' event
+# Returns the (response, HTTP status) pair
+# ==========================================================
+def process_location(data):
+    try:
+        
+        # Try getting the player details from the request data
+        player_id = str(data['id'])
+        player_latitude = float(data['lat'])
+        player_longitude = float(data['lon'])
+        player_role = data.get('role')
+        game_id = str(data.get('game_id', DEFAULT_GAME_ID))
+
+        # NaN, infinite or out of range coordinates would poison the
+        # distance checks and can't be packed (see wire_lib)
+        if not (
+            math.isfinite(player_latitude) and math.isfinite(player_longitude) 
+            and -90 <= player_latitude <= 90 and -180 <= player_longitude <= 180
+        ):
+            return (
+                "ERROR: Latitude must be within [-90, 90] and longitude within [-180, 180]", 
+                HTTPStatus.BAD_REQUEST
+            )
 
-                print("Role cop is played by: ", player_id)
+        room = rooms.get_or_create(game_id)
+
+        # The role is the one the player joined the game with (see
+        # '/login'), a ping can't change it: a mafia claiming to be the
+        # cop would eliminate the other mafia. The ping's role is only
+        # taken from players outside the game when REQUIRE_AUTH=0
+        member_role = room.role_of(player_id)
+        if member_role is None and not read_app_settings('require_auth'):
+            member_role = player_role
+        if member_role is None:
+            return (
+                "ERROR: Player has not joined this game", 
+                HTTPStatus.FORBIDDEN
+            )
+        if player_role is not None and player_role != member_role:
+            return (
+                f"ERROR: Player joined this game as {member_role}", 
+                HTTPStatus.FORBIDDEN
+            )
+        player_role = member_role
 
-                # +++ DEBUG BLOCK: For debugging purposes only (REMOVE BEFORE DEPLOYING)
+        # Sampled: this runs for every ping of every player
+        ping_logger.debug(
+            "Location of %s player %s in game %s: %s, %s", 
+            player_role, player_id, game_id, player_latitude, player_longitude
+        )
 
-                mafia_players = [
-                    player_id for player_id, data in broadcast_recipients.items() if data['role'] == 'mafia'
-                ]
+        # Eliminated players are out of the game
+        if room.is_eliminated(player_id):
+            return (
+                "ERROR: Player has been eliminated", 
+                HTTPStatus.FORBIDDEN
+            )
 
-                # +++ DEBUG BLOCK: For debugging purposes only (REMOVE BEFORE DEPLOYING)
+        # Ingestion: rate limit, smooth, and drop the moves too small
+        # to matter. Near the elimination distance the raw ping is
+        # taken as is, so eliminations are still decided exactly
+        ping_filter = read_app_settings('ping_filter')
+        if ping_filter is not None:
+            verdict, player_latitude, player_longitude = ping_filter.filter(
+                player_id, 
+                player_role, 
+                player_latitude, 
+                player_longitude, 
+                exact = near_elimination(room, player_role, player_latitude, player_longitude)
+            )
+            if verdict != ACCEPTED:
+                PINGS_DROPPED.labels(verdict).inc()
+                return ({
+                    'role': player_role, 
+                    'latitude': player_latitude, 
+                    'longitude': player_longitude
+                }, HTTPStatus.OK)
 
-                print("Mafia is played by: ", mafia_players)
+        if player_cache is not None:
 
-                # +++ DEBUG BLOCK: For debugging purposes only (REMOVE BEFORE DEPLOYING)
+            # Update the room in memory, Redis is written behind
+            player_cache.record(room, player_id, player_role, player_latitude, player_longitude)
+        else:
 
-                # Check if cop is within 1 meter of any mafia
-                for _player in mafia_players:
+            #update the user's current location
+            update_location(player_id, player_latitude, player_longitude, player_role)
+            room.geo_index.add(player_id, player_role, player_latitude, player_longitude)
+
+            room.join(player_id, player_role)
+
+            # Only this player's move is broadcast from here, then
+            # refresh the room with the player details to send back
+            # as a response
+            room.update_player(player_id, player_role, player_latitude, player_longitude)
+            room.refresh(room_players(room))
+
+        # Only the positions taken go to the journal (see ingestion)
+        journal_event(
+            game_id, 
+            "location", 
+            player_id = player_id, 
+            role = player_role, 
+            latitude = player_latitude, 
+            longitude = player_longitude
+        )
 
-                    mafia_location = (
-                        broadcast_recipients[_player]['latitude'], 
-                        broadcast_recipients[_player]['longitude']
-                    )
-                    cop_location = (
-                        player_latitude, player_longitude
-                    )
+        broadcast_recipients = room.recipients()
+
+        # Any move can bring a cop and a mafia together
+        with DISTANCE_LATENCY.time():
+            catches = find_catches(
+                room, 
+                player_id, 
+                player_role, 
+                player_latitude, 
+                player_longitude, 
+                broadcast_recipients
+            )
 
-                    # Elimination logic
-                    if distance(cop_location, mafia_location) <= read_app_settings('elimination_distance'):
-                        del broadcast_recipients[_player]
+        # Every server decides eliminations under the same lock,
+        # only taken when someone got caught, or when a cop's move
+        # finds no mafia left (the game may be won). The mafia are
+        # read from the room's cache, without a Redis round trip
+        if catches or (player_role == "cop" and not room.mafia_players()):
+            with room.game_lock():
+                mafia_players = room.mafia_players()
+                ping_logger.debug("Catches in game %s: %s", game_id, catches)
+
+                # Elimination logic
+                for cop_id, _player in catches:
+                    if _player in mafia_players:
                         mafia_players.remove(_player)
 
-                        print("Mafia eliminated", _player)
+                    # Already caught (through another server)
+                    if not room.eliminate(_player):
+                        continue
+                    forget_pings(_player)
+
+                    logger.info("Mafia %s eliminated by cop %s in game %s", _player, cop_id, game_id)
+                    ELIMINATIONS.inc()
+                    journal_event(game_id, "eliminated", player_id=_player, by=cop_id)
+                    with EMIT_LATENCY.labels("mafia_eliminated").time():
                         socketio.emit(
                             'mafia_eliminated', 
-                            {'mafia_id': _player}
+                            {'mafia_id': _player, 'game_id': game_id}, 
+                            to = channel_name(game_id)
                         )
 
-                socketio.emit(
-                    'cop_location_update', 
-                    {player_id: broadcast_recipients[player_id]}
-                )
-
-                if not mafia_players and not game_outcome:
-                    game_outcome = True
-                    socketio.emit('game_over', {'result': 'Cop wins!'})
-
-            else:
-                if not game_outcome:
+                if not mafia_players and room.finish("cop_wins"):
+                    logger.info("Game %s over: cop wins", game_id)
+                    journal_event(game_id, "game_over", result="cop_wins")
                     socketio.emit(
-                        'mafia_location_update', 
-                        {player_id: broadcast_recipients[player_id]}
+                        'game_over', 
+                        {'result': 'Cop wins!', 'game_id': game_id}, 
+                        to = channel_name(game_id)
                     )
+                    close_room_later(room)
+
+        # The new position goes out with the room's next
+        # broadcast tick (see broadcast_tick)
 
         # Return a HTTP 200 OK status with player details
         server_response = (
@@ -474,43 +937,484 @@ def get_player_location():
             HTTPStatus.OK
         )
 
-    except Exception as e:
-
-        # +++ DEBUG BLOCK: For debugging purposes only (REMOVE BEFORE DEPLOYING)
-        print("An exception occurred while receiving player location:")
-        print(e)
+    except Exception:
+        logger.exception("An exception occurred while receiving player location")
         server_response = (
-            "Exception occurred in '/location' route", 
+            "Exception occurred while processing the player location", 
             HTTPStatus.INTERNAL_SERVER_ERROR
         )
-        # +++ DEBUG BLOCK: For debugging purposes only (REMOVE BEFORE DEPLOYING)
 
-    return jsonify(server_response)
+    return server_response
+
+# ==========================================================
+# +++ Game Journal Endpoints +++
+# Replays and exports of the games' events (see 
+# journal_lib), for the admins
+# Times are UNIX timestamps in seconds
+# ==========================================================
+
+# Content type of the streamed (one JSON value per line) responses
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+# Read an optional timestamp from the query string
+# Raises ValueError if it is not a number
+def timestamp_arg(name):
+    value = request.args.get(name)
+    return None if value is None else float(value)
+
+@app.route("/games/<game_id>/replay", methods = ["GET"])
+@cross_origin()
+@admin_required
+def replay_game(game_id):
+    if journal is None:
+        return jsonify(("ERROR: The game journal is disabled", HTTPStatus.NOT_FOUND))
+    try:
+        at = timestamp_arg('at')
+    except ValueError:
+        return jsonify(("ERROR: 'at' must be a timestamp", HTTPStatus.BAD_REQUEST))
+
+    # Include this server's events not written yet
+    journal.flush()
+    return jsonify((journal.replay(game_id, at), HTTPStatus.OK))
+
+# Streams the events as newline-delimited JSON, oldest first
+@app.route("/games/<game_id>/events", methods = ["GET"])
+@cross_origin()
+@admin_required
+def export_game(game_id):
+    if journal is None:
+        return jsonify(("ERROR: The game journal is disabled", HTTPStatus.NOT_FOUND))
+    try:
+        since = timestamp_arg('since')
+        until = timestamp_arg('until')
+    except ValueError:
+        return jsonify(("ERROR: 'since' and 'until' must be timestamps", HTTPStatus.BAD_REQUEST))
+
+    journal.flush()
+    events = journal.export(game_id, since, until)
+    return Response(
+        stream_with_context(json.dumps(event) + "\n" for event in events), 
+        content_type = NDJSON_CONTENT_TYPE
+    )
+
+# ==========================================================
+# +++ Player Administration Endpoints +++
+# Bulk operations on the player records, for the admins
+# Large inputs and outputs are streamed as 
+# newline-delimited JSON, one player per line
+# ==========================================================
+
+# The users to import from the request body: a JSON array, or
+# newline-delimited JSON read line by line (large imports are
+# never held in memory)
+# Raises ValueError when a user is malformed
+def imported_users():
+    if request.mimetype == NDJSON_CONTENT_TYPE:
+        records = (json.loads(line) for line in request.stream if line.strip())
+    else:
+        records = request.get_json(silent=True)
+        if not isinstance(records, list):
+            raise ValueError("Expected a JSON array of users")
+
+    for number, record in enumerate(records, 1):
+        try:
+            user = (
+                str(record['id']), 
+                record['name'], 
+                record['password'], 
+                record.get('status', "inactive"), 
+                float(record.get('lat', 0)), 
+                float(record.get('lon', 0)), 
+                record.get('role', "mafia")
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"User {number}: missing or invalid {e}")
+        if not isinstance(user[2], str) or not user[2]:
+            raise ValueError(f"User {number}: missing or invalid 'password'")
+        if user[3] not in ("active", "inactive"):
+            raise ValueError(f"User {number}: unknown status '{user[3]}'")
+        yield user
+
+# The users with their password hashed: plaintext passwords
+# are hashed on the bcrypt pool, a batch at a time, bcrypt
+# hashes are kept as given
+def hashed_users(users):
+    verifier = read_app_settings('password_verifier')
+    users = iter(users)
+    while True:
+        batch = list(islice(users, BATCH_SIZE))
+        if not batch:
+            return
+        hashes = [
+            None if is_password_hash(user[2]) else verifier.hash_password(user[2]) 
+            for user in batch
+        ]
+        for user, password_hash in zip(batch, hashes):
+            if password_hash is not None:
+                user = (user[0], user[1], password_hash.result(), *user[3:])
+            yield user
+
+# Passwords may be given in plaintext or as bcrypt hashes,
+# only hashes are stored
+@app.route("/admin/users/import", methods = ["POST"])
+@cross_origin()
+@admin_required
+def import_players():
+    try:
+        imported = import_users(hashed_users(imported_users()))
+    except ValueError as e:
+        # The batches before the malformed user were imported
+        return jsonify((f"ERROR: {e}", HTTPStatus.BAD_REQUEST))
+    return jsonify(({"imported": imported}, HTTPStatus.OK))
+
+# Streams every player (without their password)
+@app.route("/admin/users", methods = ["GET"])
+@cross_origin()
+@admin_required
+def export_players():
+    def lines():
+        for user_id, user_data in iter_users():
+            player = dict(zip(USER_FIELDS, user_data))
+            yield json.dumps({
+                "id": user_id, 
+                "name": player["username"], 
+                "status": player["status"], 
+                "lat": player["latitude"], 
+                "lon": player["longitude"], 
+                "role": player["role"]
+            }) + "\n"
+    return Response(stream_with_context(lines()), content_type=NDJSON_CONTENT_TYPE)
+
+@app.route("/admin/users", methods = ["DELETE"])
+@cross_origin()
+@admin_required
+def delete_players():
+    user_ids = (request.get_json(silent=True) or {}).get('ids')
+    if not isinstance(user_ids, list):
+        return jsonify(("ERROR: Expected the 'ids' of the players to delete", HTTPStatus.BAD_REQUEST))
+    return jsonify(({"deleted": delete_users(str(user_id) for user_id in user_ids)}, HTTPStatus.OK))
+
+# Marks every player inactive, e.g. after a match
+@app.route("/admin/users/reset-status", methods = ["POST"])
+@cross_origin()
+@admin_required
+def reset_player_statuses():
+    return jsonify(({"reset": reset_user_statuses()}, HTTPStatus.OK))
+
+# Deletes the players not seen for 'max_age' seconds
+@app.route("/admin/users/expire", methods = ["POST"])
+@cross_origin()
+@admin_required
+def expire_players():
+    try:
+        max_age = float((request.get_json(silent=True) or {})['max_age'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify(("ERROR: Expected 'max_age', in seconds", HTTPStatus.BAD_REQUEST))
+    return jsonify(({"deleted": expire_stale_users(max_age)}, HTTPStatus.OK))
+
+# ==========================================================
+# +++ Location Endpoint +++
+# To get location co-ordinates (along with
+# other data) from players
+# Kept for clients that do not use the Socket.IO
+# 'location' event
+# ==========================================================
+
+@app.route("/location", methods = ["POST"])
+@cross_origin()
+@timed(LOCATION_LATENCY, "http")
+@token_required
+def get_player_location():
+    try:
+        data, packed = read_location_request()
+    except ValueError as e:
+        return jsonify((f"ERROR: Malformed location: {e}", HTTPStatus.BAD_REQUEST))
+    if data is None:
+        return jsonify(("ERROR: Missing location", HTTPStatus.BAD_REQUEST))
+
+    response, status = process_location(data)
+
+    # Packed requests get a packed answer (errors stay JSON)
+    if packed and status == HTTPStatus.OK:
+        return Response(
+            encode_players({str(data['id']): response}), 
+            content_type = PACKED_CONTENT_TYPE
+        )
+    return jsonify((response, status))
+
+# The ping in the request body, JSON or packed (see wire_lib)
+# Returns the (ping, packed) pair, raises ValueError if malformed
+def read_location_request():
+    if request.mimetype == PACKED_CONTENT_TYPE:
+        return decode_location(request.get_data()), True
+    return request.get_json(silent=True), False
 
 # ==========================================================
 # +++ Broadcast handler +++
 # Handle broadcast connection
+# Each socket joins the rooms of its game (and role), so 
+# broadcasts only reach the players of that game
 # ==========================================================
+# Clients may ask for the packed encoding (see wire_lib) of the
+# position messages by joining with encoding='packed'
+# Reconnecting clients send the last room version they received
+# (last_version) and only get what they missed, as one 
+# 'positions_delta', unless they are too far behind
+# The role is the one the player logged in with (the client's is
+# only taken when REQUIRE_AUTH=0), so a mafia can't listen in on the
+# cop's broadcasts
+def join_game(game_id, role, encoding=JSON, last_version=None):
+    if encoding not in ENCODINGS:
+        encoding = JSON
+    session['encoding'] = encoding
+
+    if read_app_settings('require_auth'):
+        role = player_role(session.get('player_id'))
+
+    room = rooms.get_or_create(str(game_id))
+
+    join_room(channel_name(room.game_id))
+    if role in ("cop", "mafia"):
+        join_room(channel_name(room.game_id, role, encoding))
+
+        missed = room.deltas_since(last_version, role) if last_version else None
+        if missed is not None:
+            delta, version = missed
+            emit('positions_delta', (encode_players(delta) if encoding == PACKED else delta, version))
+            return
+
+    # Send the new player where everybody in the game is
+    recipients, version = room.snapshot()
+    emit('all_users', (encode_players(recipients) if encoding == PACKED else recipients, version))
+
+# The role in an active player's record (see '/login'), or None
+def player_role(player_id):
+    user_data = fetch_user_data(player_id) if player_id is not None else []
+    if not user_data or user_data[2] != "active":
+        return None
+    return user_data[-1]
+
 @socketio.on('connect')
-def handle_connect():
-    emit('all_users', broadcast_recipients)
+def handle_connect(auth=None):
+    # Check the access token once for the whole connection, and
+    # remember who the socket belongs to
+    if read_app_settings('require_auth'):
+        token = (auth or {}).get('token') or request.args.get('token')
+        subject = token_subject(token)
+        if subject is None:
+            return False
+        session['player_id'] = subject
+
+    CONNECTED_SOCKETS.inc()
+
+    # Clients may pick their game in the connection URL,
+    # otherwise they send a 'join_game' event
+    game_id = request.args.get('game_id')
+    if game_id is not None:
+        join_game(
+            game_id, 
+            request.args.get('role'), 
+            request.args.get('encoding', JSON), 
+            request.args.get('last_version')
+        )
+
+@socketio.on('disconnect')
+def handle_disconnect(*args):
+    CONNECTED_SOCKETS.dec()
+
+@socketio.on('join_game')
+def handle_join_game(data):
+    join_game(
+        data.get('game_id', DEFAULT_GAME_ID), 
+        data.get('role'), 
+        data.get('encoding', JSON), 
+        data.get('last_version')
+    )
+
+# ==========================================================
+# +++ Location event +++
+# Same as the '/location' endpoint, over the already 
+# open socket. The (response, status) pair is sent 
+# back as the event's acknowledgement
+# ==========================================================
+@socketio.on('location')
+@timed(LOCATION_LATENCY, "socketio")
+def handle_location(data):
+    # Packed pings arrive as bytes
+    if isinstance(data, (bytes, bytearray)):
+        try:
+            data = decode_location(data)
+        except ValueError as e:
+            return [f"ERROR: Malformed location: {e}", int(HTTPStatus.BAD_REQUEST)]
+
+    if read_app_settings('require_auth') and str(data.get('id')) != session.get('player_id'):
+        return [
+            "ERROR: The connection belongs to another player", 
+            int(HTTPStatus.FORBIDDEN)
+        ]
+    response, status = process_location(data)
+
+    if session.get('encoding') == PACKED and status == HTTPStatus.OK:
+        response = encode_players({str(data['id']): response})
+    return [response, int(status)]
 
 # ==========================================================
-# +++ App pre-run configuration +++
+# +++ Application factory +++
+# Importing this module only defines the application.
+# create_app() configures it (without reaching Redis).
+# 'flask seed' adds the seed users and 'flask
+# migrate-users' upgrades the records of an older
+# version, both run by hand, never on start
 # ==========================================================
 
-# !! DEPRECATED !!
-# @app.before_first_request
-# This annotation no longer works
+# app.config keys of the Redis connection -> create_client() arguments
+REDIS_SETTINGS = {
+    "REDIS_URL": "url", 
+    "REDIS_MAX_CONNECTIONS": "max_connections", 
+    "REDIS_POOL_TIMEOUT": "pool_timeout", 
+    "REDIS_SOCKET_TIMEOUT": "socket_timeout", 
+    "REDIS_CONNECT_TIMEOUT": "socket_connect_timeout", 
+}
+
+def default_async_mode():
+    """
+    The Socket.IO async mode matching how the process was started.
+
+    Gunicorn's gevent and eventlet workers monkey-patch the standard
+    library before loading the application, so the game clocks, ticks
+    and log threads run as greenlets. Anywhere else (e.g. 'python
+    wsgi.py') those are real threads, which must not emit into a
+    gevent or eventlet loop, even if one is installed.
+
+    Returns:
+        str: 'gevent', 'eventlet' or 'threading'.
+    """
+    if "gevent" in sys.modules:
+        from gevent import monkey
+        if monkey.is_module_patched("threading"):
+            return "gevent"
+    if "eventlet" in sys.modules:
+        from eventlet import patcher
+        if patcher.is_monkey_patched("thread"):
+            return "eventlet"
+    return "threading"
+
+def create_app(config=None):
+    """
+    Configure the application: settings, Redis connection pool,
+    Socket.IO, player cache and game journal.
+
+    Nothing here reaches Redis, connections are opened by the first
+    request that needs one.
+
+    Args:
+        config (dict, optional): Values for app.config. The REDIS_*
+            keys (see REDIS_SETTINGS) override the connection settings
+            given in the environment (see redis_lib.settings_from_env).
+
+    Returns:
+        Flask: The application.
+    """
+    global player_cache, journal
+
+    app.config.update(config or {})
+    configure_logging()
+
+    redis_settings = {
+        argument: app.config[key] for key, argument in REDIS_SETTINGS.items() if key in app.config
+    }
+    if redis_settings:
+        redis_lib.configure(**redis_settings)
+
+    # SOCKETIO_ASYNC_MODE picks the server model ('threading', 'eventlet',
+    # 'gevent' or 'gevent_uwsgi'), by default the one the process runs
+    # (see default_async_mode)
+    # SOCKETIO_MESSAGE_QUEUE (e.g. redis://db:6379/0) relays the broadcasts
+    # through Redis, so that they reach the sockets of every server
+    socketio.init_app(
+        app, 
+        cors_allowed_origins = "*", 
+        async_mode = os.environ.get("SOCKETIO_ASYNC_MODE") or default_async_mode(), 
+        message_queue = os.environ.get("SOCKETIO_MESSAGE_QUEUE")
+    )
 
-def before_first_request():
-    print("Starting python server for the first time")
     app_settings()
 
-# Instead use app.app_context()
-with app.app_context():
-    before_first_request()
+    # With the player cache on (PLAYER_CACHE=1, the default), each room
+    # holds its players in memory and a location ping does no Redis read:
+    # positions are written behind to Redis every WRITE_BEHIND_INTERVAL
+    # seconds and published to the other servers (see cache_lib)
+    if os.environ.get("PLAYER_CACHE", "1") == "1":
+        player_cache = PlayerStateCache(
+            redis_lib.client, 
+            rooms, 
+            save_locations = update_locations, 
+            load_players = lambda room: room_players(room), 
+            interval = float(os.environ.get("WRITE_BEHIND_INTERVAL", 1)), 
+            resync_interval = float(os.environ.get("CACHE_RESYNC_INTERVAL", 30))
+        )
+
+    # With the journal on (JOURNAL=1, the default), every game's events
+    # are appended to a Redis stream, written in batches every
+    # JOURNAL_FLUSH_INTERVAL seconds, for replays and offline analysis.
+    # JOURNAL_MAXLEN caps the events kept per game (about 100000 by
+    # default, 0 keeps them all), and a game's stream expires
+    # JOURNAL_RETENTION seconds after the game is closed (a day by
+    # default, 0 keeps it forever)
+    if os.environ.get("JOURNAL", "1") == "1":
+        journal = EventJournal(
+            redis_lib.client, 
+            interval = float(os.environ.get("JOURNAL_FLUSH_INTERVAL", 0.5)), 
+            maxlen = int(os.environ.get("JOURNAL_MAXLEN", 100000)) or None, 
+            retention = float(os.environ.get("JOURNAL_RETENTION", 86400)) or None
+        )
+
+    logger.info("Application configured")
+    return app
 
+def seed_database():
+    """
+    Add the SEED_USERS that don't exist yet (their passwords are hashed
+    here, the existing users are left untouched). Safe to run any
+    number of times.
+
+    Returns:
+        dict: How many users were added.
+    """
+    verifier = read_app_settings('password_verifier')
+    added = 0
+    for user_id, username, password, status, latitude, longitude, role in SEED_USERS:
+        if get_user_credentials(username)[1] != "":
+            continue
+        password_hash = verifier.hash_password(password).result()
+        if add_user(user_id, username, password_hash, status, latitude, longitude, role):
+            added += 1
+
+    return {"added": added}
+
+def migrate_database():
+    """
+    Upgrade the user records written by older versions: convert the
+    records stored with the old list schema, and rebuild the indexes
+    from the records (see redis_lib.rebuild_user_indexes). SCANs the
+    whole keyspace, run it once after upgrading.
+
+    Returns:
+        dict: How many records were migrated and indexed.
+    """
+    return {"migrated": migrate_user_records(), "indexed": rebuild_user_indexes()}
+
+@app.cli.command("seed")
+def seed_command():
+    """Add the seed users that don't exist yet."""
+    counts = seed_database()
+    click.echo(f"Added {counts['added']} seed user(s)")
+
+@app.cli.command("migrate-users")
+def migrate_users_command():
+    """Convert the legacy user records and rebuild the user indexes."""
+    counts = migrate_database()
+    click.echo(f"Migrated {counts['migrated']} record(s), indexed {counts['indexed']}")
 
 # ==========================================================
 # +++ TO RUN THIS FILE, RUN wsgi.py FILE +++
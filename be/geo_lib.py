@@ -0,0 +1,277 @@
+import os
+import math
+import threading
+from distance_lib import batch_distances, haversine, EARTH_RADIUS
+
+# Player roles that get their own geospatial set
+ROLES = ("cop", "mafia")
+
+# Default cell size of GridGeoIndex, in meters
+DEFAULT_CELL_SIZE = float(os.environ.get("GEO_CELL_SIZE", 150))
+
+# Meters per degree of latitude (and of longitude at the equator)
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+# Longitude cells are sized for this latitude at most, near the poles
+_MAX_LATITUDE = 89.0
+
+class RedisGeoIndex:
+    """
+    Player positions kept in one Redis geospatial set per role, so a
+    radius query around a player is a single server-side GEOSEARCH.
+    """
+
+    def __init__(self, client, key_prefix="geo:players"):
+        """
+        Args:
+            client (redis.Redis): The Redis client to use.
+            key_prefix (str): Prefix of the per-role keys.
+        """
+        self.client = client
+        self.key_prefix = key_prefix
+
+    def key(self, role):
+        return f"{self.key_prefix}:{role}"
+
+    def add(self, player_id, role, latitude, longitude):
+        """
+        Add or move a player. The player is removed from the sets of
+        the other roles, in case they switched role.
+
+        Args:
+            player_id (str): The player's unique identifier.
+            role (str): The player's role.
+            latitude (float): The player's latitude.
+            longitude (float): The player's longitude.
+        """
+        pipe = self.client.pipeline()
+        for other_role in ROLES:
+            if other_role != role:
+                pipe.zrem(self.key(other_role), player_id)
+        pipe.geoadd(self.key(role), [float(longitude), float(latitude), player_id])
+        pipe.execute()
+
+    def remove(self, player_id):
+        """
+        Remove a player (eliminated or logged out) from every role.
+
+        Args:
+            player_id (str): The player's unique identifier.
+        """
+        pipe = self.client.pipeline()
+        for role in ROLES:
+            pipe.zrem(self.key(role), player_id)
+        pipe.execute()
+
+    def search(self, role, latitude, longitude, radius):
+        """
+        Find the players of a role within a radius of a point.
+
+        Args:
+            role (str): The role to search.
+            latitude (float): Latitude of the center.
+            longitude (float): Longitude of the center.
+            radius (float): Search radius in meters.
+
+        Returns:
+            list: (player_id, distance in meters) tuples, nearest first.
+        """
+        results = self.client.geosearch(
+            self.key(role),
+            longitude = float(longitude),
+            latitude = float(latitude),
+            radius = radius,
+            unit = "m",
+            withdist = True,
+            sort = "ASC",
+        )
+        return [(player_id, dist) for player_id, dist in results]
+
+    def clear(self):
+        """
+        Remove every player, e.g. once the game is over.
+        """
+        self.client.delete(*(self.key(role) for role in ROLES))
+
+class MemoryGeoIndex:
+    """
+    Pure-Python drop-in for RedisGeoIndex. Searches are a linear scan,
+    which is fine for tests and single-process development.
+    """
+
+    def __init__(self):
+        self.positions = {role: {} for role in ROLES}
+        self.lock = threading.Lock()
+
+    def add(self, player_id, role, latitude, longitude):
+        with self.lock:
+            for other_role in ROLES:
+                self.positions[other_role].pop(player_id, None)
+            self.positions.setdefault(role, {})[player_id] = (float(latitude), float(longitude))
+
+    def remove(self, player_id):
+        with self.lock:
+            for players in self.positions.values():
+                players.pop(player_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.positions = {role: {} for role in ROLES}
+
+    def search(self, role, latitude, longitude, radius):
+        latitude = float(latitude)
+        longitude = float(longitude)
+
+        with self.lock:
+            players = list(self.positions.get(role, {}).items())
+
+        if not players:
+            return []
+
+        distances = batch_distances(
+            (latitude, longitude), 
+            [position for _, position in players], 
+            "haversine"
+        )
+        results = [
+            (player_id, float(dist)) 
+            for (player_id, _), dist in zip(players, distances) if dist <= radius
+        ]
+        results.sort(key=lambda result: result[1])
+        return results
+
+class GridGeoIndex:
+    """
+    In-memory spatial hash: a uniform grid of cells about 'cell_size'
+    meters wide, each holding the players of each role inside it.
+
+    A radius search only looks at the cells the circle overlaps, so
+    it costs as much as there are players nearby, whatever the total
+    number of players.
+
+    Rows are bands of latitude. A row is split into a whole number of
+    columns around the globe, as many as fit with every cell at least
+    'cell_size' meters wide at the band's highest latitude. Columns
+    wrap around at the antimeridian (+-180 degrees), so searches
+    there see both sides.
+    """
+
+    def __init__(self, cell_size=DEFAULT_CELL_SIZE):
+        """
+        Args:
+            cell_size (float): Cell size in meters. Searches are
+                cheapest when it is about the usual search radius.
+        """
+        self.cell_size = float(cell_size)
+        self.row_height = self.cell_size / METERS_PER_DEGREE
+        self.columns = {}           # row -> (number of columns, their width in degrees)
+
+        self.cells = {role: {} for role in ROLES}   # role -> (row, column) -> {player_id}
+        self.positions = {}         # player_id -> (role, latitude, longitude, cell)
+        self.lock = threading.Lock()
+
+    def _columns(self, row):
+        columns = self.columns.get(row)
+        if columns is None:
+            latitude = min(_MAX_LATITUDE, max(abs(row * self.row_height), abs((row + 1) * self.row_height)))
+            count = max(1, math.floor(360 * math.cos(math.radians(latitude)) / self.row_height))
+            columns = self.columns[row] = (count, 360 / count)
+        return columns
+
+    def _cell(self, latitude, longitude):
+        row = math.floor(latitude / self.row_height)
+        count, width = self._columns(row)
+        return row, math.floor((longitude + 180) / width) % count
+
+    def _remove(self, player_id):
+        # Caller holds self.lock
+        position = self.positions.pop(player_id, None)
+        if position is None:
+            return
+        role, _, _, cell = position
+        players = self.cells[role].get(cell)
+        if players is not None:
+            players.discard(player_id)
+            if not players:
+                del self.cells[role][cell]
+
+    def add(self, player_id, role, latitude, longitude):
+        latitude = float(latitude)
+        longitude = float(longitude)
+        cell = self._cell(latitude, longitude)
+
+        with self.lock:
+            old = self.positions.get(player_id)
+            if old is None or old[0] != role or old[3] != cell:
+                self._remove(player_id)
+                self.cells.setdefault(role, {}).setdefault(cell, set()).add(player_id)
+            self.positions[player_id] = (role, latitude, longitude, cell)
+
+    def remove(self, player_id):
+        with self.lock:
+            self._remove(player_id)
+
+    def clear(self):
+        with self.lock:
+            self.cells = {role: {} for role in ROLES}
+            self.positions = {}
+
+    def search(self, role, latitude, longitude, radius):
+        latitude = float(latitude)
+        longitude = float(longitude)
+
+        # The rows the circle overlaps, then the columns of each row
+        d_latitude = radius / METERS_PER_DEGREE
+        edge = abs(latitude) + d_latitude
+        if edge < _MAX_LATITUDE:
+            d_longitude = d_latitude / math.cos(math.radians(edge))
+        else:
+            # Too close to a pole for a box: every column of the rows
+            d_longitude = 360
+
+        with self.lock:
+            cells = self.cells.get(role, {})
+            candidates = []
+            for row in range(
+                math.floor((latitude - d_latitude) / self.row_height), 
+                math.floor((latitude + d_latitude) / self.row_height) + 1
+            ):
+                count, width = self._columns(row)
+                first = math.floor((longitude - d_longitude + 180) / width)
+                last = math.floor((longitude + d_longitude + 180) / width)
+
+                # Past the antimeridian, the columns start over
+                columns = range(count) if last - first + 1 >= count else (
+                    column % count for column in range(first, last + 1)
+                )
+                for column in columns:
+                    for player_id in cells.get((row, column), ()):
+                        _, player_latitude, player_longitude, _ = self.positions[player_id]
+                        candidates.append((player_id, player_latitude, player_longitude))
+
+        results = []
+        for player_id, player_latitude, player_longitude in candidates:
+            dist = haversine(latitude, longitude, player_latitude, player_longitude)
+            if dist <= radius:
+                results.append((player_id, dist))
+        results.sort(key=lambda result: result[1])
+        return results
+
+def create_geo_index(client, key_prefix="geo:players"):
+    """
+    Build the geospatial index selected by the GEO_INDEX_BACKEND
+    environment variable ('redis', the default, 'grid' or 'memory').
+
+    Args:
+        client (redis.Redis): The Redis client, used by the redis backend.
+        key_prefix (str): Prefix of the redis backend's per-role keys.
+
+    Returns:
+        RedisGeoIndex, GridGeoIndex or MemoryGeoIndex: The index.
+    """
+    backend = os.environ.get("GEO_INDEX_BACKEND", "redis")
+    if backend == "grid":
+        return GridGeoIndex()
+    if backend == "memory":
+        return MemoryGeoIndex()
+    return RedisGeoIndex(client, key_prefix)
@@ -0,0 +1,51 @@
+# Gunicorn settings for production (see the Dockerfile's CMD)
+#
+# Socket.IO needs an async worker to hold many open sockets per
+# process, so gevent (with gevent-websocket) is used by default.
+#
+# One worker per Gunicorn process: Socket.IO long-polling needs every
+# request of a session to reach the same process, and a load balancer
+# can pin a client to a server but not to one worker behind a master.
+# Scale out with more instances (containers) instead, which share the
+# games through Redis: set SOCKETIO_MESSAGE_QUEUE so that broadcasts
+# reach every instance's sockets, and use sticky sessions in the load
+# balancer.
+
+import os
+
+bind = "0.0.0.0:" + os.environ.get("PORT", "5000")
+
+# Number of worker processes (see above, more break long-polling)
+workers = 1
+
+# Async worker class ('eventlet' also works if installed)
+worker_class = os.environ.get(
+    "WORKER_CLASS", 
+    "geventwebsocket.gunicorn.workers.GeventWebSocketWorker"
+)
+
+# Maximum number of simultaneous clients (sockets) per worker
+worker_connections = int(os.environ.get("WORKER_CONNECTIONS", 10000))
+
+# Long-polling Socket.IO requests can be slow, don't kill their worker
+timeout = int(os.environ.get("WORKER_TIMEOUT", 60))
+graceful_timeout = 30
+keepalive = 5
+
+# No debug reloader, and only errors in the access path
+reload = False
+loglevel = os.environ.get("LOG_LEVEL", "warning")
+accesslog = None
+
+def post_worker_init(worker):
+    # Open the default game (and start its game clock) in the worker
+    from gameserver import rooms, DEFAULT_GAME_ID
+    rooms.get_or_create(DEFAULT_GAME_ID)
+
+def worker_exit(server, worker):
+    # Write the positions and game events still queued
+    from gameserver import player_cache, journal
+    if player_cache is not None:
+        player_cache.stop()
+    if journal is not None:
+        journal.stop()
@@ -0,0 +1,149 @@
+import time
+import threading
+from distance_lib import equirectangular
+
+# Verdicts of PingFilter.filter()
+ACCEPTED = "accepted"
+RATE_LIMITED = "rate_limited"
+UNCHANGED = "unchanged"
+
+class _Track:
+    """
+    Filter state of one player: the filtered position and velocity (in
+    degrees and degrees per second), and the position last accepted.
+    """
+    __slots__ = ("role", "time", "latitude", "longitude", "v_latitude", "v_longitude", "stored")
+
+    def __init__(self, role, now, latitude, longitude):
+        self.role = role
+        self.time = now
+        self.latitude = latitude
+        self.longitude = longitude
+        self.v_latitude = 0.0
+        self.v_longitude = 0.0
+        self.stored = (latitude, longitude)
+
+class PingFilter:
+    """
+    Ingestion stage for the location pings, in front of update_location.
+
+    - Rate limit: a player's pings closer than 'min_interval' seconds
+      to the last one taken are dropped.
+    - Smoothing: an alpha-beta filter (a fixed-gain Kalman filter)
+      tracks each player's position and velocity. A ping is compared to
+      where the player should be by now (dead reckoning from the last
+      velocity) and only 'alpha' of the difference is taken, which
+      evens out the GPS jitter. A ping further than 'snap_distance'
+      from the prediction is taken as is (the player really moved).
+    - Threshold: filtered moves shorter than 'min_move' meters from the
+      last accepted position are dropped.
+
+    The position kept for a smoothed or thresholded ping is never more
+    than max_error meters from the raw one. A rate-limited ping keeps
+    the last accepted position, however far the player went since. So
+    callers pass exact=True near a decision boundary (e.g. the
+    elimination distance) to take the raw ping right away, rate limit
+    included.
+    """
+
+    def __init__(self, min_interval=0.5, min_move=2.0, alpha=0.5, beta=0.1, snap_distance=30.0, clock=time.monotonic):
+        """
+        Args:
+            min_interval (float): Seconds between two pings taken from
+                the same player.
+            min_move (float): Shortest move worth storing, in meters.
+            alpha (float): Share (0..1] of the difference between the
+                ping and the prediction applied to the position.
+            beta (float): Share of that difference applied to the
+                velocity (0 turns dead reckoning off).
+            snap_distance (float): Pings further than this (in meters)
+                from the prediction are taken unfiltered.
+            clock (callable): Returns the current time in seconds.
+        """
+        self.min_interval = min_interval
+        self.min_move = min_move
+        self.alpha = alpha
+        self.beta = beta
+        self.snap_distance = snap_distance
+        self.clock = clock
+
+        self.tracks = {}           # player_id -> _Track
+        self.lock = threading.Lock()
+
+    @property
+    def max_error(self):
+        """
+        How far (in meters) the position kept for a ping that was not
+        rate-limited can be from the raw ping.
+        """
+        return self.snap_distance + self.min_move
+
+    def filter(self, player_id, role, latitude, longitude, exact=False):
+        """
+        Run a ping through the filter.
+
+        Args:
+            player_id (str): The player's unique identifier.
+            role (str): The player's role.
+            latitude (float): The ping's latitude.
+            longitude (float): The ping's longitude.
+            exact (bool): Take the raw position now, bypassing the
+                rate limit, the smoothing and the threshold.
+
+        Returns:
+            tuple: (verdict, latitude, longitude). The position is the
+            one to store if the verdict is ACCEPTED, else the one last
+            accepted.
+        """
+        latitude = float(latitude)
+        longitude = float(longitude)
+        now = self.clock()
+
+        with self.lock:
+            track = self.tracks.get(player_id)
+
+            # New players, role changes and exact pings restart the track
+            if track is None or track.role != role or exact:
+                self.tracks[player_id] = _Track(role, now, latitude, longitude)
+                return ACCEPTED, latitude, longitude
+
+            dt = now - track.time
+            if dt < self.min_interval:
+                return (RATE_LIMITED, *track.stored)
+
+            # Dead reckoning: where the player should be by now
+            predicted_latitude = track.latitude + track.v_latitude * dt
+            predicted_longitude = track.longitude + track.v_longitude * dt
+
+            if equirectangular(predicted_latitude, predicted_longitude, latitude, longitude) > self.snap_distance:
+                # Start over from the ping, a jump says nothing
+                # reliable about the speed
+                track.latitude = latitude
+                track.longitude = longitude
+                track.v_latitude = 0.0
+                track.v_longitude = 0.0
+            else:
+                residual_latitude = latitude - predicted_latitude
+                residual_longitude = longitude - predicted_longitude
+                track.latitude = predicted_latitude + self.alpha * residual_latitude
+                track.longitude = predicted_longitude + self.alpha * residual_longitude
+
+                # Two pings at once (min_interval=0) say nothing about
+                # the speed
+                if dt > 0:
+                    track.v_latitude += self.beta * residual_latitude / dt
+                    track.v_longitude += self.beta * residual_longitude / dt
+            track.time = now
+
+            if equirectangular(*track.stored, track.latitude, track.longitude) < self.min_move:
+                return (UNCHANGED, *track.stored)
+
+            track.stored = (round(track.latitude, 7), round(track.longitude, 7))
+            return (ACCEPTED, *track.stored)
+
+    def forget(self, player_id):
+        """
+        Drop a player's track (they left or were eliminated).
+        """
+        with self.lock:
+            self.tracks.pop(player_id, None)
@@ -0,0 +1,272 @@
+import json
+import time
+import threading
+from log_lib import get_logger
+from timer_lib import Ticker
+
+logger = get_logger(__name__)
+
+# Events written to the journal, with their fields
+#   started     start_time (a new game under the game id, see open())
+#   joined      player_id, role
+#   left        player_id
+#   location    player_id, role, latitude, longitude
+#   eliminated  player_id, by
+#   game_over   result
+EVENTS = ("started", "joined", "left", "location", "eliminated", "game_over")
+
+class EventJournal:
+    """
+    Append-only log of each game's events, in one Redis stream per game
+    id (journal:{game_id}). Game ids are reused once a game is closed,
+    so every game begins with a 'started' event (see open()), and
+    replay() only goes back to the last one.
+
+    record() only appends to a buffer in memory; the buffer is written
+    every 'interval' seconds with one pipelined XADD per event, so the
+    journal adds no round trip to the location path. Every event
+    carries the time it happened ('t', UNIX seconds), which replay()
+    and export() go by.
+
+    Streams are capped at about 'maxlen' events, and a game's stream
+    expires 'retention' seconds after the game is closed (see close()),
+    unless a new game starts under the same id first.
+    """
+
+    # Stream entries are read this many at a time
+    CHUNK = 1000
+
+    def __init__(self, client, interval=0.5, maxlen=None, retention=None, key_prefix="journal", clock=time.time):
+        """
+        Args:
+            client (redis.Redis): The Redis client to use.
+            interval (float): Seconds between two writes to Redis.
+            maxlen (int, optional): Approximate number of events kept
+                per game (the oldest are trimmed), unbounded if None.
+            retention (float, optional): Seconds a game's stream is kept
+                once the game is closed, forever if None.
+            key_prefix (str): Prefix of the per-game stream keys.
+            clock (callable): Returns the current UNIX time in seconds.
+        """
+        self.client = client
+        self.interval = interval
+        self.maxlen = maxlen
+        self.retention = retention
+        self.key_prefix = key_prefix
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.buffer = []           # (game_id, event, time, fields)
+        self.lifetimes = {}        # game_id -> seconds its stream lives from the next write (None: forever)
+        self.ticker = None
+
+    def key(self, game_id):
+        return f"{self.key_prefix}:{game_id}"
+
+    def record(self, game_id, event, **fields):
+        """
+        Queue an event for the next write.
+
+        Args:
+            game_id (str): The game's unique identifier.
+            event (str): One of EVENTS.
+            **fields: The event's fields (JSON serializable).
+        """
+        entry = (game_id, event, self.clock(), fields)
+        with self.lock:
+            self.buffer.append(entry)
+
+    def open(self, game_id, start_time):
+        """
+        Record the start of a game, and keep its stream (the previous
+        game under the same id may have left it expiring). Every server
+        hosting the game calls it, the event is dated from the game's
+        start time so replay() tells the copies apart from a new game.
+
+        Args:
+            game_id (str): The game's unique identifier.
+            start_time (float): When the game started (UNIX seconds).
+        """
+        entry = (game_id, "started", start_time, {"start_time": start_time})
+        with self.lock:
+            self.buffer.append(entry)
+            self.lifetimes[game_id] = None
+
+    def close(self, game_id):
+        """
+        Let a game's stream expire 'retention' seconds from its next
+        write, which includes the events still queued.
+
+        Args:
+            game_id (str): The game's unique identifier.
+        """
+        if self.retention is None:
+            return
+        with self.lock:
+            self.lifetimes[game_id] = self.retention
+
+    def flush(self):
+        """
+        Write the queued events to Redis.
+        """
+        with self.lock:
+            batch, self.buffer = self.buffer, []
+            lifetimes, self.lifetimes = self.lifetimes, {}
+        if not batch and not lifetimes:
+            return
+
+        pipe = self.client.pipeline(transaction=False)
+        for game_id, event, at, fields in batch:
+            pipe.xadd(
+                self.key(game_id),
+                {"t": repr(at), "event": event, "data": json.dumps(fields)},
+                maxlen = self.maxlen,
+                approximate = True
+            )
+        for game_id, lifetime in lifetimes.items():
+            if lifetime is None:
+                pipe.persist(self.key(game_id))
+            else:
+                pipe.expire(self.key(game_id), int(lifetime))
+        try:
+            pipe.execute()
+        except Exception:
+            # Put them back in front of the newer ones
+            with self.lock:
+                self.buffer[:0] = batch
+                self.lifetimes = {**lifetimes, **self.lifetimes}
+            raise
+
+    def _tick(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Could not write the game journal to Redis")
+
+    def start(self):
+        """
+        Start writing the buffer every 'interval' seconds, if not
+        already started.
+        """
+        with self.lock:
+            if self.ticker is not None:
+                return
+            self.ticker = Ticker(1.0 / self.interval, self._tick)
+        self.ticker.start()
+
+    def stop(self):
+        """
+        Stop the writes, and write what is left.
+        """
+        with self.lock:
+            ticker, self.ticker = self.ticker, None
+        if ticker is not None:
+            ticker.stop()
+        self.flush()
+
+    # ==========================================================
+    # +++ Readers +++
+    # ==========================================================
+    def export(self, game_id, since=None, until=None):
+        """
+        Iterate over a game's events in the order they were written,
+        reading the stream a chunk at a time. Events recorded by
+        different servers may be a write interval (plus clock skew)
+        out of order, see 't'.
+
+        Args:
+            game_id (str): The game's unique identifier.
+            since (float, optional): Only events at or after this time.
+            until (float, optional): Only events at or before this time.
+
+        Yields:
+            dict: 'id' (the stream entry id), 't', 'event' and the
+            event's fields.
+        """
+        key = self.key(game_id)
+
+        # Entry ids are the (Redis server) time of the write, which is
+        # after the event by up to one write interval (plus clock skew),
+        # so widen the id range and filter on 't'
+        slack = max(5.0, self.interval * 2)
+        start = "-" if since is None else str(int((since - slack) * 1000))
+        end = "+" if until is None else str(int((until + slack) * 1000))
+
+        while True:
+            entries = self.client.xrange(key, start, end, count=self.CHUNK)
+            for entry_id, values in entries:
+                at = float(values["t"])
+                if (since is not None and at < since) or (until is not None and at > until):
+                    continue
+                yield {"id": entry_id, "t": at, "event": values["event"], **json.loads(values["data"])}
+
+            if len(entries) < self.CHUNK:
+                return
+            start = f"({entries[-1][0]}"
+
+    def replay(self, game_id, at=None):
+        """
+        Rebuild a game's state as it was at a given time, from its
+        events, applied in the order they happened ('t') rather than
+        the order they were written. Only the events since the last
+        game started under the id (at that time) count.
+
+        Args:
+            game_id (str): The game's unique identifier.
+            at (float, optional): The time (UNIX seconds), now if None.
+
+        Returns:
+            dict: 'game_id', 'at', 'started' (the game's start time,
+            None if unknown), 'players' (player_id -> {'role',
+            'latitude', 'longitude'}), 'eliminated' (player_ids),
+            'outcome' (None while playing) and 'events' (the number of
+            events replayed).
+        """
+        at = self.clock() if at is None else at
+        started = None
+        players = {}
+        eliminated = set()
+        outcome = None
+        count = 0
+
+        for event in sorted(self.export(game_id, until=at), key=lambda event: event["t"]):
+            kind = event["event"]
+            player_id = event.get("player_id")
+
+            # A new game: forget the previous one (every server hosting
+            # the game records its start)
+            if kind == "started":
+                if event["start_time"] == started:
+                    continue
+                started = event["start_time"]
+                players = {}
+                eliminated = set()
+                outcome = None
+                count = 0
+
+            count += 1
+            if kind == "joined":
+                players.setdefault(player_id, {"role": event.get("role"), "latitude": None, "longitude": None})
+            elif kind == "location":
+                players[player_id] = {
+                    "role": event["role"],
+                    "latitude": event["latitude"],
+                    "longitude": event["longitude"],
+                }
+            elif kind == "left":
+                players.pop(player_id, None)
+            elif kind == "eliminated":
+                players.pop(player_id, None)
+                eliminated.add(player_id)
+            elif kind == "game_over":
+                outcome = event["result"]
+
+        return {
+            "game_id": game_id,
+            "at": at,
+            "started": started,
+            "players": players,
+            "eliminated": sorted(eliminated),
+            "outcome": outcome,
+            "events": count,
+        }
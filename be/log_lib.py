@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import itertools
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+# Production mode (FLASK_ENV=production, as set in the Dockerfile)
+# turns the per-request debug output off
+PRODUCTION = os.environ.get("FLASK_ENV", "development") == "production"
+
+# Per-request debug output, on by default outside production
+DEBUG = os.environ.get("APP_DEBUG", "0" if PRODUCTION else "1") == "1"
+
+# Every logger of the server lives under this one
+ROOT_LOGGER = "app"
+
+# LOG_LEVEL overrides the level picked from DEBUG
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG" if DEBUG else "INFO").upper()
+
+# 'text' for humans, 'json' for log collectors
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json" if PRODUCTION else "text")
+
+# Only one in LOG_SAMPLE_EVERY of the per-ping debug lines is written
+LOG_SAMPLE_EVERY = int(os.environ.get("LOG_SAMPLE_EVERY", 100 if PRODUCTION else 1))
+
+# Attributes of every LogRecord, the others come from 'extra'
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, with the fields passed in 'extra'.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class SampledLogger:
+    """
+    Writes one in 'every' of its messages, for the lines logged on
+    every location ping. When the level is disabled, a call costs a
+    single (cached) level check and nothing is formatted.
+    """
+
+    def __init__(self, logger, every):
+        """
+        Args:
+            logger (logging.Logger): The logger to write to.
+            every (int): Write one message in this many.
+        """
+        self.logger = logger
+        self.every = max(1, every)
+        self.counter = itertools.count()
+
+    def debug(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.DEBUG) and next(self.counter) % self.every == 0:
+            self.logger.debug(msg, *args, stacklevel=2, **kwargs)
+
+_listener = None
+_lock = threading.Lock()
+
+def get_logger(name):
+    """
+    Return the logger of a module.
+
+    Messages use %-style arguments, which are only formatted if the
+    message is written:
+
+        logger.debug("Player %s moved to %s, %s", player_id, lat, lon)
+
+    Args:
+        name (str): The module's name (usually __name__).
+    """
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+def get_sampled_logger(name, every=None):
+    """
+    Return a SampledLogger for a module's per-ping debug lines.
+
+    Args:
+        name (str): The module's name (usually __name__).
+        every (int, optional): Write one message in this many,
+            LOG_SAMPLE_EVERY if None.
+    """
+    return SampledLogger(get_logger(name), LOG_SAMPLE_EVERY if every is None else every)
+
+def configure_logging(level=None, log_format=None, stream=None):
+    """
+    Send the server's logs to a stream (stderr by default).
+
+    Records are put on a queue by the calling thread and formatted and
+    written by a background listener, so a request never waits on
+    the stream. Calling it again does nothing.
+
+    Args:
+        level (str, optional): Level name, LOG_LEVEL if None.
+        log_format (str, optional): 'text' or 'json', LOG_FORMAT if None.
+        stream (file, optional): Where to write, sys.stderr if None.
+    """
+    global _listener
+
+    with _lock:
+        if _listener is not None:
+            return
+
+        handler = logging.StreamHandler(stream or sys.stderr)
+        if (log_format or LOG_FORMAT) == "json":
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(logging.Formatter(
+                "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+            ))
+
+        records = queue.SimpleQueue()
+        logger = logging.getLogger(ROOT_LOGGER)
+        logger.setLevel(level or LOG_LEVEL)
+        logger.addHandler(QueueHandler(records))
+        logger.propagate = False
+
+        _listener = QueueListener(records, handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+
+def stop_logging():
+    """
+    Write the queued records and stop the listener.
+    """
+    global _listener
+
+    with _lock:
+        listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
@@ -0,0 +1,320 @@
+import os
+import time
+import bisect
+import threading
+from functools import wraps
+
+# METRICS_ENABLED=0 turns every metric into a no-op: the decorators
+# return the function unchanged and time() returns a shared
+# context manager that does nothing
+ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+
+# Latency buckets, in seconds (from 100us to 10s)
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+class _NullTimer:
+    """
+    Context manager used by the timers of disabled metrics.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class _Timer:
+    """
+    Context manager observing the time spent in its block.
+    """
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+    return "{" + ",".join(escaped) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+class _Metric:
+    """
+    Base of the metric types. A metric with label names holds one child
+    per combination of label values, created on first use by labels().
+    """
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        """
+        Args:
+            name (str): The metric name.
+            documentation (str): The HELP text.
+            labelnames (tuple): Names of the labels, if any.
+            registry (Registry, optional): Where to register the metric,
+                REGISTRY if None.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values, **kwargs):
+        """
+        Return the child for a combination of label values.
+        """
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        values = tuple(str(value) for value in values)
+
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._child())
+        return child
+
+    def _child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        """
+        Yield (suffix, label values, extra labels, value) tuples.
+        """
+        if not self.labelnames:
+            yield from self._child_samples((), self.labels())
+            return
+        for values, child in list(self.children.items()):
+            yield from self._child_samples(values, child)
+
+    def _child_samples(self, values, child):
+        yield "", values, (), child.get()
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        for suffix, values, extra, value in self._samples():
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}"
+            )
+        return "\n".join(lines)
+
+class _Value:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = float(value)
+
+    def get(self):
+        return self.value
+
+class Counter(_Metric):
+    """
+    A value that only goes up, e.g. the number of eliminations.
+    """
+    type_name = "counter"
+
+    def _child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        if ENABLED:
+            self.labels().inc(amount)
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down, e.g. the connected sockets.
+
+    set_function() makes the gauge call a function when scraped, for
+    values that are cheaper to read than to track.
+    """
+    type_name = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        self.function = None
+        super().__init__(*args, **kwargs)
+
+    def _child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        if ENABLED:
+            self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        if ENABLED:
+            self.labels().dec(amount)
+
+    def set(self, value):
+        if ENABLED:
+            self.labels().set(value)
+
+    def set_function(self, function):
+        """
+        Args:
+            function (callable): Returns the gauge's value.
+        """
+        self.function = function
+
+    def _child_samples(self, values, child):
+        if self.function is not None:
+            yield "", values, (), self.function()
+        else:
+            yield "", values, (), child.get()
+
+class _HistogramValue:
+    __slots__ = ("upper_bounds", "counts", "sum", "lock")
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.upper_bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        if not ENABLED:
+            return _NULL_TIMER
+        return _Timer(self)
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values (latencies, in seconds), counted
+    in cumulative buckets.
+    """
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, buckets=DEFAULT_BUCKETS):
+        self.upper_bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _child(self):
+        return _HistogramValue(self.upper_bounds)
+
+    def observe(self, value):
+        if ENABLED:
+            self.labels().observe(value)
+
+    def time(self):
+        """
+        Context manager observing the time spent in its block:
+
+            with LATENCY.time():
+                ...
+        """
+        if not ENABLED:
+            return _NULL_TIMER
+        return _Timer(self.labels())
+
+    def _child_samples(self, values, child):
+        with child.lock:
+            counts = list(child.counts)
+            total = child.sum
+
+        cumulative = 0
+        for upper_bound, count in zip(self.upper_bounds + (float("inf"),), counts):
+            cumulative += count
+            yield "_bucket", values, (("le", _format_value(upper_bound)),), cumulative
+        yield "_sum", values, (), total
+        yield "_count", values, (), cumulative
+
+def timed(histogram, *labelvalues):
+    """
+    Decorator observing the run time of a function:
+
+        @timed(REDIS_LATENCY, "fetch_user_data")
+        def fetch_user_data(user_id):
+            ...
+
+    Returns the function unchanged when metrics are disabled.
+
+    Args:
+        histogram (Histogram): Where to record the time.
+        *labelvalues (str): The histogram's label values, if any.
+    """
+    def decorator(function):
+        if not ENABLED:
+            return function
+
+        child = histogram.labels(*labelvalues)
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+class Registry:
+    """
+    The metrics exposed by a process.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric '{metric.name}' is already registered")
+            self.metrics[metric.name] = metric
+
+    def render(self):
+        """
+        Return every metric in the Prometheus text format (0.0.4).
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+REGISTRY = Registry()
+
+# Content type of Registry.render()'s output
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
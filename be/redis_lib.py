@@ -1,14 +1,331 @@
 import redis
+from log_lib import get_logger
+from metrics_lib import Histogram, timed
+from itertools import islice
 import os
+import time
 
-# Connect to Redis
-# redis_url = os.environ.get("DATABASE_URL", 'redis://localhost:6379/')
-# client = redis.from_url(redis_url)
-client = redis.StrictRedis(host='localhost', port=6379, db=0, decode_responses=True)
+logger = get_logger(__name__)
 
+# Time spent in each of the functions below, Redis round trips included
+REDIS_LATENCY = Histogram(
+    "redis_call_seconds", 
+    "Time spent in redis_lib calls, in seconds", 
+    ("operation",)
+)
+
+DEFAULT_REDIS_URL = "redis://localhost:6379/0"
+
+def _env_number(name, cast):
+    value = os.environ.get(name)
+    return cast(value) if value else None
+
+def settings_from_env():
+    """
+    The Redis connection settings given in the environment:
+    DATABASE_URL, REDIS_MAX_CONNECTIONS, REDIS_POOL_TIMEOUT,
+    REDIS_SOCKET_TIMEOUT and REDIS_CONNECT_TIMEOUT.
+
+    Returns:
+        dict: Keyword arguments of create_client().
+    """
+    return {
+        "url": os.environ.get("DATABASE_URL", DEFAULT_REDIS_URL),
+        "max_connections": _env_number("REDIS_MAX_CONNECTIONS", int),
+        "pool_timeout": _env_number("REDIS_POOL_TIMEOUT", float),
+        "socket_timeout": _env_number("REDIS_SOCKET_TIMEOUT", float),
+        "socket_connect_timeout": _env_number("REDIS_CONNECT_TIMEOUT", float),
+    }
+
+def create_client(url=DEFAULT_REDIS_URL, max_connections=None, pool_timeout=None, socket_timeout=None, socket_connect_timeout=None):
+    """
+    Build a Redis client on its own connection pool. Connections are
+    opened on demand, nothing connects before the first command.
+
+    Args:
+        url (str): The Redis URL, e.g. 'redis://db:6379/0'.
+        max_connections (int, optional): Size of the pool. Once every
+            connection is in use, callers wait for one to be released
+            (up to 'pool_timeout' seconds). Unbounded if None.
+        pool_timeout (float, optional): Seconds to wait for a free
+            connection, forever if None.
+        socket_timeout (float, optional): Seconds to wait for a reply.
+        socket_connect_timeout (float, optional): Seconds to wait for
+            a connection to open.
+
+    Returns:
+        redis.StrictRedis: The client.
+    """
+    options = {
+        "decode_responses": True,
+        "socket_timeout": socket_timeout,
+        "socket_connect_timeout": socket_connect_timeout,
+    }
+    if max_connections:
+        pool = redis.BlockingConnectionPool.from_url(
+            url, max_connections=max_connections, timeout=pool_timeout, **options
+        )
+    else:
+        pool = redis.ConnectionPool.from_url(url, **options)
+    return redis.StrictRedis(connection_pool=pool)
+
+def configure(**settings):
+    """
+    Replace the client used by this module.
+
+    Args:
+        **settings: create_client() arguments, overriding the ones
+            given in the environment.
+
+    Returns:
+        redis.StrictRedis: The new client.
+    """
+    global client
+    client = create_client(**{**settings_from_env(), **settings})
+    return client
+
+# Connect to Redis (lazily) as the environment says, until configure()
+# is called (see gameserver.create_app)
+client = create_client(**settings_from_env())
+
+# Index keys kept alongside the users:{id} records so that the hot
+# paths never have to SCAN the whole keyspace
+USERNAME_INDEX = "index:usernames"   # hash: username -> user_id
+USER_INDEX = "index:users"           # set: every known user_id
+ACTIVE_INDEX = "index:active"        # set: user_ids with status 'active'
+LAST_SEEN_INDEX = "index:last_seen"  # sorted set: user_id -> last write (UNIX time)
+
+# Number of users handled per round trip by the bulk operations
+BATCH_SIZE = 1000
+
+# Each users:{id} record is a Redis hash with these fields.
+# fetch_user_data() still returns them as a list, in this order
+USER_FIELDS = ("username", "password", "status", "latitude", "longitude", "role")
+
+# Update some fields of an existing record in a single atomic step,
+# without creating a partial record for an unknown user.
+# KEYS[1] = record key, ARGV = field1, value1, field2, value2, ...
+_UPDATE_FIELDS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+return redis.call('HSET', KEYS[1], unpack(ARGV))
+"""
+_update_fields = client.register_script(_UPDATE_FIELDS_SCRIPT)
+
+# Delete users and their index entries in a single atomic step.
+# The username entry is only removed if it still points to the user.
+# KEYS = username, user, active and last-seen indexes
+# ARGV[1] = record key prefix, ARGV[2..] = user_ids
+_DELETE_USERS_SCRIPT = """
+local deleted = 0
+for i = 2, #ARGV do
+    local user_id = ARGV[i]
+    local key = ARGV[1] .. user_id
+    if redis.call('TYPE', key).ok == 'hash' then
+        local username = redis.call('HGET', key, 'username')
+        if username and redis.call('HGET', KEYS[1], username) == user_id then
+            redis.call('HDEL', KEYS[1], username)
+        end
+    end
+    deleted = deleted + redis.call('DEL', key)
+    redis.call('SREM', KEYS[2], user_id)
+    redis.call('SREM', KEYS[3], user_id)
+    redis.call('ZREM', KEYS[4], user_id)
+end
+return deleted
+"""
+_delete_users = client.register_script(_DELETE_USERS_SCRIPT)
+
+# Take up to ARGV[1] users out of the active-players index and mark
+# their records inactive.
+# KEYS[1] = active index, ARGV[1] = batch size, ARGV[2] = key prefix
+_DEACTIVATE_USERS_SCRIPT = """
+local user_ids = redis.call('SPOP', KEYS[1], ARGV[1])
+for _, user_id in ipairs(user_ids) do
+    local key = ARGV[2] .. user_id
+    if redis.call('TYPE', key).ok == 'hash' then
+        redis.call('HSET', key, 'status', 'inactive')
+    end
+end
+return #user_ids
+"""
+_deactivate_users = client.register_script(_DEACTIVATE_USERS_SCRIPT)
+
+# Index users from their records, each read and indexed in a single
+# atomic step (see rebuild_user_indexes).
+# KEYS = username, user and active indexes
+# ARGV[1] = record key prefix, ARGV[2..] = user_ids
+_INDEX_USERS_SCRIPT = """
+local indexed = 0
+for i = 2, #ARGV do
+    local user_id = ARGV[i]
+    local key = ARGV[1] .. user_id
+    if redis.call('TYPE', key).ok == 'hash' then
+        local record = redis.call('HMGET', key, 'username', 'status')
+        if record[1] then
+            redis.call('HSET', KEYS[1], record[1], user_id)
+            redis.call('SADD', KEYS[2], user_id)
+            if record[2] == 'active' then
+                redis.call('SADD', KEYS[3], user_id)
+            else
+                redis.call('SREM', KEYS[3], user_id)
+            end
+            indexed = indexed + 1
+        end
+    end
+end
+return indexed
+"""
+_index_users = client.register_script(_INDEX_USERS_SCRIPT)
+
+# Remove the index entries their records no longer back, each checked
+# and removed in a single atomic step (see rebuild_user_indexes).
+# KEYS[1] = the index, ARGV[1] = record key prefix, ARGV[2] = the
+# index's kind: 'username' (ARGV[3..] = username, user_id pairs),
+# 'user' or 'active' (ARGV[3..] = user_ids)
+_PRUNE_INDEX_SCRIPT = """
+local function field(key, name)
+    if redis.call('TYPE', key).ok ~= 'hash' then
+        return false
+    end
+    return redis.call('HGET', key, name)
+end
+
+local removed = 0
+if ARGV[2] == 'username' then
+    for i = 3, #ARGV, 2 do
+        local username, user_id = ARGV[i], ARGV[i + 1]
+        if redis.call('HGET', KEYS[1], username) == user_id
+                and field(ARGV[1] .. user_id, 'username') ~= username then
+            removed = removed + redis.call('HDEL', KEYS[1], username)
+        end
+    end
+else
+    for i = 3, #ARGV do
+        local user_id = ARGV[i]
+        local key = ARGV[1] .. user_id
+        local stale
+        if ARGV[2] == 'active' then
+            stale = field(key, 'status') ~= 'active'
+        else
+            stale = not field(key, 'username')
+        end
+        if stale then
+            removed = removed + redis.call('SREM', KEYS[1], user_id)
+        end
+    end
+end
+return removed
+"""
+_prune_index = client.register_script(_PRUNE_INDEX_SCRIPT)
+
+def _to_number(value):
+    """
+    Read a stored coordinate as a float. Values that aren't numbers
+    (missing or empty fields) are returned unchanged.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+def user_key(user_id):
+    """
+    Build the Redis key holding a user's record.
+
+    Args:
+        user_id (str): The user's unique identifier.
+
+    Returns:
+        str: The key, e.g. 'users:1001'.
+    """
+    return f"users:{user_id}"
+
+def _index_user(pipe, user_id, username, status):
+    """
+    Queue the index updates for a user on a pipeline.
+
+    Args:
+        pipe (redis.client.Pipeline): The pipeline to queue commands on.
+        user_id (str): The user's unique identifier.
+        username (str): The user's username.
+        status (str): The user's status ('active' or 'inactive').
+    """
+    pipe.hset(USERNAME_INDEX, username, user_id)
+    pipe.sadd(USER_INDEX, user_id)
+    if status == "active":
+        pipe.sadd(ACTIVE_INDEX, user_id)
+    else:
+        pipe.srem(ACTIVE_INDEX, user_id)
+
+def _touch(pipe, user_ids, nx=False):
+    """
+    Queue the update of the users' last-seen times (now) on a pipeline.
+
+    Args:
+        pipe (redis.client.Pipeline): The pipeline to queue commands on.
+        user_ids (iterable): The user identifiers.
+        nx (bool): Only set the users not seen yet.
+    """
+    last_seen = dict.fromkeys((str(user_id) for user_id in user_ids), time.time())
+    if last_seen:
+        pipe.zadd(LAST_SEEN_INDEX, last_seen, nx=nx)
+
+def _set_fields(user_id, fields):
+    """
+    Atomically overwrite some fields of an existing user record.
+
+    Args:
+        user_id (str): The user's unique identifier.
+        fields (dict): Field name -> new value.
+
+    Returns:
+        bool: False if the user does not exist.
+    """
+    args = []
+    for field, value in fields.items():
+        args.extend((field, value))
+    # Run on the current client, which may have been replaced since
+    # the script was registered
+    return _update_fields(keys=[user_key(user_id)], args=args, client=client) != -1
+
+@timed(REDIS_LATENCY, "add_user")
+def add_user(user_id, username, password, status, latitude, longitude, role):
+    """
+    Store a new user's record, unless the user id or the username is
+    already taken. Existing records are left as they are.
+
+    Args:
+        user_id (str): The user's unique identifier.
+        username (str): The user's username.
+        password (str): The user's password (or its hash).
+        status (str): The user's status ('active' or 'inactive').
+        latitude (float): The user's latitude.
+        longitude (float): The user's longitude.
+        role (str): The user's role.
+
+    Returns:
+        bool: True if the user was added.
+    """
+    user_data = [username, password, status, _to_number(latitude), _to_number(longitude), role]
+    key = user_key(user_id)
+
+    def add(pipe):
+        if pipe.exists(key) or pipe.hexists(USERNAME_INDEX, username):
+            return False
+        pipe.multi()
+        pipe.hset(key, mapping=dict(zip(USER_FIELDS, user_data)))
+        _index_user(pipe, user_id, username, status)
+        _touch(pipe, [user_id])
+        return True
+
+    return client.transaction(add, key, USERNAME_INDEX, value_from_callable=True)
+
+@timed(REDIS_LATENCY, "store_user_location")
 def store_user_location(user_id, username, password, status, latitude, longitude, role):
     """
-    Store the user's location as a list in Redis.
+    Store the user's record as a hash in Redis.
 
     Args:
         user_id (str): The user's unique identifier.
@@ -18,13 +335,69 @@ def store_user_location(user_id, username, password, status, latitude, longitude
         longitude (float): The user's longitude.
         role (str): The user's role.
     """
-    # List of user data
-    print("Inside store_user user_id ", user_id)
-    user_data = [username, password, status, latitude, longitude, role]
-    key = f"users:{user_id}"
-    client.delete(key)
-    client.rpush(key, *user_data)
+    user_data = [username, password, status, _to_number(latitude), _to_number(longitude), role]
+    key = user_key(user_id)
+
+    pipe = client.pipeline()
+    pipe.delete(key)
+    pipe.hset(key, mapping=dict(zip(USER_FIELDS, user_data)))
+    _index_user(pipe, user_id, username, status)
+    _touch(pipe, [user_id])
+    pipe.execute()
 
+def _migrate_record(key):
+    """
+    Convert a legacy list record (the pre-hash schema, fields in
+    USER_FIELDS order) into a hash, in place.
+
+    Args:
+        key (str): The record key, e.g. 'users:1001'.
+
+    Returns:
+        list: The record's fields, or an empty list if the key does
+        not hold a legacy record.
+    """
+    def convert(pipe):
+        if pipe.type(key) != "list":
+            return []
+        data = pipe.lrange(key, 0, -1)
+        pipe.multi()
+        pipe.delete(key)
+        pipe.hset(key, mapping=dict(zip(USER_FIELDS, data)))
+        return data
+
+    data = client.transaction(convert, key, value_from_callable=True)
+    return _record_to_list(data[:len(USER_FIELDS)]) if data else []
+
+def migrate_user_records():
+    """
+    Convert every legacy users:{id} list into the hash schema.
+
+    Records are also migrated lazily when fetch_user_data() meets one,
+    so this only needs to be run once (by 'flask migrate-users').
+
+    Returns:
+        int: The number of records migrated.
+    """
+    migrated = 0
+    for key in client.scan_iter(match='users:*', _type='list'):
+        if _migrate_record(key):
+            migrated += 1
+    return migrated
+
+def _record_to_list(values):
+    """
+    Turn the HMGET reply for USER_FIELDS into the list layout used by
+    callers, or an empty list for a missing record.
+    """
+    if all(value is None for value in values):
+        return []
+    data = list(values)
+    data[3] = _to_number(data[3])
+    data[4] = _to_number(data[4])
+    return data
+
+@timed(REDIS_LATENCY, "fetch_user_data")
 def fetch_user_data(user_id):
     """
     Fetch the user's data from Redis.
@@ -33,138 +406,442 @@ def fetch_user_data(user_id):
         user_id (str): The user's unique identifier.
 
     Returns:
-        list: A list containing the latitude and longitude.
+        list: [username, password, status, latitude, longitude, role],
+        with the coordinates as floats, or an empty list if the user
+        does not exist.
     """
-    key = f"users:{user_id}"
-    print(key)
-    data = client.lrange(key, 0, -1)
-    print("Len of data and data: ", len(data), data)
+    key = user_key(user_id)
+    data = _record_to_list(client.hmget(key, USER_FIELDS))
+
+    # Not found as a hash, it may still be stored with the old schema
+    if not data:
+        data = _migrate_record(key)
+
     return data
 
+def _fetch_many(user_ids):
+    """
+    Fetch the records of several users in a single round trip.
+
+    Args:
+        user_ids (list): The user identifiers to fetch.
+
+    Returns:
+        list: One record (list) per user_id, in the same order.
+    """
+    pipe = client.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.hmget(user_key(user_id), USER_FIELDS)
+    return [_record_to_list(values) for values in pipe.execute()]
+
+@timed(REDIS_LATENCY, "get_active_users")
 def get_active_users():
     """
     Fetches all active users from redis db
+
+    Only the members of the active-players index are read, so the cost
+    grows with the number of players in the game and not with the
+    number of accounts ever created.
     """
-    cursor = '0'
+    user_ids = sorted(client.smembers(ACTIVE_INDEX))
     active_users = []
 
-    while True:
-        cursor, keys = client.scan(cursor=cursor, match='users:*')
-        for key in keys:
-            user_data = client.lrange(key, 0, -1)  # Get the entire list
-            # user_data = [item.decode('utf-8') for item in user_data]
+    for user_id, user_data in zip(user_ids, _fetch_many(user_ids)):
+        if len(user_data) > 2 and user_data[2] == 'active':  # Status is the third element
+            active_users.append({user_id: user_data})
+
+    return active_users
 
-            # print(user_data)
-            if len(user_data) >2 and user_data[2] == 'active':  # Assuming status is the second element
-                active_users.append({key.split(':')[1]: user_data})
+def count_active_users():
+    """
+    Number of players in the active-players index.
+    """
+    return client.scard(ACTIVE_INDEX)
 
-        if cursor == 0:
-            break
+@timed(REDIS_LATENCY, "get_users")
+def get_users(user_ids):
+    """
+    Fetches the active users among the given user_ids from redis db
 
-    # print(active_users)
+    Args:
+        user_ids (iterable): The user identifiers to fetch.
 
-    return active_users
+    Returns:
+        list: One {user_id: user_data} dict per active user.
+    """
+    user_ids = sorted(user_ids)
+    users = []
+
+    for user_id, user_data in zip(user_ids, _fetch_many(user_ids)):
+        if len(user_data) > 2 and user_data[2] == 'active':
+            users.append({user_id: user_data})
+
+    return users
 
+@timed(REDIS_LATENCY, "get_all_users")
 def get_all_users():
     """
     Fetches all users from redis db
     """
-    cursor = '0'
+    user_ids = sorted(client.smembers(USER_INDEX))
     available_users = []
 
-    while True:
-        cursor, keys = client.scan(cursor=cursor, match='users:*')
-        for key in keys:
-            user_data = client.lrange(key, 0, -1)
-            available_users.append({key: user_data})
-
-        if cursor == 0:
-            break
-
-    # print(available_users)
+    for user_id, user_data in zip(user_ids, _fetch_many(user_ids)):
+        if user_data:
+            available_users.append({user_key(user_id): user_data})
 
     return available_users
 
+@timed(REDIS_LATENCY, "delete_user")
 def delete_user(user_id):
     """
     deletes a user with a particular user_id
     """
-    cursor = '0'
-
-    while True:
-        cursor, keys = client.scan(cursor=cursor, match='users:*')
-        for key in keys:
-            if key == 'users:'+ user_id:
-                user_data = client.lrange(key, 0, -1)
-                deleted_count = client.delete(key)
-                # Check if key was deleted
-                if deleted_count == 1:
-                    print(f"User with user_id {user_id} deleted successfully.")
-                else:
-                    print(f"User with user_id {user_id} not found.")
-                break
+    deleted_count = _delete_batch([user_id])
 
-        if cursor == 0:
-            print("No matching keys")
-            break
-
-    print("remaining users: ", get_all_users())
+    # Check if key was deleted
+    if deleted_count == 1:
+        logger.debug("User with user_id %s deleted successfully.", user_id)
+    else:
+        logger.debug("User with user_id %s not found.", user_id)
 
+@timed(REDIS_LATENCY, "update_user")
 def update_user(user_id, user_data):
     """
     updates a user with a particular user_id
     """
-    cursor = '0'
+    key = user_key(user_id)
+    old_username = client.hget(key, "username")
 
-    while True:
-        cursor, keys = client.scan(cursor=cursor, match='users:*')
-        for key in keys:
-            # print("key : ", key, " user_id: ", user_id)
-            if key.split(':')[1] == user_id:
-                user_data_new = [user_data[0], user_data[1], user_data[2], user_data[3], user_data[4], user_data[5]]
-                print("user_data_new: ", user_data_new)
-                store_user_location(key.split(':')[1], *user_data_new)
-                print("updated user succesfully! ", user_data_new)
-                break
+    # Only existing users are updated
+    if old_username is None:
+        return
 
-        if cursor == 0:
-            break
-    
+    user_data_new = [user_data[0], user_data[1], user_data[2], user_data[3], user_data[4], user_data[5]]
+    if old_username != user_data_new[0]:
+        client.hdel(USERNAME_INDEX, old_username)
+
+    store_user_location(user_id, *user_data_new)
+    logger.debug("Updated user %s", user_id)
+
+@timed(REDIS_LATENCY, "set_user_status")
+def set_user_status(user_id, status, role=None):
+    """
+    Change a user's status (and optionally role) in place.
+
+    Used on login and logout; keeps the active-players index in sync
+    without rewriting the whole record.
+
+    Args:
+        user_id (str): The user's unique identifier.
+        status (str): The new status ('active' or 'inactive').
+        role (str, optional): The new role, left unchanged if None.
+
+    Returns:
+        bool: False if the user does not exist.
+    """
+    fields = {"status": status}
+    if role is not None:
+        fields["role"] = role
+
+    if not _set_fields(user_id, fields):
+        return False
+
+    if status == "active":
+        pipe = client.pipeline(transaction=False)
+        pipe.sadd(ACTIVE_INDEX, user_id)
+        _touch(pipe, [user_id])
+        pipe.execute()
+    else:
+        client.srem(ACTIVE_INDEX, user_id)
+    return True
+
+@timed(REDIS_LATENCY, "set_user_password")
+def set_user_password(user_id, password):
+    """
+    Replace a user's stored password (normally with its bcrypt hash).
+
+    Args:
+        user_id (str): The user's unique identifier.
+        password (str): The new stored password.
+
+    Returns:
+        bool: False if the user does not exist.
+    """
+    return _set_fields(user_id, {"password": password})
+
+@timed(REDIS_LATENCY, "get_user_credentials")
 def get_user_credentials(user_name):
-    all_users = get_all_users()
     user_credentials = ["","",""]
-    print(all_users)
-    for user in all_users:
-        for k,v in user.items():
-            if user_name == v[0]:
-                user_credentials = [k.split(':')[1], user_name, v[1]]
-                break
-    print(user_credentials)
+
+    user_id = client.hget(USERNAME_INDEX, user_name)
+    if user_id is not None:
+        username, password = client.hmget(user_key(user_id), ("username", "password"))
+        if username == user_name:
+            user_credentials = [user_id, user_name, password]
+
     return user_credentials
 
+def rebuild_user_indexes(batch_size=BATCH_SIZE):
+    """
+    Rebuild the username, user and active-players indexes from the
+    users:{id} records.
+
+    This is the only place that still SCANs the keyspace. It is meant
+    to be run once by 'flask migrate-users' (after
+    migrate_user_records()), to pick up records written before the
+    indexes existed.
+
+    The records are merged into the live indexes, then the entries no
+    records back are removed, one Lua call per batch. Each user is
+    read and (un)indexed in one atomic step, so the servers using the
+    indexes meanwhile never miss a user, and the users added, logging
+    in or out during the rebuild keep their entries.
+
+    Args:
+        batch_size (int): Users handled per round trip.
+
+    Returns:
+        int: The number of user records indexed.
+    """
+    indexes = [USERNAME_INDEX, USER_INDEX, ACTIVE_INDEX]
+    indexed = 0
+
+    cursor = 0
+    while True:
+        cursor, keys = client.scan(cursor=cursor, match='users:*', count=batch_size, _type='hash')
+        user_ids = [key.split(':', 1)[1] for key in keys]
+        if user_ids:
+            indexed += _index_users(keys=indexes, args=[user_key(""), *user_ids], client=client)
+
+            # Records written before the last-seen times were kept count
+            # as seen now
+            pipe = client.pipeline(transaction=False)
+            _touch(pipe, user_ids, nx=True)
+            pipe.execute()
+
+        if cursor == 0:
+            break
+
+    for batch in _batches(client.hscan_iter(USERNAME_INDEX, count=batch_size), batch_size):
+        _prune_index(
+            keys=[USERNAME_INDEX], 
+            args=[user_key(""), "username", *(value for entry in batch for value in entry)], 
+            client=client
+        )
+    for index, kind in ((USER_INDEX, "user"), (ACTIVE_INDEX, "active")):
+        for batch in _batches(client.sscan_iter(index, count=batch_size), batch_size):
+            _prune_index(keys=[index], args=[user_key(""), kind, *batch], client=client)
+
+    return indexed
+
+@timed(REDIS_LATENCY, "update_location")
 def update_location(user_id, latitude, longitude, role):
-    user_data = fetch_user_data(user_id)
-    print("within-> before updating location: user_data", user_data)
-    #change latitude
-    user_data[3] = latitude
-    #change longitude
-    user_data[4] = longitude
-    #change longitude
-    user_data[5] = role
-    
-    user_data_new = user_data[:6]
-    print("within -> after updating location: user_data", user_data_new)
-    store_user_location(user_id, *user_data_new)
+    """
+    Update a player's position and role.
+
+    Only the changed fields are written, atomically and in the same
+    round trip as the last-seen time, so concurrent pings can no
+    longer overwrite each other's records.
+
+    Args:
+        user_id (str): The user's unique identifier.
+        latitude (float): The user's latitude.
+        longitude (float): The user's longitude.
+        role (str): The user's role.
 
-    print("Location for the user: ", user_data[0], " updated successfully!")
+    Returns:
+        bool: False if the user does not exist.
+    """
+    pipe = client.pipeline(transaction=False)
+    _update_fields(
+        keys=[user_key(user_id)], 
+        args=["latitude", _to_number(latitude), "longitude", _to_number(longitude), "role", role], 
+        client=pipe
+    )
+    _touch(pipe, [user_id])
+    return pipe.execute()[0] != -1
     
+@timed(REDIS_LATENCY, "update_locations")
+def update_locations(locations):
+    """
+    Update the location and role of many users in one round trip.
+    Unknown users are skipped.
+
+    Args:
+        locations (iterable): (user_id, latitude, longitude, role) tuples.
+    """
+    pipe = client.pipeline(transaction=False)
+    user_ids = []
+    for user_id, latitude, longitude, role in locations:
+        _update_fields(
+            keys=[user_key(user_id)], 
+            args=["latitude", _to_number(latitude), "longitude", _to_number(longitude), "role", role], 
+            client=pipe
+        )
+        user_ids.append(user_id)
+    _touch(pipe, user_ids)
+    pipe.execute()
+
+@timed(REDIS_LATENCY, "fetch_user_location")
 def fetch_user_location(user_id):
-    print("Inside fetch_user_location user_id ", user_id)
-    user_data = fetch_user_data(user_id)
-    print(user_data)
-    location = (user_data[3], user_data[4])
-    # print(location)
-    return location
+    location = tuple(client.hmget(user_key(user_id), ("latitude", "longitude")))
+    if location == (None, None):
+        user_data = fetch_user_data(user_id)
+        return (user_data[3], user_data[4])
+    return (_to_number(location[0]), _to_number(location[1]))
+
+def _batches(iterable, size):
+    """
+    Split an iterable into lists of at most 'size' items, reading it
+    lazily.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def _delete_batch(user_ids):
+    """
+    Delete users and their index entries, in one round trip.
+
+    Returns:
+        int: The number of records deleted.
+    """
+    return _delete_users(
+        keys=[USERNAME_INDEX, USER_INDEX, ACTIVE_INDEX, LAST_SEEN_INDEX], 
+        args=[user_key(""), *user_ids], 
+        client=client
+    )
+
+@timed(REDIS_LATENCY, "import_users")
+def import_users(users, batch_size=BATCH_SIZE):
+    """
+    Store many users, one pipelined transaction per batch. Like
+    store_user_location(), existing records are replaced.
+
+    The users are read lazily, so a generator can feed an import of
+    any size.
+
+    Args:
+        users (iterable): (user_id, username, password, status,
+            latitude, longitude, role) tuples.
+        batch_size (int): Users written per round trip.
+
+    Returns:
+        int: The number of users stored.
+    """
+    stored = 0
+    for batch in _batches(users, batch_size):
+        pipe = client.pipeline()
+        for user_id, username, password, status, latitude, longitude, role in batch:
+            key = user_key(user_id)
+            pipe.delete(key)
+            pipe.hset(key, mapping=dict(zip(
+                USER_FIELDS, 
+                [username, password, status, _to_number(latitude), _to_number(longitude), role]
+            )))
+            _index_user(pipe, user_id, username, status)
+        _touch(pipe, [user[0] for user in batch])
+        pipe.execute()
+        stored += len(batch)
+
+    logger.info("Imported %d users", stored)
+    return stored
+
+def iter_users(batch_size=BATCH_SIZE):
+    """
+    Iterate over every user with a cursor (SSCAN of the user index),
+    fetching the records one batch per round trip, so the whole set is
+    never held in memory.
+
+    As with any SSCAN, a user added or removed during the iteration may
+    be missed, and a user may (rarely) come up twice.
+
+    Args:
+        batch_size (int): Users fetched per round trip (a hint).
+
+    Yields:
+        tuple: (user_id, user_data) for every existing user, user_data
+        being the record as a list (see fetch_user_data).
+    """
+    for user_ids in _batches(client.sscan_iter(USER_INDEX, count=batch_size), batch_size):
+        for user_id, user_data in zip(user_ids, _fetch_many(user_ids)):
+            if user_data:
+                yield user_id, user_data
+
+@timed(REDIS_LATENCY, "delete_users")
+def delete_users(user_ids, batch_size=BATCH_SIZE):
+    """
+    Delete many users (and their index entries), one Lua call per
+    batch.
+
+    Args:
+        user_ids (iterable): The user identifiers.
+        batch_size (int): Users deleted per round trip.
+
+    Returns:
+        int: The number of users deleted.
+    """
+    deleted = 0
+    for batch in _batches(user_ids, batch_size):
+        deleted += _delete_batch(batch)
+    return deleted
+
+@timed(REDIS_LATENCY, "reset_user_statuses")
+def reset_user_statuses(batch_size=BATCH_SIZE):
+    """
+    Mark every active user inactive (e.g. after a match) and empty the
+    active-players index, one Lua call per batch.
+
+    Args:
+        batch_size (int): Users handled per round trip.
+
+    Returns:
+        int: The number of users deactivated.
+    """
+    reset = 0
+    while True:
+        count = _deactivate_users(
+            keys=[ACTIVE_INDEX], 
+            args=[batch_size, user_key("")], 
+            client=client
+        )
+        reset += count
+        if count < batch_size:
+            break
+
+    logger.info("Reset the status of %d users", reset)
+    return reset
+
+@timed(REDIS_LATENCY, "expire_stale_users")
+def expire_stale_users(max_age, batch_size=BATCH_SIZE, now=None):
+    """
+    Delete the users not seen (no login, location update or import)
+    for 'max_age' seconds, oldest first, one batch per round trip.
+
+    Args:
+        max_age (float): Seconds since the user was last seen.
+        batch_size (int): Users deleted per round trip.
+        now (float, optional): The current UNIX time.
+
+    Returns:
+        int: The number of users deleted.
+    """
+    cutoff = (time.time() if now is None else now) - max_age
+    deleted = 0
+    while True:
+        user_ids = client.zrangebyscore(LAST_SEEN_INDEX, "-inf", cutoff, start=0, num=batch_size)
+        if not user_ids:
+            break
+
+        # The script takes them out of the last-seen index too
+        deleted += _delete_batch(user_ids)
+
+    logger.info("Expired %d users not seen for %s seconds", deleted, max_age)
+    return deleted
 # User data
 # user_id = 1003
 # username = "john_doe"
@@ -0,0 +1,700 @@
+import time
+import uuid
+import threading
+from collections import deque
+from distance_lib import equirectangular
+
+# Game id used when a client does not say which game it is playing
+DEFAULT_GAME_ID = "default"
+
+# Default game duration (in seconds)
+DEFAULT_GAME_DURATION = 5 * 60
+
+# Default number of broadcast ticks a room remembers, for the clients
+# catching up after a reconnect
+DEFAULT_DELTA_HISTORY = 300
+
+def channel_name(game_id, role=None, encoding=None):
+    """
+    Name of the Socket.IO room that reaches every player of a game,
+    or only the players with the given role (and, for the position
+    broadcasts, the given wire encoding).
+
+    Args:
+        game_id (str): The game's unique identifier.
+        role (str, optional): 'cop' or 'mafia'.
+        encoding (str, optional): 'packed' for the clients that asked
+            for the packed encoding (see wire_lib), JSON otherwise.
+
+    Returns:
+        str: The room name, e.g. 'game:default', 'game:default:cop'
+        or 'game:default:cop:packed'.
+    """
+    if role is None:
+        return f"game:{game_id}"
+    if encoding == "packed":
+        return f"game:{game_id}:{role}:packed"
+    return f"game:{game_id}:{role}"
+
+class PlayerState:
+    """
+    Latest known state of one player in a room.
+    """
+    __slots__ = ("player_id", "role", "latitude", "longitude")
+
+    def __init__(self, player_id, role, latitude, longitude):
+        self.player_id = player_id
+        self.role = role
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def to_dict(self):
+        """
+        The player as sent to the clients (see the 'all_users' and
+        'positions_delta' events).
+        """
+        return {
+            'role': self.role,
+            'latitude': self.latitude,
+            'longitude': self.longitude
+        }
+
+class MemoryRoomStore:
+    """
+    Shared state of a game (members, eliminations, cop, outcome) kept
+    in this process. Only suitable for a single server.
+    """
+
+    def __init__(self):
+        self.meta = {}
+        self.member_ids = set()
+        self.member_roles = {}
+        self.eliminated_ids = set()
+        self.mutex = threading.RLock()
+
+    def claim(self, field, value):
+        with self.mutex:
+            if field in self.meta:
+                return False
+            self.meta[field] = value
+            return True
+
+    def get(self, field):
+        return self.meta.get(field)
+
+    def release(self, field, value):
+        with self.mutex:
+            if self.meta.get(field) == value:
+                del self.meta[field]
+
+    def add_member(self, player_id, role=None):
+        with self.mutex:
+            self.member_ids.add(player_id)
+            if role is not None:
+                self.member_roles[player_id] = role
+
+    def remove_member(self, player_id):
+        with self.mutex:
+            self.member_ids.discard(player_id)
+            self.member_roles.pop(player_id, None)
+
+    def members(self):
+        with self.mutex:
+            return set(self.member_ids)
+
+    def roles(self):
+        with self.mutex:
+            return dict(self.member_roles)
+
+    def role(self, player_id):
+        return self.member_roles.get(player_id)
+
+    def eliminate(self, player_id):
+        with self.mutex:
+            if player_id in self.eliminated_ids:
+                return False
+            self.eliminated_ids.add(player_id)
+            return True
+
+    def is_eliminated(self, player_id):
+        return player_id in self.eliminated_ids
+
+    def eliminated(self):
+        with self.mutex:
+            return set(self.eliminated_ids)
+
+    def lock(self):
+        return self.mutex
+
+    def close(self, start_time):
+        with self.mutex:
+            if self.meta.get("start_time") != start_time:
+                return
+            self.meta.clear()
+            self.member_ids.clear()
+            self.member_roles.clear()
+            self.eliminated_ids.clear()
+
+class RedisRoomStore:
+    """
+    Shared state of a game kept in Redis, so that every server behind
+    the load balancer sees the same members, eliminations, cop and
+    outcome, and serializes the elimination checks on a Redis lock.
+
+    Keys (all expire 'ttl' seconds after the last write):
+        room:{game_id}             hash: cop, outcome, start_time
+        room:{game_id}:members     set of player_ids
+        room:{game_id}:roles       hash: player_id -> role the player joined with
+        room:{game_id}:eliminated  set of player_ids
+        room:{game_id}:lock        the distributed lock
+    """
+
+    # Delete a hash field only if it still holds the given value
+    # KEYS[1] = hash key, ARGV[1] = field, ARGV[2] = value
+    RELEASE_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+    # Delete the game's keys, unless a new game started under the
+    # same id since (its start time differs)
+    # KEYS[1] = hash key, KEYS[2..] = the other keys, ARGV[1] = start time
+    CLOSE_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'start_time') == ARGV[1] then
+    return redis.call('DEL', unpack(KEYS))
+end
+return 0
+"""
+
+    def __init__(self, client, game_id, ttl, lock_timeout=5):
+        """
+        Args:
+            client (redis.Redis): The Redis client to use.
+            game_id (str): The game's unique identifier.
+            ttl (int): Seconds the game's keys live after a write.
+            lock_timeout (float): Seconds the lock is held at most, and
+                also waited for at most.
+        """
+        self.client = client
+        self.ttl = int(ttl)
+        self.lock_timeout = lock_timeout
+        self.key = f"room:{game_id}"
+        self.members_key = f"{self.key}:members"
+        self.roles_key = f"{self.key}:roles"
+        self.eliminated_key = f"{self.key}:eliminated"
+        self.lock_key = f"{self.key}:lock"
+        self.release_field = client.register_script(self.RELEASE_SCRIPT)
+        self.delete_game = client.register_script(self.CLOSE_SCRIPT)
+
+    def _write(self, command, key, *args):
+        # Run one write command and push the key's expiry back
+        pipe = self.client.pipeline()
+        getattr(pipe, command)(key, *args)
+        pipe.expire(key, self.ttl)
+        return pipe.execute()[0]
+
+    def claim(self, field, value):
+        return self._write("hsetnx", self.key, field, value) == 1
+
+    def get(self, field):
+        return self.client.hget(self.key, field)
+
+    def release(self, field, value):
+        self.release_field(keys=[self.key], args=[field, value])
+
+    def add_member(self, player_id, role=None):
+        pipe = self.client.pipeline()
+        pipe.sadd(self.members_key, player_id)
+        pipe.expire(self.members_key, self.ttl)
+        if role is not None:
+            pipe.hset(self.roles_key, player_id, role)
+            pipe.expire(self.roles_key, self.ttl)
+        pipe.execute()
+
+    def remove_member(self, player_id):
+        pipe = self.client.pipeline()
+        pipe.srem(self.members_key, player_id)
+        pipe.hdel(self.roles_key, player_id)
+        pipe.execute()
+
+    def members(self):
+        return self.client.smembers(self.members_key)
+
+    def roles(self):
+        return self.client.hgetall(self.roles_key)
+
+    def role(self, player_id):
+        return self.client.hget(self.roles_key, player_id)
+
+    def eliminate(self, player_id):
+        return self._write("sadd", self.eliminated_key, player_id) == 1
+
+    def is_eliminated(self, player_id):
+        return bool(self.client.sismember(self.eliminated_key, player_id))
+
+    def eliminated(self):
+        return self.client.smembers(self.eliminated_key)
+
+    def lock(self):
+        return self.client.lock(
+            self.lock_key, 
+            timeout = self.lock_timeout, 
+            blocking_timeout = self.lock_timeout
+        )
+
+    def close(self, start_time):
+        self.delete_game(
+            keys=[self.key, self.members_key, self.roles_key, self.eliminated_key], 
+            args=[start_time]
+        )
+
+class GameRoom:
+    """
+    State of one game: who plays which role, where every player is,
+    and how the game ended.
+
+    What must agree across servers (members, eliminations, cop and
+    outcome) lives in the room's store. Player positions and the
+    broadcast bookkeeping are kept per process, under room.lock.
+    Decisions that change the game (eliminations, the outcome) are
+    taken under room.game_lock(), which is shared by every server
+    when the store is a RedisRoomStore.
+    """
+
+    def __init__(self, game_id, geo_index, store, duration=DEFAULT_GAME_DURATION, clock=time.time, history=DEFAULT_DELTA_HISTORY):
+        """
+        Args:
+            game_id (str): The game's unique identifier.
+            geo_index (RedisGeoIndex or MemoryGeoIndex): Positions of
+                this room's players, used for the elimination checks.
+            store (MemoryRoomStore or RedisRoomStore): The game's
+                shared state.
+            duration (float): Game duration in seconds.
+            clock (callable): Returns the current time in seconds.
+            history (int): Number of broadcast ticks remembered for
+                the clients catching up (see deltas_since).
+        """
+        self.game_id = game_id
+        self.geo_index = geo_index
+        self.store = store
+        self.duration = duration
+        self.clock = clock
+
+        # The first server to open the game sets its start time,
+        # which also tells this game apart from the later ones
+        # played under the same id (see close)
+        store.claim("start_time", clock())
+        self.started = store.get("start_time")
+        self.start_time = float(self.started)
+
+        self.lock = threading.RLock()
+        self.players = {}          # player_id -> PlayerState
+        self.peer_updates = {}     # key -> when the last rate-limited update went out
+        self.cached_outcome = None
+
+        # Position broadcasts are batched: players that changed since
+        # the last tick, what was last sent for each player, and the
+        # mafia updates waiting for the next (slower) mafia peer update
+        self.dirty = set()
+        self.last_sent = {}        # player_id -> (role, latitude, longitude)
+        self.pending_peer = {}
+
+        # Every tick that sends something gets the next sequence number.
+        # The epoch tells this process' copy of the room apart from the
+        # other servers' (their sequence numbers mean something else)
+        self.epoch = uuid.uuid4().hex[:8]
+        self.sequence = 0
+        self.history = deque(maxlen=history)   # (sequence, role -> delta, removals)
+        self.removals = False      # players removed since the last tick
+
+    @property
+    def cop(self):
+        return self.store.get("cop")
+
+    @property
+    def members(self):
+        return self.store.members()
+
+    @property
+    def outcome(self):
+        """
+        None while playing, then 'cop_wins' or 'cop_loses'. An outcome
+        never changes once set, so it is cached.
+        """
+        if self.cached_outcome is None:
+            self.cached_outcome = self.store.get("outcome")
+        return self.cached_outcome
+
+    @property
+    def finished(self):
+        return self.outcome is not None
+
+    def finish(self, outcome):
+        """
+        End the game, unless it already ended (possibly on another
+        server).
+
+        Returns:
+            bool: True if this call ended the game.
+        """
+        if self.store.claim("outcome", outcome):
+            self.cached_outcome = outcome
+            return True
+        self.cached_outcome = self.store.get("outcome")
+        return False
+
+    def game_lock(self):
+        return self.store.lock()
+
+    def time_left(self):
+        return max(0.0, self.start_time + self.duration - self.clock())
+
+    def close(self):
+        """
+        Free the game once it is over: its shared state (so that the
+        game id can host a new game), the positions and the broadcast
+        history. The store is left alone if a new game already started
+        under the same id, possibly on another server.
+        """
+        self.store.close(self.started)
+        self.geo_index.clear()
+        with self.lock:
+            self.players.clear()
+            self.peer_updates.clear()
+            self.dirty.clear()
+            self.last_sent.clear()
+            self.pending_peer.clear()
+            self.history.clear()
+
+    def assign_role(self, player_id):
+        """
+        The first player to ask becomes the cop, everybody else is mafia.
+
+        Args:
+            player_id (str): The player's unique identifier.
+
+        Returns:
+            str: The assigned role.
+        """
+        if self.store.claim("cop", player_id) or self.store.get("cop") == player_id:
+            role = "cop"
+        else:
+            role = "mafia"
+        self.store.add_member(player_id, role)
+        return role
+
+    def join(self, player_id, role=None):
+        """
+        Add a player to the game, with the role they play (if known),
+        before they send their first position.
+        """
+        self.store.add_member(player_id, role)
+
+    def role_of(self, player_id):
+        """
+        The role a member joined the game with (see join), or None.
+        """
+        return self.store.role(player_id)
+
+    def leave(self, player_id):
+        self.store.remove_member(player_id)
+        self.store.release("cop", player_id)
+        self.drop(player_id)
+
+    def drop(self, player_id):
+        """
+        Remove a player (who left or was eliminated) from this process'
+        copy of the room, without touching the store.
+        """
+        with self.lock:
+            if self.players.pop(player_id, None) is not None:
+                self.removals = True
+            self._forget(player_id)
+        self.geo_index.remove(player_id)
+
+    def _forget(self, player_id):
+        # Caller holds self.lock
+        self.dirty.discard(player_id)
+        self.last_sent.pop(player_id, None)
+        self.pending_peer.pop(player_id, None)
+
+    def update_player(self, player_id, role, latitude, longitude, broadcast=True):
+        """
+        Record a player's latest role and position.
+
+        Args:
+            broadcast (bool): Send the change with the next tick (see
+                role_deltas). Only the server that took the player's
+                ping broadcasts it: the clients of every server get it
+                through the Socket.IO message queue, the other servers
+                only learn the position.
+
+        Returns:
+            PlayerState: The player's state.
+        """
+        with self.lock:
+            player = self.players.get(player_id)
+            if player is None:
+                player = self.players[player_id] = PlayerState(player_id, role, latitude, longitude)
+            elif (player.role, player.latitude, player.longitude) != (role, latitude, longitude):
+                player.role = role
+                player.latitude = latitude
+                player.longitude = longitude
+            else:
+                return player
+            if broadcast:
+                self.dirty.add(player_id)
+            return player
+
+    def refresh(self, players):
+        """
+        Bring the room up to date with the stored players, dropping the
+        ones eliminated (possibly by another server). The positions are
+        not broadcast again, the servers that took them did.
+
+        Args:
+            players (iterable): (player_id, role, latitude, longitude)
+                tuples.
+        """
+        eliminated = self.store.eliminated()
+        with self.lock:
+            for player_id in eliminated.intersection(self.players):
+                self.players.pop(player_id)
+                self.removals = True
+                self._forget(player_id)
+
+            for player_id, role, latitude, longitude in players:
+                if player_id not in eliminated:
+                    self.update_player(player_id, role, latitude, longitude, broadcast=False)
+
+    def is_eliminated(self, player_id):
+        return self.store.is_eliminated(player_id)
+
+    def eliminate(self, player_id):
+        """
+        Take a mafia player out of the game.
+
+        Returns:
+            bool: False if the player was already eliminated.
+        """
+        eliminated = self.store.eliminate(player_id)
+        self.drop(player_id)
+        return eliminated
+
+    def peer_update_due(self, key, interval):
+        """
+        Rate-limit an update. Returns True (and restarts the interval)
+        at most once every 'interval' seconds per key.
+        """
+        now = self.clock()
+        with self.lock:
+            last = self.peer_updates.get(key)
+            if last is not None and now - last < interval:
+                return False
+            self.peer_updates[key] = now
+            return True
+
+    def collect_delta(self, epsilon):
+        """
+        Take the players that changed since the last call. Players that
+        moved less than 'epsilon' meters from the position last sent
+        (and kept their role) are left out.
+
+        Args:
+            epsilon (float): Smallest move worth sending, in meters.
+
+        Returns:
+            dict: player_id -> player state, as sent to the clients.
+        """
+        with self.lock:
+            delta = {}
+            for player_id in self.dirty:
+                player = self.players.get(player_id)
+                if player is None:
+                    continue
+
+                sent = self.last_sent.get(player_id)
+                if sent is not None and sent[0] == player.role and equirectangular(
+                    float(sent[1]), float(sent[2]), 
+                    float(player.latitude), float(player.longitude)
+                ) < epsilon:
+                    continue
+
+                self.last_sent[player_id] = (player.role, player.latitude, player.longitude)
+                delta[player_id] = player.to_dict()
+
+            self.dirty.clear()
+            return delta
+
+    def role_deltas(self, epsilon, peer_interval):
+        """
+        Split the changes since the last tick by audience. The cop gets
+        every change; the mafia get the cop's changes every tick but
+        each other's at most once every 'peer_interval' seconds.
+
+        Returns:
+            dict: role -> delta to send to that role (may be empty).
+        """
+        with self.lock:
+            delta = self.collect_delta(epsilon)
+
+            mafia_delta = {}
+            for player_id, state in delta.items():
+                if state['role'] == 'mafia':
+                    self.pending_peer[player_id] = state
+                else:
+                    mafia_delta[player_id] = state
+
+            if self.pending_peer and self.peer_update_due('mafia', peer_interval):
+                mafia_delta.update(self.pending_peer)
+                self.pending_peer.clear()
+
+            deltas = {'cop': delta, 'mafia': mafia_delta}
+            if delta or mafia_delta or self.removals:
+                self.sequence += 1
+                self.history.append((self.sequence, deltas, self.removals))
+                self.removals = False
+            return deltas
+
+    @property
+    def version(self):
+        """
+        Version of the room's broadcasts, as sent to the clients with
+        every 'positions_delta' and 'all_users', e.g. '3f2a9c1e:42'.
+        """
+        with self.lock:
+            return f"{self.epoch}:{self.sequence}"
+
+    def snapshot(self):
+        """
+        Every player's state (see recipients) and the version it
+        stands for.
+
+        Returns:
+            tuple: (players, version).
+        """
+        with self.lock:
+            return self.recipients(), self.version
+
+    def deltas_since(self, version, role):
+        """
+        What a client of the given role missed since it received the
+        given version, merged into one delta.
+
+        Args:
+            version (str): The last version the client received.
+            role (str): The client's role.
+
+        Returns:
+            tuple: (delta, version), or None if the client must get a
+            snapshot instead: the version is unknown (another server or
+            a restart), too old for the history, or players were removed
+            since (deltas do not carry removals).
+        """
+        epoch, _, sequence = str(version).partition(":")
+        try:
+            sequence = int(sequence)
+        except ValueError:
+            return None
+
+        with self.lock:
+            if epoch != self.epoch or sequence > self.sequence:
+                return None
+            if sequence < self.sequence and (not self.history or self.history[0][0] > sequence + 1):
+                return None
+
+            delta = {}
+            for entry_sequence, deltas, removals in self.history:
+                if entry_sequence <= sequence:
+                    continue
+                if removals:
+                    return None
+                delta.update(deltas.get(role, {}))
+            return delta, self.version
+
+    def mafia_players(self):
+        """
+        The mafia still in the game: the members who joined as mafia,
+        whether or not their position is known yet, and the players
+        whose position says mafia, less the eliminated ones.
+
+        Returns:
+            list: The player_ids.
+        """
+        mafia = {player_id for player_id, role in self.store.roles().items() if role == 'mafia'}
+        eliminated = self.store.eliminated()
+        with self.lock:
+            mafia.update(
+                player_id for player_id, player in self.players.items() if player.role == 'mafia'
+            )
+        return [player_id for player_id in mafia if player_id not in eliminated]
+
+    def recipients(self):
+        """
+        Every player's state, keyed by player_id, as sent to the clients.
+        """
+        with self.lock:
+            return {player_id: player.to_dict() for player_id, player in self.players.items()}
+
+class RoomRegistry:
+    """
+    All the games hosted by this process, keyed by game id.
+    """
+
+    def __init__(self, room_factory, on_create=None):
+        """
+        Args:
+            room_factory (callable): Builds a GameRoom from a game id.
+            on_create (callable, optional): Called with every new room,
+                e.g. to start its game clock.
+        """
+        self.room_factory = room_factory
+        self.on_create = on_create
+        self.rooms = {}
+        self.lock = threading.Lock()
+
+    def get(self, game_id):
+        return self.rooms.get(game_id)
+
+    def get_or_create(self, game_id=DEFAULT_GAME_ID):
+        room = self.rooms.get(game_id)
+        if room is not None:
+            return room
+
+        with self.lock:
+            room = self.rooms.get(game_id)
+            if room is None:
+                room = self.rooms[game_id] = self.room_factory(game_id)
+                created = True
+            else:
+                created = False
+
+        if created and self.on_create is not None:
+            self.on_create(room)
+        return room
+
+    def remove(self, game_id, room=None):
+        """
+        Stop hosting a game.
+
+        Args:
+            game_id (str): The game's unique identifier.
+            room (GameRoom, optional): Only remove this room, not a
+                newer one hosting the same game id.
+
+        Returns:
+            GameRoom: The removed room, or None.
+        """
+        with self.lock:
+            current = self.rooms.get(game_id)
+            if current is None or (room is not None and current is not room):
+                return None
+            return self.rooms.pop(game_id)
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def __iter__(self):
+        return iter(list(self.rooms.values()))
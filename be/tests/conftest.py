@@ -0,0 +1,107 @@
+# Shared fixtures of the test suite
+#
+# Run from the be/ directory:
+#   pip install -r requirements-dev.txt
+#   python -m pytest -q
+
+import pytest
+
+class FakeClock:
+    """
+    A clock that only moves when told to, for the classes that take a
+    'clock' argument.
+    """
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    """
+    An empty fakeredis database, used by redis_lib in place of Redis.
+    """
+    import fakeredis
+    import redis_lib
+
+    client = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(redis_lib, "client", client)
+    return client
+
+@pytest.fixture
+def server(request, redis_client, monkeypatch):
+    """
+    The gameserver module, configured against fakeredis, with the ping
+    filter and the journal off. The player cache is on unless the test
+    is parametrized with server="0" (indirect=True).
+
+    The broadcast ticker only ticks when a room opens, tests call
+    broadcast_tick() themselves.
+    """
+    monkeypatch.setenv("PLAYER_CACHE", getattr(request, "param", "1"))
+    monkeypatch.setenv("PING_FILTER", "0")
+    monkeypatch.setenv("JOURNAL", "0")
+    monkeypatch.setenv("TICK_RATE", "0.001")
+    monkeypatch.setenv("BCRYPT_LOG_ROUNDS", "4")
+    monkeypatch.delenv("SOCKETIO_ASYNC_MODE", raising=False)
+    monkeypatch.setenv("SECRET_KEY", "test-secret-key-of-at-least-32-bytes")
+
+    import gameserver
+
+    # Settings and singletons are read again by create_app()
+    monkeypatch.setattr(gameserver, "g", {})
+    monkeypatch.setattr(gameserver, "player_cache", None)
+    monkeypatch.setattr(gameserver, "journal", None)
+    monkeypatch.setattr(gameserver, "position_ticker", None)
+    gameserver.create_app({"TESTING": True})
+
+    yield gameserver
+
+    if gameserver.position_ticker is not None:
+        gameserver.position_ticker.stop()
+    if gameserver.player_cache is not None:
+        gameserver.player_cache.stop()
+    for room in gameserver.rooms:
+        gameserver.rooms.remove(room.game_id)
+        gameserver.game_clocks.cancel(room.game_id)
+
+@pytest.fixture
+def player(server):
+    """
+    Factory of users: player(user_id, name, role) stores an inactive
+    user whose password is their name, and returns the user_id.
+    """
+    import bcrypt
+    import redis_lib
+
+    def create(user_id, name, role="mafia"):
+        password_hash = bcrypt.hashpw(name.encode(), bcrypt.gensalt(4)).decode()
+        redis_lib.add_user(str(user_id), name, password_hash, "inactive", 0, 0, role)
+        return str(user_id)
+    return create
+
+@pytest.fixture
+def login(server):
+    """
+    login(name, role, game_id) logs a player in through '/login' and
+    returns the access token.
+    """
+    client = server.app.test_client()
+
+    def log_in(name, role, game_id="test"):
+        body, status = client.post(
+            "/login", 
+            json={"name": name, "password": name, "role": role, "game_id": game_id}
+        ).json
+        assert status == 200, body
+        return body["access_token"]
+    return log_in
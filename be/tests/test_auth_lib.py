@@ -0,0 +1,60 @@
+import bcrypt
+import threading
+import auth_lib
+from auth_lib import PasswordVerifier
+
+def verifier(clock, **options):
+    return PasswordVerifier(workers=1, log_rounds=4, clock=clock, **options)
+
+def password_hash(password):
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(4)).decode()
+
+def test_passwords_are_checked_against_their_hash(clock):
+    passwords = verifier(clock)
+    stored = password_hash("secret")
+    assert passwords.verify("user", "secret", stored)
+    assert not passwords.verify("user", "wrong", stored)
+    assert not passwords.verify("user", "secret", "")
+
+def test_successful_checks_are_remembered(clock, monkeypatch):
+    passwords = verifier(clock, cache_ttl=60)
+    stored = password_hash("secret")
+    assert passwords.verify("user", "secret", stored)
+
+    checks = []
+    checkpw = bcrypt.checkpw
+    monkeypatch.setattr(bcrypt, "checkpw", lambda *args: checks.append(args) or checkpw(*args))
+
+    assert passwords.verify("user", "secret", stored)
+    assert checks == []
+
+    # Wrong passwords are never remembered, nor passwords once expired
+    # or stored differently
+    assert not passwords.verify("user", "wrong", stored)
+    clock.advance(61)
+    assert passwords.verify("user", "secret", stored)
+    assert passwords.verify("user", "secret", password_hash("secret"))
+    assert len(checks) == 3
+
+def test_plaintext_passwords_are_upgraded(clock):
+    passwords = verifier(clock)
+    upgraded = []
+    done = threading.Event()
+
+    assert not passwords.verify("user", "wrong", "secret", upgrade=upgraded.append)
+    assert passwords.verify("user", "secret", "secret", upgrade=lambda new_hash: upgraded.append(new_hash) or done.set())
+    assert done.wait(5)
+    assert len(upgraded) == 1
+    assert auth_lib.is_password_hash(upgraded[0])
+    assert bcrypt.checkpw(b"secret", upgraded[0].encode())
+
+def test_failed_upgrades_are_logged(clock, monkeypatch):
+    passwords = verifier(clock)
+    logged = threading.Event()
+    monkeypatch.setattr(auth_lib.logger, "exception", lambda *args: logged.set())
+
+    def upgrade(new_hash):
+        raise ConnectionError("Redis is down")
+
+    assert passwords.verify("user", "secret", "secret", upgrade=upgrade)
+    assert logged.wait(5)
@@ -0,0 +1,60 @@
+from cache_lib import PlayerStateCache
+from geo_lib import GridGeoIndex
+from room_lib import GameRoom, RoomRegistry, MemoryRoomStore
+
+def cache_and_room(redis_client):
+    rooms = RoomRegistry(lambda game_id: None)
+    cache = PlayerStateCache(redis_client, rooms, save_locations=lambda locations: None, load_players=lambda room: [])
+    room = GameRoom("test", GridGeoIndex(), cache.wrap_store("test", MemoryRoomStore()))
+    rooms.rooms["test"] = room
+    return cache, room
+
+def positions(game_id, **players):
+    return {"node": "other", "game_id": game_id, "event": "positions", "players": players}
+
+def test_positions_of_members_are_applied(redis_client):
+    cache, room = cache_and_room(redis_client)
+    cache.apply({"node": "other", "game_id": "test", "event": "joined", "player_id": "1", "role": "mafia"})
+    cache.apply(positions("test", **{"1": ("mafia", 42.0, -71.0)}))
+
+    assert room.recipients() == {"1": {"role": "mafia", "latitude": 42.0, "longitude": -71.0}}
+    assert room.mafia_players() == ["1"]
+
+def test_late_positions_do_not_bring_players_back(redis_client):
+    cache, room = cache_and_room(redis_client)
+    cache.record(room, "1", "mafia", 42.0, -71.0)
+    cache.record(room, "2", "mafia", 42.0, -71.0)
+    room.leave("1")
+    room.eliminate("2")
+
+    cache.apply(positions("test", **{"1": ("mafia", 42.1, -71.0), "2": ("mafia", 42.1, -71.0)}))
+    cache.apply(positions("test", **{"3": ("mafia", 42.1, -71.0)}))
+
+    assert room.recipients() == {}
+    assert room.mafia_players() == []
+    assert room.geo_index.search("mafia", 42.1, -71.0, 1000) == []
+
+def test_members_count_as_mafia_before_their_first_position(redis_client):
+    cache, room = cache_and_room(redis_client)
+    room.join("1", "cop")
+    room.join("2", "mafia")
+    assert room.mafia_players() == ["2"]
+
+    cache.apply({"node": "other", "game_id": "test", "event": "joined", "player_id": "3", "role": "mafia"})
+    assert sorted(room.mafia_players()) == ["2", "3"]
+
+def test_only_the_server_taking_a_ping_broadcasts_it(redis_client):
+    cache, room = cache_and_room(redis_client)
+    cache.load_players = lambda room: [("3", "mafia", 42.3, -71.0)]
+    room.join("2", "mafia")
+    room.join("3", "mafia")
+
+    cache.record(room, "1", "cop", 42.0, -71.0)
+    cache.apply(positions("test", **{"2": ("mafia", 42.2, -71.0)}))
+    cache.resync(room)
+
+    assert set(room.recipients()) == {"1", "2", "3"}
+    assert room.role_deltas(0, 0) == {
+        "cop": {"1": {"role": "cop", "latitude": 42.0, "longitude": -71.0}}, 
+        "mafia": {"1": {"role": "cop", "latitude": 42.0, "longitude": -71.0}}, 
+    }
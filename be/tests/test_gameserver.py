@@ -0,0 +1,283 @@
+import pytest
+from http import HTTPStatus
+from wire_lib import decode_players
+
+def auth(token):
+    return {"Authorization": f"Bearer {token}"}
+
+def socket_rooms(server, socket):
+    manager = server.socketio.server.manager
+    return set(manager.get_rooms(manager.sid_from_eio_sid(socket.eio_sid, "/"), "/"))
+
+# ==========================================================
+# +++ join_game +++
+# ==========================================================
+def test_join_game_takes_the_role_from_the_login(server, player, login):
+    player(1, "mafia")
+    token = login("mafia", "mafia")
+
+    socket = server.socketio.test_client(server.app, auth={"token": token})
+    socket.emit("join_game", {"game_id": "test", "role": "cop"})
+
+    rooms = socket_rooms(server, socket)
+    assert "game:test:mafia" in rooms
+    assert "game:test:cop" not in rooms
+
+def test_join_game_without_login_gets_no_role_channel(server, player):
+    player(1, "mafia")
+    token = server.encode_token("1", "access")
+
+    socket = server.socketio.test_client(server.app, auth={"token": token})
+    socket.emit("join_game", {"game_id": "test", "role": "cop"})
+
+    rooms = socket_rooms(server, socket)
+    assert "game:test" in rooms
+    assert not {"game:test:cop", "game:test:mafia"} & rooms
+
+# ==========================================================
+# +++ Application factory +++
+# ==========================================================
+def test_socketio_uses_threads_unless_monkey_patched(server):
+    # gevent is installed, but this process is not patched
+    assert server.default_async_mode() == "threading"
+    assert server.socketio.server.async_mode == "threading"
+
+# ==========================================================
+# +++ Logout +++
+# ==========================================================
+def test_logout_needs_the_players_own_token(server, player, login):
+    cop = player(1, "cop", "cop")
+    mafia = player(2, "mafia")
+    login("cop", "cop")
+    mafia_token = login("mafia", "mafia")
+    client = server.app.test_client()
+
+    body, status = client.post("/logout", json={"id": cop}).json
+    assert status == HTTPStatus.UNAUTHORIZED
+
+    body, status = client.post("/logout", json={"id": cop}, headers=auth(mafia_token)).json
+    assert status == HTTPStatus.FORBIDDEN
+    assert cop in server.rooms.get("test").members
+
+    body, status = client.post("/logout", json={"id": mafia}, headers=auth(mafia_token)).json
+    assert status == HTTPStatus.OK
+    assert server.rooms.get("test").members == {cop}
+
+def test_logout_only_leaves_the_players_games(server, player, login, monkeypatch):
+    mafia = player(1, "mafia")
+    token = login("mafia", "mafia")
+    other = server.rooms.get_or_create("other")
+    left = []
+    monkeypatch.setattr(other, "leave", left.append)
+
+    body, status = server.app.test_client().post("/logout", json={"id": mafia}, headers=auth(token)).json
+    assert status == HTTPStatus.OK
+    assert server.rooms.get("test").members == set()
+    assert left == []
+
+# ==========================================================
+# +++ Location updates +++
+# ==========================================================
+def ping(server, token, player_id, role, latitude, longitude, game_id="test"):
+    client = server.app.test_client()
+    return client.post(
+        "/location", 
+        json={"id": player_id, "role": role, "lat": latitude, "lon": longitude, "game_id": game_id}, 
+        headers=auth(token)
+    ).json
+
+@pytest.mark.parametrize("server", ["1", "0"], indirect=True)
+def test_cop_does_not_win_before_the_mafia_pinged(server, player, login):
+    cop = player(1, "cop", "cop")
+    player(2, "mafia")
+    cop_token = login("cop", "cop")
+    login("mafia", "mafia")
+
+    body, status = ping(server, cop_token, cop, "cop", 42.0, -71.0)
+    assert status == HTTPStatus.OK
+    assert server.rooms.get("test").outcome is None
+
+@pytest.mark.parametrize("server", ["1", "0"], indirect=True)
+def test_cop_wins_once_every_mafia_is_caught(server, player, login):
+    cop = player(1, "cop", "cop")
+    mafia = player(2, "mafia")
+    cop_token = login("cop", "cop")
+    mafia_token = login("mafia", "mafia")
+
+    ping(server, mafia_token, mafia, "mafia", 42.0, -71.0)
+    ping(server, cop_token, cop, "cop", 42.01, -71.0)
+    room = server.rooms.get("test")
+    assert room.outcome is None
+
+    # About 50 meters away
+    ping(server, cop_token, cop, "cop", 42.00045, -71.0)
+    assert room.is_eliminated(mafia)
+    assert room.outcome == "cop_wins"
+
+def test_cop_pings_only_lock_the_game_to_decide_it(server, player, login, monkeypatch):
+    cop = player(1, "cop", "cop")
+    mafia = player(2, "mafia")
+    cop_token = login("cop", "cop")
+    mafia_token = login("mafia", "mafia")
+    ping(server, mafia_token, mafia, "mafia", 42.0, -71.0)
+
+    room = server.rooms.get("test")
+    game_lock = room.game_lock
+    locks = []
+    monkeypatch.setattr(room, "game_lock", lambda: locks.append(1) or game_lock())
+
+    ping(server, cop_token, cop, "cop", 42.01, -71.0)
+    ping(server, cop_token, cop, "cop", 42.02, -71.0)
+    assert locks == []
+
+    ping(server, cop_token, cop, "cop", 42.00045, -71.0)
+    assert locks == [1]
+    assert room.outcome == "cop_wins"
+
+@pytest.mark.parametrize("server", ["1", "0"], indirect=True)
+def test_pings_cant_change_the_players_role(server, player, login):
+    spoofer = player(1, "spoofer")
+    mafia = player(2, "mafia")
+    spoofer_token = login("spoofer", "mafia")
+    mafia_token = login("mafia", "mafia")
+    ping(server, mafia_token, mafia, "mafia", 42.0, -71.0)
+
+    body, status = ping(server, spoofer_token, spoofer, "cop", 42.0001, -71.0)
+    assert status == HTTPStatus.FORBIDDEN
+    room = server.rooms.get("test")
+    assert not room.is_eliminated(mafia)
+    assert room.outcome is None
+    assert room.store.roles() == {spoofer: "mafia", mafia: "mafia"}
+
+    # Without a role, the ping takes the one the player logged in with
+    client = server.app.test_client()
+    body, status = client.post(
+        "/location", 
+        json={"id": spoofer, "lat": 42.0001, "lon": -71.0, "game_id": "test"}, 
+        headers=auth(spoofer_token)
+    ).json
+    assert status == HTTPStatus.OK
+    assert body["role"] == "mafia"
+    assert not room.is_eliminated(mafia)
+
+def test_pings_outside_the_players_game_are_rejected(server, player, login):
+    mafia = player(1, "mafia")
+    token = login("mafia", "mafia")
+
+    body, status = ping(server, token, mafia, "mafia", 42.0, -71.0, game_id="other")
+    assert status == HTTPStatus.FORBIDDEN
+
+def test_pings_near_an_opponent_skip_the_filter(server, player, login, clock, monkeypatch):
+    from ingest_lib import PingFilter
+
+    monkeypatch.setitem(server.g, "ping_filter", PingFilter(min_interval=10, clock=clock))
+    cop = player(1, "cop", "cop")
+    mafia = player(2, "mafia")
+    cop_token = login("cop", "cop")
+    mafia_token = login("mafia", "mafia")
+    ping(server, mafia_token, mafia, "mafia", 42.0, -71.0)
+    ping(server, cop_token, cop, "cop", 42.01, -71.0)
+
+    # Rate limited, far from the mafia
+    clock.advance(1)
+    body, status = ping(server, cop_token, cop, "cop", 42.005, -71.0)
+    assert body["latitude"] == 42.01
+    room = server.rooms.get("test")
+    assert room.recipients()[cop]["latitude"] == 42.01
+
+    # About 50 meters from the mafia, taken as is
+    clock.advance(1)
+    body, status = ping(server, cop_token, cop, "cop", 42.00045, -71.0)
+    assert status == HTTPStatus.OK
+    assert room.is_eliminated(mafia)
+
+@pytest.mark.parametrize("latitude, longitude", [
+    ("nan", -71.0), 
+    (42.0, "inf"), 
+    (500, -71.0), 
+    (-90.5, -71.0), 
+    (42.0, 180.5), 
+])
+def test_invalid_coordinates_are_rejected(server, player, login, latitude, longitude):
+    mafia = player(1, "mafia")
+    token = login("mafia", "mafia")
+
+    body, status = ping(server, token, mafia, "mafia", latitude, longitude)
+    assert status == HTTPStatus.BAD_REQUEST
+    assert server.rooms.get("test").recipients() == {}
+
+# ==========================================================
+# +++ Broadcast ticks +++
+# ==========================================================
+def received_deltas(socket):
+    return [event["args"][0] for event in socket.get_received() if event["name"] == "positions_delta"]
+
+def test_deltas_are_only_packed_for_packed_listeners(server, player, login, monkeypatch):
+    cop = player(1, "cop", "cop")
+    mafia = player(2, "mafia")
+    cop_token = login("cop", "cop")
+    mafia_token = login("mafia", "mafia")
+
+    cop_socket = server.socketio.test_client(server.app, auth={"token": cop_token})
+    cop_socket.emit("join_game", {"game_id": "test"})
+    cop_socket.get_received()
+
+    encode_players = server.encode_players
+    packed = []
+    monkeypatch.setattr(server, "encode_players", lambda players: packed.append(players) or b"")
+    ping(server, mafia_token, mafia, "mafia", 42.0, -71.0)
+    server.broadcast_tick()
+    assert received_deltas(cop_socket) == [{mafia: {"role": "mafia", "latitude": 42.0, "longitude": -71.0}}]
+    assert packed == []
+    monkeypatch.setattr(server, "encode_players", encode_players)
+
+    packed_socket = server.socketio.test_client(server.app, auth={"token": cop_token})
+    packed_socket.emit("join_game", {"game_id": "test", "encoding": "packed"})
+    packed_socket.get_received()
+
+    ping(server, mafia_token, mafia, "mafia", 42.001, -71.0)
+    server.broadcast_tick()
+    assert decode_players(received_deltas(packed_socket)[0]) == {
+        mafia: {"role": "mafia", "latitude": 42.001, "longitude": -71.0}
+    }
+
+# ==========================================================
+# +++ Player administration +++
+# ==========================================================
+def test_imported_passwords_are_stored_hashed(server, monkeypatch):
+    import bcrypt
+    import redis_lib
+
+    monkeypatch.setitem(server.g, "admin_token", "admin")
+    client = server.app.test_client()
+    password_hash = bcrypt.hashpw(b"hashed", bcrypt.gensalt(4)).decode()
+
+    body, status = client.post(
+        "/admin/users/import", 
+        json=[
+            {"id": 1, "name": "plain", "password": "plain"}, 
+            {"id": 2, "name": "hashed", "password": password_hash}, 
+        ], 
+        headers=auth("admin")
+    ).json
+    assert status == HTTPStatus.OK
+    assert body == {"imported": 2}
+
+    stored = redis_lib.get_user_credentials("plain")[2]
+    assert stored != "plain" and bcrypt.checkpw(b"plain", stored.encode())
+    assert redis_lib.get_user_credentials("hashed")[2] == password_hash
+
+    for name in ("plain", "hashed"):
+        body, status = client.post("/login", json={"name": name, "password": name, "role": "mafia"}).json
+        assert status == HTTPStatus.OK
+
+def test_imports_without_a_password_are_rejected(server, monkeypatch):
+    monkeypatch.setitem(server.g, "admin_token", "admin")
+    client = server.app.test_client()
+
+    body, status = client.post(
+        "/admin/users/import", 
+        json=[{"id": 1, "name": "nobody", "password": None}], 
+        headers=auth("admin")
+    ).json
+    assert status == HTTPStatus.BAD_REQUEST
@@ -0,0 +1,85 @@
+import random
+import pytest
+from geo_lib import GridGeoIndex, MemoryGeoIndex, METERS_PER_DEGREE
+
+def both(players, cell_size=150):
+    grid, memory = GridGeoIndex(cell_size), MemoryGeoIndex()
+    for player_id, role, latitude, longitude in players:
+        grid.add(player_id, role, latitude, longitude)
+        memory.add(player_id, role, latitude, longitude)
+    return grid, memory
+
+def same_results(grid, memory, role, latitude, longitude, radius):
+    found = grid.search(role, latitude, longitude, radius)
+    expected = memory.search(role, latitude, longitude, radius)
+    assert [player_id for player_id, _ in found] == [player_id for player_id, _ in expected]
+    assert [dist for _, dist in found] == pytest.approx([dist for _, dist in expected])
+    return found
+
+@pytest.mark.parametrize("center", [
+    (42.3, -71.1),      # Boston
+    (0.0, 0.0),         # Cell corners at the origin
+    (-33.9, 151.2),     # Sydney
+    (0.0, 179.999),     # On the antimeridian
+    (-16.5, -179.999),  # Fiji, the other side
+    (78.2, 15.6),       # Svalbard, narrow cells
+    (89.5, 45.0),       # Near the pole, few columns
+])
+def test_grid_matches_the_linear_index(center):
+    rng = random.Random(str(center))
+    spread = 2000 / METERS_PER_DEGREE
+    players = []
+    for i in range(2000):
+        latitude = max(-90, min(90, center[0] + rng.uniform(-spread, spread)))
+        longitude = center[1] + rng.uniform(-spread, spread) * 3
+        longitude = (longitude + 180) % 360 - 180
+        players.append((str(i), rng.choice(("cop", "mafia")), latitude, longitude))
+    grid, memory = both(players)
+
+    for _ in range(200):
+        _, _, latitude, longitude = rng.choice(players)
+        for radius in (50, 100, 150, 400):
+            same_results(grid, memory, rng.choice(("cop", "mafia")), latitude, longitude, radius)
+
+def test_searches_see_across_cell_boundaries():
+    grid = GridGeoIndex(150)
+    row_height = grid.row_height
+
+    # Just either side of a row boundary, about a meter apart
+    boundary = 100 * row_height
+    grid.add("below", "mafia", boundary - 0.000005, 10.0)
+    grid.add("above", "mafia", boundary + 0.000005, 10.0)
+    found = [player_id for player_id, _ in grid.search("mafia", boundary - 0.000005, 10.0, 5)]
+    assert sorted(found) == ["above", "below"]
+
+    # And of a column boundary
+    count, width = grid._columns(100)
+    edge = -180 + 7 * width
+    grid.add("left", "cop", boundary + row_height / 2, edge - 0.000005)
+    grid.add("right", "cop", boundary + row_height / 2, edge + 0.000005)
+    found = [player_id for player_id, _ in grid.search("cop", boundary + row_height / 2, edge + 0.000005, 5)]
+    assert sorted(found) == ["left", "right"]
+
+@pytest.mark.parametrize("latitude", [0.0, -16.5, 65.0])
+def test_searches_wrap_around_the_antimeridian(latitude):
+    grid, memory = both([
+        ("east", "mafia", latitude, 179.9995),
+        ("west", "mafia", latitude, -179.9995),
+        ("far", "mafia", latitude, 179.9),
+    ])
+    for longitude in (179.9995, -179.9995, 180.0, -180.0):
+        found = same_results(grid, memory, "mafia", latitude, longitude, 150)
+        assert sorted(player_id for player_id, _ in found) == ["east", "west"]
+
+def test_moves_and_removals():
+    grid = GridGeoIndex(150)
+    grid.add("1", "mafia", 42.0, -71.0)
+    grid.add("1", "mafia", 42.01, -71.0)
+    assert grid.search("mafia", 42.0, -71.0, 100) == []
+    assert [player_id for player_id, _ in grid.search("mafia", 42.01, -71.0, 100)] == ["1"]
+
+    grid.add("1", "cop", 42.01, -71.0)
+    assert grid.search("mafia", 42.01, -71.0, 100) == []
+
+    grid.remove("1")
+    assert grid.search("cop", 42.01, -71.0, 100) == []
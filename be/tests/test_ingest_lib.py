@@ -0,0 +1,71 @@
+import pytest
+from distance_lib import equirectangular
+from ingest_lib import PingFilter, ACCEPTED, RATE_LIMITED, UNCHANGED
+
+# About one meter, north-south
+METER = 1 / 111195
+
+def ping_filter(clock, **options):
+    return PingFilter(clock=clock, **options)
+
+def test_first_pings_are_taken_as_is(clock):
+    pings = ping_filter(clock)
+    assert pings.filter("1", "mafia", 42.0, -71.0) == (ACCEPTED, 42.0, -71.0)
+
+def test_pings_too_close_in_time_are_rate_limited(clock):
+    pings = ping_filter(clock, min_interval=0.5)
+    pings.filter("1", "mafia", 42.0, -71.0)
+
+    clock.advance(0.2)
+    assert pings.filter("1", "mafia", 42.0 + 500 * METER, -71.0) == (RATE_LIMITED, 42.0, -71.0)
+
+    clock.advance(0.3)
+    verdict, latitude, _ = pings.filter("1", "mafia", 42.0 + 500 * METER, -71.0)
+    assert verdict == ACCEPTED
+    assert latitude == pytest.approx(42.0 + 500 * METER)
+
+def test_small_moves_are_dropped(clock):
+    pings = ping_filter(clock, min_move=2, alpha=0.5)
+    pings.filter("1", "mafia", 42.0, -71.0)
+
+    # Half of a 3 meter move is under min_move
+    clock.advance(1)
+    assert pings.filter("1", "mafia", 42.0 + 3 * METER, -71.0) == (UNCHANGED, 42.0, -71.0)
+
+    clock.advance(1)
+    verdict, latitude, longitude = pings.filter("1", "mafia", 42.0 + 10 * METER, -71.0)
+    assert verdict == ACCEPTED
+    assert 42.0 < latitude < 42.0 + 10 * METER
+    assert equirectangular(latitude, longitude, 42.0 + 10 * METER, -71.0) <= pings.max_error
+
+def test_jumps_reset_the_track(clock):
+    pings = ping_filter(clock, snap_distance=30, alpha=0.5)
+    pings.filter("1", "mafia", 42.0, -71.0)
+
+    clock.advance(1)
+    verdict, latitude, longitude = pings.filter("1", "mafia", 42.0 + 100 * METER, -71.0)
+    assert verdict == ACCEPTED
+    assert (latitude, longitude) == pytest.approx((42.0 + 100 * METER, -71.0))
+    track = pings.tracks["1"]
+    assert (track.v_latitude, track.v_longitude) == (0.0, 0.0)
+
+def test_exact_pings_bypass_the_filter(clock):
+    pings = ping_filter(clock, min_interval=0.5)
+    pings.filter("1", "mafia", 42.0, -71.0)
+
+    clock.advance(0.1)
+    exact = (42.0 + 1 * METER, -71.0)
+    assert pings.filter("1", "mafia", *exact, exact=True) == (ACCEPTED, *exact)
+
+    # And restart the track from there
+    clock.advance(0.1)
+    assert pings.filter("1", "mafia", 42.0, -71.0) == (RATE_LIMITED, *exact)
+
+def test_simultaneous_pings_without_a_rate_limit(clock):
+    pings = ping_filter(clock, min_interval=0, min_move=0)
+    pings.filter("1", "mafia", 42.0, -71.0)
+
+    verdict, latitude, _ = pings.filter("1", "mafia", 42.0 + 10 * METER, -71.0)
+    assert verdict == ACCEPTED
+    assert latitude == pytest.approx(42.0 + 5 * METER)
+    assert pings.tracks["1"].v_latitude == 0.0
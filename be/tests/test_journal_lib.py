@@ -0,0 +1,95 @@
+import time
+from journal_lib import EventJournal
+
+def journal(redis_client, clock, **options):
+    # Stream entry ids are the Redis server's time, keep the events
+    # near it (see export)
+    clock.now = time.time()
+    return EventJournal(redis_client, clock=clock, **options)
+
+def test_replay_follows_the_event_times(redis_client, clock):
+    first = journal(redis_client, clock)
+    second = EventJournal(redis_client, clock=clock)
+
+    # The second server writes its (older) event last
+    first.record("test", "joined", player_id="1", role="mafia")
+    clock.advance(1)
+    first.record("test", "location", player_id="1", role="mafia", latitude=1.0, longitude=2.0)
+    clock.advance(1)
+    second.record("test", "eliminated", player_id="1", by="2")
+    clock.advance(-1.5)
+    second.record("test", "location", player_id="1", role="mafia", latitude=0.0, longitude=0.0)
+    clock.advance(2)
+    first.flush()
+    second.flush()
+
+    state = first.replay("test")
+    assert state["players"] == {}
+    assert state["eliminated"] == ["1"]
+    assert state["events"] == 4
+
+    before = first.replay("test", at=clock() - 1.5)
+    assert before["players"] == {"1": {"role": "mafia", "latitude": 1.0, "longitude": 2.0}}
+
+def test_streams_are_capped(redis_client, clock):
+    events = journal(redis_client, clock, maxlen=10)
+    for i in range(500):
+        events.record("test", "location", player_id="1", role="mafia", latitude=i, longitude=0)
+    events.flush()
+    assert redis_client.xlen(events.key("test")) < 500
+
+def test_closed_games_expire_after_their_last_events(redis_client, clock):
+    events = journal(redis_client, clock, retention=60)
+    events.record("test", "joined", player_id="1", role="mafia")
+    events.flush()
+    assert redis_client.ttl(events.key("test")) == -1
+
+    events.record("test", "game_over", result="cop_wins")
+    events.close("test")
+    events.flush()
+    assert 0 < redis_client.ttl(events.key("test")) <= 60
+    assert [event["event"] for event in events.export("test")] == ["joined", "game_over"]
+
+def test_no_retention_keeps_the_stream(redis_client, clock):
+    events = journal(redis_client, clock)
+    events.record("test", "joined", player_id="1", role="mafia")
+    events.close("test")
+    events.flush()
+    assert redis_client.ttl(events.key("test")) == -1
+
+def test_replay_starts_from_the_last_game_under_the_id(redis_client, clock):
+    events = journal(redis_client, clock, retention=60)
+    second_server = EventJournal(redis_client, clock=clock)
+
+    first_game = clock()
+    events.open("test", first_game)
+    events.record("test", "joined", player_id="1", role="mafia")
+    events.record("test", "location", player_id="2", role="cop", latitude=1.0, longitude=2.0)
+    events.record("test", "eliminated", player_id="1", by="2")
+    events.record("test", "game_over", result="cop_wins")
+    events.close("test")
+    events.flush()
+
+    clock.advance(2)
+    second_game = clock()
+    events.open("test", second_game)
+    clock.advance(1)
+    events.record("test", "joined", player_id="3", role="mafia")
+
+    # Another server opening the same game later changes nothing
+    second_server.open("test", second_game)
+    second_server.flush()
+    events.flush()
+    assert redis_client.ttl(events.key("test")) == -1
+
+    state = events.replay("test")
+    assert state["started"] == second_game
+    assert state["players"] == {"3": {"role": "mafia", "latitude": None, "longitude": None}}
+    assert state["eliminated"] == []
+    assert state["outcome"] is None
+    assert state["events"] == 2
+
+    before = events.replay("test", at=second_game - 1)
+    assert before["started"] == first_game
+    assert before["outcome"] == "cop_wins"
+    assert before["eliminated"] == ["1"]
@@ -0,0 +1,64 @@
+import redis_lib
+
+def store(user_id, status="inactive"):
+    redis_lib.store_user_location(user_id, f"user-{user_id}", "password", status, 42.0, -71.0, "mafia")
+
+def test_rebuild_indexes_the_records(redis_client):
+    for user_id in range(5):
+        store(str(user_id), "active" if user_id < 2 else "inactive")
+
+    # Stale entries, and a record the indexes don't know about
+    redis_client.sadd(redis_lib.ACTIVE_INDEX, "4")
+    redis_client.hset(redis_lib.USERNAME_INDEX, "gone", "99")
+    redis_client.hset(redis_lib.user_key("5"), mapping={"username": "user-5", "status": "active"})
+
+    assert redis_lib.rebuild_user_indexes() == 6
+    assert redis_client.smembers(redis_lib.ACTIVE_INDEX) == {"0", "1", "5"}
+    assert redis_client.smembers(redis_lib.USER_INDEX) == {str(user_id) for user_id in range(6)}
+    assert redis_lib.get_user_credentials("user-5")[0] == "5"
+    assert redis_lib.get_user_credentials("gone")[0] == ""
+
+def test_rebuild_keeps_the_indexes_while_it_runs(redis_client, monkeypatch):
+    for user_id in range(3):
+        store(str(user_id), "active")
+
+    seen = []
+    scan = redis_client.scan
+    def scan_and_look(*args, **kwargs):
+        seen.append(redis_lib.get_user_credentials("user-1")[0])
+        seen.append(redis_lib.count_active_users())
+        return scan(*args, **kwargs)
+    monkeypatch.setattr(redis_client, "scan", scan_and_look)
+
+    redis_lib.rebuild_user_indexes()
+    assert seen and all(value in ("1", 3) for value in seen)
+
+def test_rebuild_keeps_the_writes_made_while_it_runs(redis_client, monkeypatch):
+    for user_id in range(3):
+        store(str(user_id), "active" if user_id else "inactive")
+
+    # Between two batches: a user is added, one logs in, one logs out
+    writes = iter([
+        lambda: store("new", "active"), 
+        lambda: redis_lib.set_user_status("0", "active"), 
+        lambda: redis_lib.set_user_status("1", "inactive"), 
+    ])
+    scan = redis_client.scan
+    def scan_and_write(*args, **kwargs):
+        result = scan(*args, **kwargs)
+        next(writes, lambda: None)()
+        return result
+    monkeypatch.setattr(redis_client, "scan", scan_and_write)
+
+    redis_lib.rebuild_user_indexes(batch_size=1)
+    assert redis_lib.get_user_credentials("user-new")[0] == "new"
+    assert redis_client.smembers(redis_lib.USER_INDEX) == {"0", "1", "2", "new"}
+    assert redis_client.smembers(redis_lib.ACTIVE_INDEX) == {"0", "2", "new"}
+
+def test_rebuild_with_no_active_users_empties_the_active_index(redis_client):
+    store("1")
+    redis_client.sadd(redis_lib.ACTIVE_INDEX, "1")
+
+    redis_lib.rebuild_user_indexes()
+    assert not redis_client.exists(redis_lib.ACTIVE_INDEX)
+    assert redis_client.smembers(redis_lib.USER_INDEX) == {"1"}
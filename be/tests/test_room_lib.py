@@ -0,0 +1,108 @@
+from geo_lib import MemoryGeoIndex
+from room_lib import GameRoom, MemoryRoomStore
+
+def game_room(clock, history=300):
+    return GameRoom("test", MemoryGeoIndex(), MemoryRoomStore(), clock=clock, history=history)
+
+def tick(room):
+    # No epsilon, every mafia update goes out right away
+    return room.role_deltas(0, 0)
+
+def test_reconnecting_clients_get_what_they_missed(clock):
+    room = game_room(clock)
+    room.update_player("1", "cop", 42.0, -71.0)
+    tick(room)
+    seen = room.version
+
+    room.update_player("2", "mafia", 42.1, -71.0)
+    tick(room)
+    room.update_player("1", "cop", 42.2, -71.0)
+    tick(room)
+
+    delta, version = room.deltas_since(seen, "cop")
+    assert delta == {
+        "1": {"role": "cop", "latitude": 42.2, "longitude": -71.0}, 
+        "2": {"role": "mafia", "latitude": 42.1, "longitude": -71.0}, 
+    }
+    assert version == room.version
+
+def test_resync_only_sends_what_the_role_receives(clock):
+    room = game_room(clock)
+
+    # The mafia get each other's moves once a minute
+    room.update_player("3", "mafia", 42.3, -71.0)
+    room.role_deltas(0, 60)
+    seen = room.version
+
+    clock.advance(1)
+    room.update_player("2", "mafia", 42.1, -71.0)
+    room.role_deltas(0, 60)
+    room.update_player("1", "cop", 42.0, -71.0)
+    room.role_deltas(0, 60)
+
+    mafia_delta, _ = room.deltas_since(seen, "mafia")
+    cop_delta, _ = room.deltas_since(seen, "cop")
+    assert set(cop_delta) == {"1", "2"}
+    assert set(mafia_delta) == {"1"}
+
+def test_an_up_to_date_client_gets_an_empty_delta(clock):
+    room = game_room(clock)
+    room.update_player("1", "cop", 42.0, -71.0)
+    tick(room)
+    assert room.deltas_since(room.version, "cop") == ({}, room.version)
+
+def test_unknown_versions_need_a_snapshot(clock):
+    room = game_room(clock)
+    room.update_player("1", "cop", 42.0, -71.0)
+    tick(room)
+    epoch, _, sequence = room.version.partition(":")
+
+    # Another server (or before a restart), from the future, or garbage
+    assert room.deltas_since(f"other:{sequence}", "cop") is None
+    assert room.deltas_since(f"{epoch}:{int(sequence) + 1}", "cop") is None
+    assert room.deltas_since("garbage", "cop") is None
+
+def test_clients_behind_the_history_need_a_snapshot(clock):
+    room = game_room(clock, history=2)
+    tick(room)
+    room.update_player("1", "cop", 42.0, -71.0)
+    tick(room)
+    seen = room.version
+
+    for i in range(1, 4):
+        room.update_player("1", "cop", 42.0 + i, -71.0)
+        tick(room)
+    assert room.deltas_since(seen, "cop") is None
+
+    seen = room.version
+    room.update_player("1", "cop", 43.0, -71.0)
+    tick(room)
+    assert room.deltas_since(seen, "cop") is not None
+
+def test_removals_need_a_snapshot(clock):
+    room = game_room(clock)
+    room.update_player("1", "cop", 42.0, -71.0)
+    room.update_player("2", "mafia", 42.1, -71.0)
+    tick(room)
+    seen = room.version
+
+    room.eliminate("2")
+    tick(room)
+    assert room.deltas_since(seen, "cop") is None
+
+    players, version = room.snapshot()
+    assert players == {"1": {"role": "cop", "latitude": 42.0, "longitude": -71.0}}
+    assert room.deltas_since(version, "cop") == ({}, version)
+
+def test_closing_frees_the_game(clock):
+    room = game_room(clock)
+    room.join("1", "mafia")
+    room.update_player("1", "mafia", 42.0, -71.0)
+    room.geo_index.add("1", "mafia", 42.0, -71.0)
+    room.finish("cop_loses")
+
+    room.close()
+    assert room.recipients() == {}
+    assert room.members == set()
+    assert room.store.get("outcome") is None
+    assert room.geo_index.search("mafia", 42.0, -71.0, 100) == []
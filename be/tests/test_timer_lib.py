@@ -0,0 +1,121 @@
+from timer_lib import GameClockScheduler
+
+def scheduler(clock):
+    return GameClockScheduler(clock=clock, autostart=False)
+
+def test_clocks_fire_in_deadline_order(clock):
+    clocks = scheduler(clock)
+    fired = []
+    clocks.start_clock("b", 20, lambda: fired.append("b"))
+    clocks.start_clock("a", 10, lambda: fired.append("a"))
+    clocks.start_clock("c", 30, lambda: fired.append("c"))
+
+    assert clocks.run_pending() == 10
+    assert fired == []
+
+    clock.advance(25)
+    assert clocks.run_pending() == 5
+    assert fired == ["a", "b"]
+
+    clock.advance(5)
+    assert clocks.run_pending() is None
+    assert fired == ["a", "b", "c"]
+
+def test_a_clock_fires_once(clock):
+    clocks = scheduler(clock)
+    fired = []
+    clocks.start_clock("a", 10, lambda: fired.append("a"))
+
+    clock.advance(10)
+    clocks.run_pending()
+    clock.advance(10)
+    clocks.run_pending()
+    assert fired == ["a"]
+    assert clocks.remaining("a") is None
+
+def test_cancelled_clocks_do_not_fire(clock):
+    clocks = scheduler(clock)
+    fired = []
+    clocks.start_clock("a", 10, lambda: fired.append("a"))
+    clocks.start_clock("b", 20, lambda: fired.append("b"))
+
+    assert clocks.cancel("a")
+    assert not clocks.cancel("a")
+
+    clock.advance(30)
+    clocks.run_pending()
+    assert fired == ["b"]
+
+def test_restarting_a_clock_reschedules_it(clock):
+    clocks = scheduler(clock)
+    fired = []
+    clocks.start_clock("a", 10, lambda: fired.append("first"))
+    clock.advance(5)
+    clocks.start_clock("a", 10, lambda: fired.append("second"))
+
+    clock.advance(5)
+    clocks.run_pending()
+    assert fired == []
+    assert clocks.remaining("a") == 5
+
+    clock.advance(5)
+    clocks.run_pending()
+    assert fired == ["second"]
+
+def test_extend_moves_the_deadline(clock):
+    clocks = scheduler(clock)
+    fired = []
+    clocks.start_clock("a", 10, lambda: fired.append("a"))
+    clocks.start_clock("b", 15, lambda: fired.append("b"))
+
+    assert clocks.extend("a", 10)
+    clock.advance(15)
+    clocks.run_pending()
+    assert fired == ["b"]
+
+    assert clocks.extend("a", -5)
+    assert clocks.remaining("a") == 0
+    clocks.run_pending()
+    assert fired == ["b", "a"]
+    assert not clocks.extend("a", 10)
+
+def test_paused_clocks_keep_their_time(clock):
+    clocks = scheduler(clock)
+    fired = []
+    clocks.start_clock("a", 10, lambda: fired.append("a"))
+    clock.advance(4)
+
+    assert clocks.pause("a")
+    assert not clocks.pause("a")
+    clock.advance(100)
+    clocks.run_pending()
+    assert fired == []
+    assert clocks.remaining("a") == 6
+
+    assert clocks.extend("a", 2)
+    assert clocks.resume("a")
+    assert not clocks.resume("a")
+    clock.advance(7)
+    clocks.run_pending()
+    assert fired == []
+
+    clock.advance(1)
+    clocks.run_pending()
+    assert fired == ["a"]
+
+def test_a_callback_can_start_a_new_clock(clock):
+    clocks = scheduler(clock)
+    fired = []
+
+    def game_over():
+        fired.append("game_over")
+        clocks.start_clock("a", 60, lambda: fired.append("close"))
+
+    clocks.start_clock("a", 10, game_over)
+    clock.advance(10)
+    clocks.run_pending()
+    assert clocks.remaining("a") == 60
+
+    clock.advance(60)
+    clocks.run_pending()
+    assert fired == ["game_over", "close"]
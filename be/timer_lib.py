@@ -0,0 +1,296 @@
+import time
+import heapq
+import itertools
+import threading
+from log_lib import get_logger
+
+logger = get_logger(__name__)
+
+class GameClock:
+    """
+    Countdown of one game. While running, 'deadline' is when the game
+    ends; while paused, 'remaining' holds the seconds left.
+    """
+    __slots__ = ("game_id", "callback", "deadline", "remaining", "paused", "generation")
+
+    def __init__(self, game_id, callback, deadline):
+        self.game_id = game_id
+        self.callback = callback
+        self.deadline = deadline
+        self.remaining = None
+        self.paused = False
+        self.generation = 0
+
+class GameClockScheduler:
+    """
+    One heap of deadlines for every game clock in the process.
+
+    A single background thread sleeps until the earliest deadline (or
+    until a clock is changed) and fires the callbacks that are due, so
+    the cost no longer grows with one polling thread per game.
+
+    Heap entries are never removed in place: pausing, extending or
+    cancelling a clock bumps its generation and stale entries are
+    skipped when they reach the top of the heap.
+    """
+
+    def __init__(self, clock=time.monotonic, autostart=True):
+        """
+        Args:
+            clock (callable): Returns the current time in seconds.
+                Tests can pass a fake clock and call run_pending().
+            autostart (bool): Start the background thread the first
+                time a game clock is started.
+        """
+        self.clock = clock
+        self.autostart = autostart
+        self.clocks = {}
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.running = False
+
+    def _push(self, game_clock):
+        # Caller holds self.condition
+        game_clock.generation += 1
+        heapq.heappush(
+            self.heap,
+            (game_clock.deadline, next(self.counter), game_clock.game_id, game_clock.generation)
+        )
+        self.condition.notify()
+
+    def start_clock(self, game_id, duration, callback):
+        """
+        Start (or restart) a game's clock.
+
+        Args:
+            game_id (str): The game's unique identifier.
+            duration (float): Seconds until the game ends.
+            callback (callable): Called with no arguments when the
+                clock runs out.
+        """
+        with self.condition:
+            game_clock = self.clocks.get(game_id)
+            if game_clock is None:
+                game_clock = self.clocks[game_id] = GameClock(game_id, callback, None)
+            game_clock.callback = callback
+            game_clock.deadline = self.clock() + duration
+            game_clock.remaining = None
+            game_clock.paused = False
+            self._push(game_clock)
+
+        if self.autostart:
+            self.start()
+
+    def pause(self, game_id):
+        """
+        Stop a game's clock, keeping the time left.
+
+        Returns:
+            bool: False if there is no running clock for the game.
+        """
+        with self.condition:
+            game_clock = self.clocks.get(game_id)
+            if game_clock is None or game_clock.paused:
+                return False
+            game_clock.remaining = max(0.0, game_clock.deadline - self.clock())
+            game_clock.paused = True
+            game_clock.generation += 1
+            return True
+
+    def resume(self, game_id):
+        """
+        Restart a paused game's clock with the time it had left.
+
+        Returns:
+            bool: False if there is no paused clock for the game.
+        """
+        with self.condition:
+            game_clock = self.clocks.get(game_id)
+            if game_clock is None or not game_clock.paused:
+                return False
+            game_clock.deadline = self.clock() + game_clock.remaining
+            game_clock.remaining = None
+            game_clock.paused = False
+            self._push(game_clock)
+            return True
+
+    def extend(self, game_id, seconds):
+        """
+        Add (or, if negative, remove) time to a game's clock.
+
+        Returns:
+            bool: False if there is no clock for the game.
+        """
+        with self.condition:
+            game_clock = self.clocks.get(game_id)
+            if game_clock is None:
+                return False
+            if game_clock.paused:
+                game_clock.remaining = max(0.0, game_clock.remaining + seconds)
+            else:
+                game_clock.deadline += seconds
+                self._push(game_clock)
+            return True
+
+    def cancel(self, game_id):
+        """
+        Drop a game's clock without firing its callback.
+
+        Returns:
+            bool: False if there is no clock for the game.
+        """
+        with self.condition:
+            game_clock = self.clocks.pop(game_id, None)
+            if game_clock is None:
+                return False
+            game_clock.generation += 1
+            return True
+
+    def remaining(self, game_id):
+        """
+        Seconds left on a game's clock, or None if it has none.
+        """
+        with self.condition:
+            game_clock = self.clocks.get(game_id)
+            if game_clock is None:
+                return None
+            if game_clock.paused:
+                return game_clock.remaining
+            return max(0.0, game_clock.deadline - self.clock())
+
+    def _pop_due(self):
+        """
+        Remove the clocks that ran out from the heap.
+
+        Returns:
+            tuple: (the due callbacks, seconds until the next deadline
+            or None if there is none).
+        """
+        due = []
+        now = self.clock()
+
+        while self.heap:
+            deadline, _, game_id, generation = self.heap[0]
+            game_clock = self.clocks.get(game_id)
+
+            # Stale entry (clock paused, moved or cancelled)
+            if game_clock is None or game_clock.generation != generation:
+                heapq.heappop(self.heap)
+                continue
+
+            if deadline > now:
+                return due, deadline - now
+
+            heapq.heappop(self.heap)
+            del self.clocks[game_id]
+            due.append(game_clock.callback)
+
+        return due, None
+
+    def run_pending(self):
+        """
+        Fire the callbacks of every clock that ran out.
+
+        Returns:
+            float or None: Seconds until the next deadline, None if no
+            clock is running.
+        """
+        with self.condition:
+            due, wait = self._pop_due()
+
+        for callback in due:
+            callback()
+        return wait
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.running:
+                    return
+                due, wait = self._pop_due()
+                if not due:
+                    # Sleep until the next deadline, or until a clock
+                    # is started or changed (which notifies us)
+                    self.condition.wait(wait)
+                    continue
+
+            for callback in due:
+                try:
+                    callback()
+                except Exception:
+                    logger.exception("An exception occurred in a game clock callback")
+
+    def start(self):
+        """
+        Start the background thread, if not already running.
+        """
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+            self.thread = threading.Thread(target=self._run, name="game-clocks", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread. Clocks are kept.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+class Ticker:
+    """
+    Calls a function at a fixed rate from a background thread, e.g.
+    to batch the position broadcasts of every room once per tick.
+    """
+
+    def __init__(self, rate, callback):
+        """
+        Args:
+            rate (float): Ticks per second.
+            callback (callable): Called with no arguments every tick.
+        """
+        self.interval = 1.0 / rate
+        self.callback = callback
+        self.stopped = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while not self.stopped.is_set():
+            try:
+                self.callback()
+            except Exception:
+                logger.exception("An exception occurred in a tick")
+
+            # Keep a steady rate, skipping ticks if we fell behind
+            next_tick += self.interval
+            now = time.monotonic()
+            if next_tick < now:
+                next_tick = now
+            self.stopped.wait(next_tick - now)
+
+    def start(self):
+        """
+        Start ticking, if not already started.
+        """
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run, name="ticker", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        self.stopped.set()
+        if thread is not None:
+            thread.join()
@@ -0,0 +1,166 @@
+import struct
+
+# Packed encoding of the location messages, an opt-in alternative to
+# JSON that a client asks for when it joins a game (see join_game).
+#
+# Coordinates are fixed-point int32 (1e-7 degree, about 1 cm), strings
+# are UTF-8 prefixed with their length in one byte, and everything is
+# little-endian.
+#
+# Location (client -> server, 'location' event or '/location' body):
+#   version u8 | id str | game_id str | role u8 | lat i32 | lon i32
+#
+# Players ('positions_delta', 'all_users' and the acknowledgements):
+#   version u8 | count u16 | count x (id str | role u8 | lat i32 | lon i32)
+
+JSON = "json"
+PACKED = "packed"
+ENCODINGS = (JSON, PACKED)
+
+# Content type of the packed '/location' requests and responses
+PACKED_CONTENT_TYPE = "application/x-packed-location"
+
+FORMAT_VERSION = 1
+SCALE = 10 ** 7
+
+# Role codes, any other role is sent as UNKNOWN_ROLE
+ROLES = ("cop", "mafia")
+UNKNOWN_ROLE = 255
+
+_BYTE = struct.Struct("<B")
+_COUNT = struct.Struct("<H")
+_POSITION = struct.Struct("<Bii")
+
+def _fixed(degrees):
+    return int(round(float(degrees) * SCALE))
+
+def _role_code(role):
+    try:
+        return ROLES.index(role)
+    except ValueError:
+        return UNKNOWN_ROLE
+
+def _role_name(code):
+    return ROLES[code] if code < len(ROLES) else None
+
+def _pack_string(value):
+    data = str(value).encode()
+    if len(data) > 255:
+        raise ValueError(f"'{value}' is too long to pack")
+    return bytes((len(data),)) + data
+
+class _Reader:
+    """
+    Reads a packed message from the front, raising ValueError when it
+    runs short.
+    """
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def unpack(self, layout):
+        try:
+            values = layout.unpack_from(self.data, self.offset)
+        except struct.error as e:
+            raise ValueError(f"Truncated message: {e}")
+        self.offset += layout.size
+        return values
+
+    def string(self):
+        (length,) = self.unpack(_BYTE)
+        end = self.offset + length
+        if end > len(self.data):
+            raise ValueError("Truncated message")
+        value = bytes(self.data[self.offset:end]).decode()
+        self.offset = end
+        return value
+
+    def version(self):
+        (version,) = self.unpack(_BYTE)
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported format version {version}")
+
+def encode_location(player_id, game_id, role, latitude, longitude):
+    """
+    Pack a location ping (what clients send).
+
+    Returns:
+        bytes: The packed ping.
+    """
+    return b"".join((
+        _BYTE.pack(FORMAT_VERSION),
+        _pack_string(player_id),
+        _pack_string(game_id),
+        _POSITION.pack(_role_code(role), _fixed(latitude), _fixed(longitude)),
+    ))
+
+def decode_location(data):
+    """
+    Unpack a location ping into the fields of a JSON ping.
+
+    Args:
+        data (bytes): The packed ping.
+
+    Returns:
+        dict: 'id', 'game_id', 'role', 'lat' and 'lon'.
+
+    Raises:
+        ValueError: If the message is malformed.
+    """
+    reader = _Reader(data)
+    reader.version()
+    player_id = reader.string()
+    game_id = reader.string()
+    role, latitude, longitude = reader.unpack(_POSITION)
+    return {
+        'id': player_id,
+        'game_id': game_id,
+        'role': _role_name(role),
+        'lat': latitude / SCALE,
+        'lon': longitude / SCALE,
+    }
+
+def encode_players(players):
+    """
+    Pack player states, as sent in 'positions_delta' and 'all_users'.
+
+    Args:
+        players (dict): player_id -> {'role', 'latitude', 'longitude'}.
+
+    Returns:
+        bytes: The packed players.
+    """
+    parts = [_BYTE.pack(FORMAT_VERSION), _COUNT.pack(len(players))]
+    for player_id, state in players.items():
+        parts.append(_pack_string(player_id))
+        parts.append(_POSITION.pack(
+            _role_code(state['role']),
+            _fixed(state['latitude']),
+            _fixed(state['longitude'])
+        ))
+    return b"".join(parts)
+
+def decode_players(data):
+    """
+    Unpack what encode_players() packed.
+
+    Returns:
+        dict: player_id -> {'role', 'latitude', 'longitude'}.
+
+    Raises:
+        ValueError: If the message is malformed.
+    """
+    reader = _Reader(data)
+    reader.version()
+    (count,) = reader.unpack(_COUNT)
+    players = {}
+    for _ in range(count):
+        player_id = reader.string()
+        role, latitude, longitude = reader.unpack(_POSITION)
+        players[player_id] = {
+            'role': _role_name(role),
+            'latitude': latitude / SCALE,
+            'longitude': longitude / SCALE,
+        }
+    return players
@@ -1,27 +1,43 @@
-# The wsgi.py file creates an application object (or callable) for the Gunicorn server
-# so that the server can use it. Each time a request comes, the server uses this application 
-# object to run the application’s request handlers upon parsing the URL.
-
-# Import the Flask app from gameserver.py
-from gameserver import app, socketio, threading, game_timer
-
-# Run the application from the main() method
-def main() -> None:
-    app_host = '0.0.0.0'
-    app_port = 5000
-    app_debug_state = True
-
-    timer_thread = threading.Thread(target=game_timer)
-    timer_thread.start()
-
-    socketio.run(
-        app, 
-        host = app_host, 
-        port = app_port, 
-        debug = app_debug_state,
-        allow_unsafe_werkzeug = True
-    )
-
-# Application entrypoint
-if __name__ == '__main__':
-    main()
+# The wsgi.py file creates an application object (or callable) for the Gunicorn server
+# so that the server can use it. Each time a request comes, the server uses this application 
+# object to run the application’s request handlers upon parsing the URL.
+
+# Build the Flask app from gameserver.py
+# In production, run it with Gunicorn and an async worker instead
+# (see gunicorn.conf.py):
+#   gunicorn --config gunicorn.conf.py wsgi:app
+# Add the seed users (safe to repeat), and upgrade the user records
+# of an older version (once) with:
+#   FLASK_APP=wsgi flask seed
+#   FLASK_APP=wsgi flask migrate-users
+from gameserver import create_app, seed_database, socketio, rooms, DEFAULT_GAME_ID, PRODUCTION
+
+app = create_app()
+
+# Run the application from the main() method
+def main() -> None:
+    app_host = '0.0.0.0'
+    app_port = 5000
+    app_debug_state = not PRODUCTION
+
+    # The development server seeds Redis itself
+    seed_database()
+
+    # Open the default game, which starts its game clock
+    rooms.get_or_create(DEFAULT_GAME_ID)
+
+    # Werkzeug serves with real threads, so Socket.IO runs in its
+    # 'threading' mode here even if gevent is installed (see
+    # gameserver.default_async_mode)
+    socketio.run(
+        app, 
+        host = app_host, 
+        port = app_port, 
+        debug = app_debug_state,
+        use_reloader = app_debug_state,
+        allow_unsafe_werkzeug = True
+    )
+
+# Application entrypoint
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@ import React, { useState, useEffect, useCallback } from "react";
 import { Map, Marker, ZoomControl } from "pigeon-maps";
 import { rgbToHex, withStyles } from "@material-ui/core/styles";
 import io from "socket.io-client";
+import { encodeLocation, readPlayers } from "../../utils/packedLocations";
 
 const styles = (theme) => ({
   root: {
@@ -37,8 +38,23 @@ const markerColors2 = {
 // Server address and port defined as env variables
 const server_address = `${process.env.REACT_APP_API_SERVICE_URL}`;
 
+// Opt in to the packed (binary) location messages
+const packedLocations = process.env.REACT_APP_PACKED_LOCATIONS === "true";
+
+// Last room version received, sent back when rejoining after a
+// reconnect so the server only sends the updates that were missed
+let lastVersion = null;
+
 // Establish websocket connection with Flask application
-const socket = io(server_address);
+// The server checks the access token once, when the socket connects
+const socket = io(server_address, {
+  auth: (cb) => {
+    const cookie = document.cookie
+      .split("; ")
+      .find((row) => row.startsWith("accessToken="));
+    cb({ token: cookie ? cookie.split("=")[1] : null });
+  },
+});
 
 function GeoLocation(props) {
   // Set initial values for Latitude, Longitude, Heading, and Speed
@@ -93,33 +109,25 @@ function GeoLocation(props) {
       'id': userId,
       'role': role,
       'lat': latitude,
-      'lon': longitude
+      'lon': longitude,
+      'game_id': readCookie('gameId') || 'default'
     };
 
     try {
-      const URI = server_address.concat("/location");
-      const requestConfiguration = {
-        method: "POST",
-        headers: {
-          'Accept': 'application/json',
-          'Content-Type': 'application/json',
-          'Access-Control-Allow-Origin': '*'
-        },
-        body: JSON.stringify(requestFields)
-      };
-
-      const response = fetch(URI, requestConfiguration);
-
-      if (response.ok) {
-        console.log("Server responded!");
-        try {
-          const responseData = response.json();
-          console.log(responseData);
-        } catch (error) {
-          alert("Error occurred in responseData!");
-          console.error(error);
+      // Send the location over the open socket, the server
+      // acknowledges with the same [response, status] pair
+      // as the '/location' endpoint
+      const message = packedLocations
+        ? encodeLocation(userId, requestFields.game_id, role, latitude, longitude)
+        : requestFields;
+      socket.emit('location', message, (responseData) => {
+        if (responseData && responseData[1] === 200) {
+          console.log("Server responded!");
+          console.log(readPlayers(responseData[0]));
+        } else {
+          console.error(responseData);
         }
-      }
+      });
     } catch (error) {
       alert("Error occurred in reportPlayerLocation!");
       console.error(error);
@@ -162,15 +170,17 @@ function GeoLocation(props) {
 
   // UseEffect hook to broadcast location
   useEffect(() => {
-    socket.on('cop_location_update', (data) => {
+    // Players that moved since the server's last broadcast tick
+    socket.on('positions_delta', (message, version) => {
+      lastVersion = version || lastVersion;
+      const data = readPlayers(message);
       setplayersCop((prevUsers) => ({ ...prevUsers, ...data }));
-    });
-
-    socket.on('mafia_location_update', (data) => {
       setplayersMafia((prevUsers) => ({ ...prevUsers, ...data }));
     });
 
-    socket.on('all_users', (data) => {
+    socket.on('all_users', (message, version) => {
+      lastVersion = version || lastVersion;
+      const data = readPlayers(message);
       setplayersCop(data);
       setplayersMafia(data);
     });
@@ -184,15 +194,17 @@ function GeoLocation(props) {
 
   // UseEffect hook to broadcast location
   useEffect(() => {
-    socket.on('cop_location_update', (data) => {
+    // Players that moved since the server's last broadcast tick
+    socket.on('positions_delta', (message, version) => {
+      lastVersion = version || lastVersion;
+      const data = readPlayers(message);
       setplayersCop((prevUsers) => ({ ...prevUsers, ...data }));
-    });
-
-    socket.on('mafia_location_update', (data) => {
       setplayersMafia((prevUsers) => ({ ...prevUsers, ...data }));
     });
 
-    socket.on('all_users', (data) => {
+    socket.on('all_users', (message, version) => {
+      lastVersion = version || lastVersion;
+      const data = readPlayers(message);
       setplayersCop(data);
       setplayersMafia(data);
     });
@@ -202,9 +214,25 @@ function GeoLocation(props) {
       alert(data.result);
     });
 
+    // Join this game's broadcast rooms (again after every reconnect)
+    const joinGame = () => {
+      socket.emit('join_game', {
+        'game_id': readCookie('gameId') || 'default',
+        'id': readCookie('userId'),
+        'role': readCookie('role'),
+        'encoding': packedLocations ? 'packed' : 'json',
+        'last_version': lastVersion
+      });
+    };
+
+    socket.on('connect', joinGame);
+    if (socket.connected) {
+      joinGame();
+    }
+
     return () => {
-      socket.off('cop_location_update');
-      socket.off('mafia_location_update');
+      socket.off('connect', joinGame);
+      socket.off('positions_delta');
       socket.off('all_users');
       socket.off('game_over');
     };
@@ -82,10 +82,11 @@ const useStyles = makeStyles((theme) => ({
 //  +++ Set cookies after successful SignIn +++
 //  ==========================================================
 
-const setCookie = (userId, role, accessToken, time) => {
+const setCookie = (userId, role, accessToken, gameId, time) => {
   document.cookie = `userId=${userId}; expires=${time}; path=/`;
   document.cookie = `role=${role}; expires=${time}; path=/`;
   document.cookie = `accessToken=${accessToken}; expires=${time}; path=/`;
+  document.cookie = `gameId=${gameId}; expires=${time}; path=/`;
  };
 
 
@@ -126,7 +127,7 @@ const SignIn = () => {
     fetch(`${process.env.REACT_APP_API_SERVICE_URL}/login`, config)
       .then(response => response.json())
       .then(data => {
-        setCookie(data[0].userId, data[0].role, data[0].access_token, data[0].expiration_time);
+        setCookie(data[0].userId, data[0].role, data[0].access_token, data[0].game_id, data[0].expiration_time);
         console.log('---');
         saveAuthorisation({
           access: data[0].access_token,
@@ -0,0 +1,71 @@
+// Packed encoding of the location messages (see be/wire_lib.py)
+// Coordinates are fixed-point int32 (1e-7 degree), strings are UTF-8
+// prefixed with their length in one byte, everything is little-endian
+const FORMAT_VERSION = 1;
+const SCALE = 1e7;
+const ROLES = ['cop', 'mafia'];
+const UNKNOWN_ROLE = 255;
+
+const encoder = new TextEncoder();
+const decoder = new TextDecoder();
+
+const roleCode = (role) => {
+  const code = ROLES.indexOf(role);
+  return code === -1 ? UNKNOWN_ROLE : code;
+};
+
+// Pack a location ping: version | id | game_id | role | lat | lon
+export function encodeLocation(id, gameId, role, latitude, longitude) {
+  const idBytes = encoder.encode(String(id));
+  const gameBytes = encoder.encode(String(gameId));
+  const buffer = new ArrayBuffer(1 + 1 + idBytes.length + 1 + gameBytes.length + 9);
+  const view = new DataView(buffer);
+  const bytes = new Uint8Array(buffer);
+
+  let offset = 0;
+  view.setUint8(offset++, FORMAT_VERSION);
+  view.setUint8(offset++, idBytes.length);
+  bytes.set(idBytes, offset);
+  offset += idBytes.length;
+  view.setUint8(offset++, gameBytes.length);
+  bytes.set(gameBytes, offset);
+  offset += gameBytes.length;
+  view.setUint8(offset++, roleCode(role));
+  view.setInt32(offset, Math.round(latitude * SCALE), true);
+  view.setInt32(offset + 4, Math.round(longitude * SCALE), true);
+  return buffer;
+}
+
+// Unpack the players of 'positions_delta', 'all_users' and the
+// location acknowledgements into { id: { role, latitude, longitude } }
+export function decodePlayers(data) {
+  const buffer = data instanceof ArrayBuffer ? data : data.buffer.slice(data.byteOffset, data.byteOffset + data.byteLength);
+  const view = new DataView(buffer);
+  const bytes = new Uint8Array(buffer);
+
+  if (view.getUint8(0) !== FORMAT_VERSION) {
+    throw new Error(`Unsupported format version ${view.getUint8(0)}`);
+  }
+  const count = view.getUint16(1, true);
+
+  const players = {};
+  let offset = 3;
+  for (let i = 0; i < count; i++) {
+    const length = view.getUint8(offset++);
+    const id = decoder.decode(bytes.subarray(offset, offset + length));
+    offset += length;
+    const role = view.getUint8(offset);
+    players[id] = {
+      role: ROLES[role] || null,
+      latitude: view.getInt32(offset + 1, true) / SCALE,
+      longitude: view.getInt32(offset + 5, true) / SCALE,
+    };
+    offset += 9;
+  }
+  return players;
+}
+
+// Players from a message, whatever its encoding
+export function readPlayers(data) {
+  return (data instanceof ArrayBuffer || ArrayBuffer.isView(data)) ? decodePlayers(data) : data;
+}